@@ -1,12 +1,19 @@
+from array import array
+import dataclasses
 from dataclasses import dataclass, field
 import math
-from typing import Dict, List, Tuple
+import networkx as nx
+import numpy as np
+import os
+from typing import Dict, List, Optional, Tuple
 from django.conf import settings
 import time
 import random
 from queue import Queue
 from enum import Enum
-from .models import Match, MatchColor, MatchQuality, MatchingGraph, PenaltyInfo, RouletteUser
+from .montecarlo import (STOP_LOWER_BOUND, STOP_NO_IMPROVEMENT, STOP_TIMEOUT, montecarlo_search,
+                         parallel_montecarlo_search, penalty_lower_bound)
+from .models import AnyMatchingGraph, Match, MatchColor, MatchQuality, PenaltyInfo, RouletteUser, as_compact_matching_graph
 
 
 def merge_matches(matches: List[Match]) -> List[List[RouletteUser]]:
@@ -42,76 +49,309 @@ def merge_matches(matches: List[Match]) -> List[List[RouletteUser]]:
 class Matching():
     matches: List[Tuple[RouletteUser, ...]] = field(default_factory=list)
     total_penalty: float = 0.0
+    # How many matchings (or moves) the engine has tried, and why it stopped.
+    iterations: int = 0
+    stop_reason: str = ""
 
 
-def generate_matches_montecarlo(graph: MatchingGraph, penalty_for_grouping_with_forbidden_user: float) -> Matching:
+def montecarlo_timeout_ms(user_count: int) -> float:
+    """ The time budget for the monte carlo matcher: it grows with the number of users, up to a hard limit. """
+    return min(settings.MATCHER_MONTECARLO_TIMEOUT_MS, settings.MATCHER_MONTECARLO_TIMEOUT_MS_PER_USER * user_count)
+
+
+def generate_matches_montecarlo(graph: AnyMatchingGraph, penalty_for_grouping_with_forbidden_user: float) -> Matching:
+    """
+    Generate random matchings and return the best one. The search stops after montecarlo_timeout_ms(),
+    after settings.MATCHER_MONTECARLO_MAX_ITERATIONS_WITHOUT_IMPROVEMENT matchings without improvement,
+    or when the best matching is certainly optimal - whichever comes first.
+    If settings.MATCHER_MONTECARLO_WORKERS is bigger than 1, the matchings are generated in that many processes.
+    """
+    graph = as_compact_matching_graph(graph)
     if len(graph) <= 1:
         return Matching()  # Not enough users
-    best_matching = Matching()
-    best_matching.total_penalty = math.inf
-    timeout_seconds = settings.MATCHER_MONTECARLO_TIMEOUT_MS / 1000.0
-    end_after = time.monotonic() + timeout_seconds
-    has_time = True
+    timeout_seconds = montecarlo_timeout_ms(len(graph)) / 1000.0
+    max_iterations_without_improvement = settings.MATCHER_MONTECARLO_MAX_ITERATIONS_WITHOUT_IMPROVEMENT
+    workers = settings.MATCHER_MONTECARLO_WORKERS
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        groups, total_penalty, iterations, stop_reason = parallel_montecarlo_search(
+            graph.weights, graph.forbidden, penalty_for_grouping_with_forbidden_user, timeout_seconds, workers,
+            max_iterations_without_improvement)
+    else:
+        groups, total_penalty, iterations, stop_reason = montecarlo_search(
+            graph.weights, graph.forbidden, penalty_for_grouping_with_forbidden_user, timeout_seconds,
+            max_iterations_without_improvement=max_iterations_without_improvement)
+    # Convert lists back to tuples
+    return Matching(matches=[tuple(graph.users[i] for i in group) for group in groups], total_penalty=total_penalty,
+                    iterations=iterations, stop_reason=stop_reason)
+
+
+# The stop reasons of the blossom engine.
+STOP_OPTIMAL = "optimal matching found"
+STOP_LEFTOVER_ADDED = "leftover user added to the best pair"
+
+
+def generate_matches_blossom(graph: AnyMatchingGraph, penalty_for_grouping_with_forbidden_user: float) -> Matching:
+    """
+    Find the pairs with the lowest total penalty, as a minimum-weight perfect matching (Edmonds' blossom algorithm).
+    A missing edge can be taken too, for the penalty_for_grouping_with_forbidden_user.
+    For an even number of users, the matching is optimal (the stop reason is STOP_OPTIMAL).
+    For an odd number of users, it's only a heuristic: one user is left over, and then joins the pair where
+    he/she adds the lowest penalty. The leftover user is matched with a dummy vertex, for the lowest penalty
+    he/she could ever add to a pair (his/her two cheapest edges), so the pairs are optimal together with a lower bound
+    of the group of 3. If the leftover user really adds that penalty, the matching is optimal. Otherwise a better
+    group of 3 may exist, and the stop reason is STOP_LEFTOVER_ADDED instead of STOP_OPTIMAL.
+    The graph is assumed to be symmetric, i.e. the edge (a, b) has the same weight as (b, a).
+    networkx is pure Python: on the benchmark data, this takes milliseconds for a few dozen users, about 0.1 s
+    for 100 users and about a second for 200 users.
+    """
+    graph = as_compact_matching_graph(graph)
+    n = len(graph)
+    if n <= 1:
+        return Matching()  # Not enough users
+    costs = graph.cost_matrix(penalty_for_grouping_with_forbidden_user)
+    leftover_vertex = None
+    if n % 2 == 1:
+        leftover_vertex = n
+        costs_without_diagonal = costs.astype(np.float64)
+        np.fill_diagonal(costs_without_diagonal, np.inf)
+        leftover_penalty_bounds = np.partition(costs_without_diagonal, 1, axis=1)[:, :2].sum(axis=1)
+    # networkx finds the maximum weight matching, so the weights need to be inverted.
+    # All the perfect matchings have the same number of edges, so the minimum is kept.
+    max_cost = float(costs.max()) + 1.0
+    if leftover_vertex is not None:
+        max_cost = max(max_cost, float(leftover_penalty_bounds.max()) + 1.0)
+    nx_graph = nx.Graph()
+    nx_graph.add_weighted_edges_from((i, j, max_cost - float(costs[i, j]))
+                                     for i in range(n) for j in range(i + 1, n))
+    if leftover_vertex is not None:
+        nx_graph.add_weighted_edges_from(
+            (i, leftover_vertex, max_cost - float(leftover_penalty_bounds[i])) for i in range(n))
+    groups = []
+    leftover_user = None
+    for i, j in nx.max_weight_matching(nx_graph, maxcardinality=True):
+        if leftover_vertex in (i, j):
+            leftover_user = i if j == leftover_vertex else j
+        else:
+            groups.append([min(i, j), max(i, j)])
+    total_penalty = sum(float(costs[i, j]) for i, j in groups)
+    stop_reason = STOP_OPTIMAL
+    if leftover_user is not None:
+        # No matching has a lower penalty than the pairs with the lowest penalty the leftover user could add.
+        lower_bound = total_penalty + float(leftover_penalty_bounds[leftover_user])
+        if len(groups) == 0:
+            groups.append([leftover_user])
+        else:
+            group_penalties = [float(costs[leftover_user, i] + costs[leftover_user, j])
+                               for i, j in groups]
+            best_group = int(np.argmin(group_penalties))
+            groups[best_group].append(leftover_user)
+            total_penalty += group_penalties[best_group]
+        if total_penalty > lower_bound + 1e-9:
+            stop_reason = STOP_LEFTOVER_ADDED
+    groups.sort()
+    return Matching(matches=[tuple(graph.users[i] for i in group) for group in groups], total_penalty=total_penalty,
+                    stop_reason=stop_reason)
+
+
+def _cost_rows(costs: np.ndarray) -> List[array]:
+    """
+    The rows of the cost matrix as arrays of doubles, like in montecarlo_search: they are much faster than numpy arrays
+    when accessed element by element, and take 8 bytes per element, unlike lists of Python floats.
+    """
+    return [array('d', row.astype(np.float64).tobytes()) for row in costs]
+
+
+def _groups_penalty(groups: List[List[int]], costs: List[array]) -> float:
+    return sum(costs[group[k]][group[l]] for group in groups for k in range(len(group)) for l in range(k + 1, len(group)))
+
+
+def _user_penalty(costs: List[array], user: int, group: List[int], without: int) -> float:
+    """ The penalty of the edges between user and the members of group, except 'without'. """
+    return sum(costs[user][other] for other in group if other != without)
+
+
+def _swap_delta(costs: List[array], user_a: int, group_a: List[int], user_b: int, group_b: List[int]) -> float:
+    """ The change of total penalty after swapping user_a (from group_a) with user_b (from group_b). """
+    return _user_penalty(costs, user_b, group_a, user_a) + _user_penalty(costs, user_a, group_b, user_b) \
+        - _user_penalty(costs, user_a, group_a, user_a) - \
+        _user_penalty(costs, user_b, group_b, user_b)
+
+
+def _move_delta(costs: List[array], user: int, group_from: List[int], group_to: List[int]) -> float:
+    """ The change of total penalty after moving user from group_from to group_to. """
+    return _user_penalty(costs, user, group_to, user) - _user_penalty(costs, user, group_from, user)
+
+
+def improve_matching(graph: AnyMatchingGraph, matching: Matching, penalty_for_grouping_with_forbidden_user: float,
+                     timeout_ms: Optional[float] = None) -> Matching:
+    """
+    Improve the matching by local search: apply the moves that lower the total penalty, until no move helps
+    or the time runs out. The moves are:
+    - swapping two users from different groups,
+    - moving a user from a bigger group (e.g. a leftover user in a group of 3) to a smaller group.
+    The change of penalty for each move is computed only from the edges of the users that move.
+    timeout_ms: the time budget. If None, settings.MATCHER_LOCAL_SEARCH_TIMEOUT_MS is used.
+    The graph is assumed to be symmetric, i.e. the edge (a, b) has the same weight as (b, a).
+    """
+    graph = as_compact_matching_graph(graph)
+    if timeout_ms is None:
+        timeout_ms = settings.MATCHER_LOCAL_SEARCH_TIMEOUT_MS
+    end_after = time.monotonic() + timeout_ms / 1000.0
+    costs = _cost_rows(graph.cost_matrix(
+        penalty_for_grouping_with_forbidden_user))
+    groups = [[graph.index_of(user.id) for user in group]
+              for group in matching.matches]
+
+    def try_swap(group_a, group_b):
+        for a_position, user_a in enumerate(group_a):
+            for b_position, user_b in enumerate(group_b):
+                if _swap_delta(costs, user_a, group_a, user_b, group_b) < -1e-9:
+                    group_a[a_position] = user_b
+                    group_b[b_position] = user_a
+                    return True
+        return False
+
+    def try_move(group_from, group_to):
+        if len(group_from) <= 2 or len(group_to) >= len(group_from):
+            return False
+        for user in group_from:
+            if _move_delta(costs, user, group_from, group_to) < -1e-9:
+                group_from.remove(user)
+                group_to.append(user)
+                return True
+        return False
+
+    improved = True
+    while improved and time.monotonic() < end_after:
+        improved = False
+        for a in range(len(groups)):
+            if time.monotonic() > end_after:
+                break
+            for b in range(a + 1, len(groups)):
+                if try_swap(groups[a], groups[b]) or try_move(groups[a], groups[b]) or try_move(groups[b], groups[a]):
+                    improved = True
+    return dataclasses.replace(matching, matches=[tuple(graph.users[i] for i in group) for group in groups],
+                               total_penalty=_groups_penalty(groups, costs))
+
+
+def generate_matches_annealing(graph: AnyMatchingGraph, penalty_for_grouping_with_forbidden_user: float) -> Matching:
+    """
+    Find a matching with low total penalty by simulated annealing.
+    Starting from a random matching, random moves are proposed: swapping two users from different groups,
+    or moving a user from a bigger group to a smaller one. A move that lowers the penalty is always accepted,
+    a worse move is accepted with probability exp(-delta / temperature).
+    The temperature falls exponentially from settings.MATCHER_ANNEALING_START_TEMPERATURE to
+    settings.MATCHER_ANNEALING_END_TEMPERATURE, within settings.MATCHER_ANNEALING_TIMEOUT_MS
+    (or settings.MATCHER_ANNEALING_ITERATIONS, if it's not None and ends earlier).
+    Like the Monte Carlo engine, the search stops earlier: after
+    settings.MATCHER_ANNEALING_MAX_ITERATIONS_WITHOUT_IMPROVEMENT moves without a new best matching,
+    or as soon as the best matching reaches the penalty_lower_bound.
+    A missing edge can be taken for the penalty_for_grouping_with_forbidden_user.
+    The graph is assumed to be symmetric, i.e. the edge (a, b) has the same weight as (b, a).
+    """
+    graph = as_compact_matching_graph(graph)
+    n = len(graph)
+    if n <= 1:
+        return Matching()  # Not enough users
+    costs = graph.cost_matrix(
+        penalty_for_grouping_with_forbidden_user)
+    lower_bound = penalty_lower_bound(costs)
+    costs = _cost_rows(costs)
+    start_temperature = settings.MATCHER_ANNEALING_START_TEMPERATURE
+    end_temperature = settings.MATCHER_ANNEALING_END_TEMPERATURE
+    timeout_seconds = settings.MATCHER_ANNEALING_TIMEOUT_MS / 1000.0
+    max_iterations = settings.MATCHER_ANNEALING_ITERATIONS
+    max_iterations_without_improvement = settings.MATCHER_ANNEALING_MAX_ITERATIONS_WITHOUT_IMPROVEMENT
+
+    # Random initial matching: random pairs, and the leftover user joins one of them.
+    users = list(range(n))
+    random.shuffle(users)
+    groups = [users[i:i + 2] for i in range(0, n - 1, 2)]
+    if n % 2 == 1:
+        random.choice(groups).append(users[-1])
+    group_of = [0] * n
+    for group_index, group in enumerate(groups):
+        for user in group:
+            group_of[user] = group_index
+    total_penalty = _groups_penalty(groups, costs)
+    best_groups = [group[:] for group in groups]
+    best_penalty = total_penalty
+    if len(groups) == 1:
+        return Matching(matches=[tuple(graph.users[i] for i in best_groups[0])], total_penalty=best_penalty)
+
+    started = time.monotonic()
+    temperature = start_temperature
     iterations = 0
-    while has_time:
+    best_found_in = 0
+    stop_reason = STOP_LOWER_BOUND if best_penalty <= lower_bound + 1e-9 else None
+    while stop_reason is None:
+        if iterations % 256 == 0:
+            if max_iterations_without_improvement is not None and \
+                    iterations - best_found_in >= max_iterations_without_improvement:
+                stop_reason = STOP_NO_IMPROVEMENT
+                break
+            time_progress = (time.monotonic() - started) / \
+                timeout_seconds if timeout_seconds > 0 else 1.0
+            iterations_progress = iterations / \
+                max_iterations if max_iterations is not None else 0.0
+            progress = max(time_progress, iterations_progress)
+            if progress >= 1.0:
+                stop_reason = STOP_TIMEOUT if time_progress >= 1.0 else "iteration limit reached"
+                break
+            temperature = start_temperature * \
+                (end_temperature / start_temperature) ** progress
         iterations += 1
-        not_processed_nodes = graph[:]
-        processed_user_ids = set()
-        random.shuffle(not_processed_nodes)
-        singleton_user_ids = set()
-        matches: List[List[RouletteUser]] = []
-        total_penalty = 0.0
-        while len(not_processed_nodes) > 0:
-            (user, neighbors) = not_processed_nodes[-1]
-            not_processed_nodes.pop()
-            if user.id in processed_user_ids:
-                # Already processed, but not removed from the list because it would be time-expensive.
-                continue
-            processed_user_ids.add(user.id)
-            possible_matches = [(user2, weight) for (
-                user2, weight, _) in neighbors if user2.id not in processed_user_ids]
-            if len(possible_matches) == 0:
-                singleton_user_ids.add(user.id)
-            else:
-                (user2, weight) = random.sample(possible_matches, 1)[0]
-                processed_user_ids.add(user2.id)
-                # List, not tuple, because we could modify it later
-                matches.append([user, user2])
-                total_penalty += weight
-        # Add non-paired users to the groups randomly
-        for (user, neighbors) in graph:
-            if user.id not in singleton_user_ids:
-                continue
-            if len(matches) == 0:
-                # No users matched at all? Then create an artificial group
-                matches.append([user])
-            else:
-                random_group = random.choice(matches)
-                for group_user in random_group:
-                    edge_exists = False
-                    for (user2, weight, _) in neighbors:
-                        if group_user.id == user2.id:
-                            total_penalty += weight
-                            edge_exists = True
-                    if not edge_exists:
-                        # Add a penalty for grouping with a user that otherwise would be forbidden (but we have to assign him somewhere)
-                        total_penalty += penalty_for_grouping_with_forbidden_user
-                random_group.append(user)
-        # Convert lists back to tuples
-        solution = [tuple(l) for l in matches]
-        if total_penalty < best_matching.total_penalty:
-            best_matching.matches = solution
-            best_matching.total_penalty = total_penalty
-        if time.monotonic() > end_after:
-            has_time = False
-    print("iterations: " + str(iterations))
-    return best_matching
-
-
-def get_matches_quality(graph: MatchingGraph, matches: List[Tuple[RouletteUser, ...]], penalty_for_grouping_with_forbidden_user, green_percentile_threshold=settings.MATCHER_GREEN_PERCENTILE, yellow_percentile_threshold=settings.MATCHER_YELLOW_PERCENTILE) -> List[MatchQuality]:
+        user_a = random.randrange(n)
+        user_b = random.randrange(n)
+        group_a = groups[group_of[user_a]]
+        group_b = groups[group_of[user_b]]
+        if group_a is group_b:
+            continue
+        is_move = len(group_a) > len(group_b) and random.random() < 0.5
+        if is_move:
+            delta = _move_delta(costs, user_a, group_a, group_b)
+        else:
+            delta = _swap_delta(costs, user_a, group_a, user_b, group_b)
+        if delta > 0 and random.random() >= math.exp(-delta / temperature):
+            continue
+        if is_move:
+            group_a.remove(user_a)
+            group_b.append(user_a)
+            group_of[user_a] = group_of[user_b]
+        else:
+            group_a[group_a.index(user_a)] = user_b
+            group_b[group_b.index(user_b)] = user_a
+            group_of[user_a], group_of[user_b] = group_of[user_b], group_of[user_a]
+        total_penalty += delta
+        if total_penalty < best_penalty - 1e-9:
+            best_penalty = total_penalty
+            best_groups = [group[:] for group in groups]
+            best_found_in = iterations
+            if best_penalty <= lower_bound + 1e-9:
+                stop_reason = STOP_LOWER_BOUND
+    return Matching(matches=[tuple(graph.users[i] for i in group) for group in best_groups],
+                    total_penalty=_groups_penalty(best_groups, costs), iterations=iterations, stop_reason=stop_reason)
+
+
+MATCHER_ENGINES = {
+    'montecarlo': generate_matches_montecarlo,
+    'blossom': generate_matches_blossom,
+    'annealing': generate_matches_annealing,
+}
+
+
+def generate_matches(graph: AnyMatchingGraph, penalty_for_grouping_with_forbidden_user: float) -> Matching:
+    """ Generate matches with the engine chosen in settings.MATCHER_ENGINE. """
+    engine = MATCHER_ENGINES[settings.MATCHER_ENGINE]
+    return engine(graph, penalty_for_grouping_with_forbidden_user)
+
+
+def get_matches_quality(graph: AnyMatchingGraph, matches: List[Tuple[RouletteUser, ...]], penalty_for_grouping_with_forbidden_user, green_percentile_threshold=settings.MATCHER_GREEN_PERCENTILE, yellow_percentile_threshold=settings.MATCHER_YELLOW_PERCENTILE) -> List[MatchQuality]:
     """
     Calculate quality of each match in matches.
-    graph: Graph in format: [(user1, [(user2, weight, penalty_info), ...]), ...]
+    graph: Graph in format: [(user1, [(user2, weight, penalty_info), ...]), ...], or a CompactMatchingGraph
     matches: A list of tuples of users matched with each other.
     penalty_for_grouping_with_forbidden_user: penalty for taking edge that doesn't exist in the graph
     green_percentile_threshold: a float threshold that tells how many edges in the graph are not green (yellow or red). If none, a default from settings.MATCHER_GREEN_PERCENTILE will be used.
@@ -119,31 +359,30 @@ def get_matches_quality(graph: MatchingGraph, matches: List[Tuple[RouletteUser,
     Returns: a list of MatchQuality objects, for each match in matches.
     """
 
-    def get_graph_weights():
-        graph_weights = []
-        for _, edges in graph:
-            for _, weight, _ in edges:
-                graph_weights.append(weight)
-        graph_weights.sort()
-        return graph_weights
+    def get_edge_weights():
+        # Most of the edges have the weight 0.0, and so do the missing edges (see CompactMatchingGraph).
+        # So only the non-zero weights are extracted, and the zero ones are just counted.
+        nonzero_weights = graph.weights[graph.weights != 0.0]
+        edge_count = graph.forbidden.size - np.count_nonzero(graph.forbidden)
+        return nonzero_weights, edge_count - len(nonzero_weights)
 
     # Return the maximum weight, for an edge to belong to a percentile.
-    def get_threshold(percentile, graph_weights):
+    # The weight is found by selection (numpy.partition), which is faster than sorting all the weights.
+    def get_threshold(percentile, edge_weights):
+        nonzero_weights, zero_count = edge_weights
+        edge_count = len(nonzero_weights) + zero_count
         threshold_index = math.ceil(
-            len(graph_weights) * percentile / 100.0) - 1
+            edge_count * percentile / 100.0) - 1
         if threshold_index < 0:
             return -math.inf
-        if threshold_index >= len(graph_weights):
+        if threshold_index >= edge_count:
             return math.inf
-        return graph_weights[threshold_index]
-
-    # Return the graph dictionary: { user_id -> (user, edges) }
-    # where edges is a list of (user_b, weight, penalty_info).
-    def get_graph_as_dict(graph_list):
-        graph_dict = {}
-        for user, edges in graph_list:
-            graph_dict[user.id] = (user, edges)
-        return graph_dict
+        negative_count = np.count_nonzero(nonzero_weights < 0.0)
+        if negative_count <= threshold_index < negative_count + zero_count:
+            return 0.0
+        if threshold_index >= negative_count:
+            threshold_index -= zero_count
+        return np.partition(nonzero_weights, threshold_index)[threshold_index]
 
     def get_color(weight, green_threshold, yellow_threshold):
         if weight <= green_threshold:
@@ -155,12 +394,12 @@ def get_matches_quality(graph: MatchingGraph, matches: List[Tuple[RouletteUser,
     def get_all_pairs(match_set):
         return [(user_a, user_b) for user_a in match_set for user_b in match_set if user_a.id < user_b.id]
 
-    graph_weights = get_graph_weights()
+    graph = as_compact_matching_graph(graph)
+    edge_weights = get_edge_weights()
     green_threshold = get_threshold(
-        green_percentile_threshold, graph_weights)
+        green_percentile_threshold, edge_weights)
     yellow_threshold = get_threshold(
-        yellow_percentile_threshold, graph_weights)
-    graph_dict = get_graph_as_dict(graph)
+        yellow_percentile_threshold, edge_weights)
     match_qualities = []
 
     for match in matches:
@@ -168,17 +407,15 @@ def get_matches_quality(graph: MatchingGraph, matches: List[Tuple[RouletteUser,
         for user_a, user_b in get_all_pairs(match):
             match_quality.users_a.append(user_a)
             match_quality.users_b.append(user_b)
-            edge_found = False
-            for user, weight, penalty_info in graph_dict[user_a.id][1]:
-                if user.id == user_b.id:
-                    edge_found = True
-                    match_quality.penalty_infos.append(penalty_info)
-                    color = get_color(
-                        weight, green_threshold, yellow_threshold)
-                    if match_quality.color is None or match_quality.color.value < color.value:
-                        match_quality.color = color
-                    break
-            if not edge_found:
+            i = graph.index_of(user_a.id)
+            j = graph.index_of(user_b.id)
+            if graph.has_edge(i, j):
+                match_quality.penalty_infos.append(graph.penalty_info(i, j))
+                color = get_color(
+                    graph.weights[i, j], green_threshold, yellow_threshold)
+                if match_quality.color is None or match_quality.color.value < color.value:
+                    match_quality.color = color
+            else:
                 penalty_info = PenaltyInfo(
                     is_forbidden=True, forbidden_penalty=penalty_for_grouping_with_forbidden_user)
                 match_quality.penalty_infos.append(penalty_info)
@@ -5,4 +5,4 @@ class MatcherConfig(AppConfig):
     name = 'matcher'
 
     def ready(self):
-        from .signals import add_default_votes, add_user_to_active_roulettes
+        from .signals import add_default_votes, add_user_to_active_roulettes, remove_match_from_pair_history
@@ -0,0 +1,149 @@
+"""
+Performance benchmark of the matcher: building the matching graph, generating matches with every engine,
+and evaluating the quality of the matches.
+The benchmark works on the current database, so it should be run on a throwaway one
+(the benchmark_matcher management command takes care of that).
+"""
+from datetime import timedelta
+import platform
+import random
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from django.conf import settings
+from django.core.management import call_command
+from django.utils import timezone
+from .algorithms import MATCHER_ENGINES, get_matches_quality, improve_matching
+from .models import (ExclusionGroup, Match, PenaltyGroup, Roulette, RouletteUser, compact_matching_graph, matching_graph,
+                     penalty_config, rebuild_pair_history)
+
+# Sizes of the synthetic organizations: every team is an exclusion group, every department is a penalty group.
+SYNTHETIC_TEAM_SIZE = 8
+SYNTHETIC_DEPARTMENT_SIZE = 40
+# The share of users that take part in every past roulette of a synthetic organization.
+SYNTHETIC_PARTICIPATION = 0.6
+
+
+def load_fixture(fixture: str):
+    """ Load a fixture (e.g. 'harry_potter.json') and build the pair history of its matches. """
+    call_command('loaddata', fixture, verbosity=0)
+    rebuild_pair_history()
+
+
+def generate_synthetic_org(user_count: int, years: float, seed: int = 0):
+    """
+    Fill the database with a synthetic organization: user_count users in teams (exclusion groups) and departments
+    (penalty groups), and a history of weekly roulettes over the last 'years' years, with random matches.
+    The objects are created in bulk, so no signals are sent (no votes are created and nothing is sent to Slack).
+    """
+    rng = random.Random(seed)
+    RouletteUser.objects.bulk_create(
+        [RouletteUser(name="User {0}".format(k), email="user{0}@example.com".format(k)) for k in range(user_count)])
+    user_ids = list(RouletteUser.objects.order_by('id').values_list('id', flat=True))
+    for group_model, group_size in ((ExclusionGroup, SYNTHETIC_TEAM_SIZE), (PenaltyGroup, SYNTHETIC_DEPARTMENT_SIZE)):
+        group_count = (user_count + group_size - 1) // group_size
+        group_model.objects.bulk_create([group_model() for _ in range(group_count)])
+        # bulk_create() doesn't set the primary keys on every database, so they are loaded again.
+        group_ids = list(group_model.objects.order_by('id').values_list('id', flat=True))
+        group_model.users.through.objects.bulk_create(
+            [group_model.users.through(**{group_model.__name__.lower() + '_id': group_ids[k // group_size],
+                                          'rouletteuser_id': user_id})
+             for k, user_id in enumerate(user_ids)])
+
+    now = timezone.now()
+    week_count = int(years * 52)
+    Roulette.objects.bulk_create(
+        [Roulette(vote_deadline=now - timedelta(weeks=week, days=1), coffee_deadline=now - timedelta(weeks=week - 1),
+                  matchings_found_on=now - timedelta(weeks=week)) for week in range(week_count, 0, -1)])
+    matches = []
+    for roulette in Roulette.objects.order_by('matchings_found_on'):
+        participants = rng.sample(user_ids, int(user_count * SYNTHETIC_PARTICIPATION))
+        groups = [participants[k:k + 2] for k in range(0, len(participants) - 1, 2)]
+        if len(participants) % 2 == 1 and len(groups) > 0:
+            groups[-1].append(participants[-1])
+        for group in groups:
+            for user_a in group:
+                for user_b in group:
+                    if user_a < user_b:
+                        matches.append(Match(user_a_id=user_a, user_b_id=user_b, roulette=roulette))
+    Match.objects.bulk_create(matches, batch_size=1000)
+    rebuild_pair_history()
+
+
+def _measure(function: Callable[[], Any], measure_memory: bool) -> Tuple[Any, Dict[str, Any]]:
+    """
+    Call the function, and return its result with its wall time in seconds. If measure_memory is True,
+    the function is called once more with tracemalloc on (tracing slows the code down too much to be timed),
+    and the peak of memory allocated by it is reported too.
+    """
+    started = time.perf_counter()
+    result = function()
+    measurement = {'wall_time_s': time.perf_counter() - started}
+    if measure_memory:
+        tracemalloc.start()
+        try:
+            function()
+            measurement['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, measurement
+
+
+def benchmark_current_database(name: str, engines: Optional[List[str]] = None, measure_memory: bool = True,
+                               list_graph_max_users: int = 1000, blossom_max_users: int = 200) -> Dict[str, Any]:
+    """
+    Benchmark the matcher on all the users in the database. Returns a JSON-serializable dict with the
+    measurements of every step. The steps, that would take too long for the number of users, are skipped:
+    matching_graph() for more than list_graph_max_users users, and the blossom engine for more than blossom_max_users.
+    """
+    users = list(RouletteUser.objects.order_by('id'))
+    penalty = penalty_config().grouping_with_forbidden_user
+    result = {
+        'name': name,
+        'users': len(users),
+        'matches_in_history': Match.objects.count(),
+        'steps': {},
+    }
+    steps = result['steps']
+
+    if len(users) <= list_graph_max_users:
+        _, steps['matching_graph'] = _measure(lambda: matching_graph(users), measure_memory)
+    else:
+        steps['matching_graph'] = {'skipped': "more than {0} users".format(list_graph_max_users)}
+    graph, steps['compact_matching_graph'] = _measure(lambda: compact_matching_graph(users), measure_memory)
+    result['edges'] = int((~graph.forbidden).sum()) // 2
+
+    matches = None
+    for engine in (engines if engines is not None else list(MATCHER_ENGINES)):
+        step_name = 'engine_' + engine
+        if engine == 'blossom' and len(users) > blossom_max_users:
+            steps[step_name] = {'skipped': "more than {0} users".format(blossom_max_users)}
+            continue
+        matching, steps[step_name] = _measure(lambda: MATCHER_ENGINES[engine](graph, penalty), measure_memory)
+        improved, local_search = _measure(lambda: improve_matching(graph, matching, penalty), False)
+        wall_time = steps[step_name]['wall_time_s']
+        steps[step_name].update({
+            'iterations': matching.iterations,
+            'iterations_per_s': matching.iterations / wall_time if wall_time > 0 else None,
+            'stop_reason': matching.stop_reason,
+            'penalty': matching.total_penalty,
+            'local_search_wall_time_s': local_search['wall_time_s'],
+            'penalty_after_local_search': improved.total_penalty,
+        })
+        if matches is None:
+            matches = improved.matches
+
+    if matches is not None:
+        _, steps['get_matches_quality'] = _measure(lambda: get_matches_quality(graph, matches, penalty),
+                                                   measure_memory)
+    return result
+
+
+def benchmark_info() -> Dict[str, Any]:
+    """ The environment of the benchmark, to be stored alongside the results. """
+    return {
+        'created': timezone.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {key: getattr(settings, key) for key in dir(settings) if key.startswith('MATCHER_')},
+    }
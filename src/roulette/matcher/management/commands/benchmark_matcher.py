@@ -0,0 +1,81 @@
+import json
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from matcher.algorithms import MATCHER_ENGINES
+from matcher.benchmark import benchmark_current_database, benchmark_info, generate_synthetic_org, load_fixture
+from matcher.models import invalidate_penalty_config
+
+FIXTURES = ['harry_potter.json', '35_users_one_year.json']
+
+
+class Command(BaseCommand):
+    help = "Measures the performance of the matcher on the fixtures and on synthetic organizations, " \
+        "and writes the results as JSON. Runs on a temporary test database, the real data is not touched."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='*', default=[100, 1000, 5000],
+                            help="Numbers of users of the synthetic organizations.")
+        parser.add_argument('--years', type=float, default=2.0,
+                            help="Years of weekly roulettes in the history of the synthetic organizations.")
+        parser.add_argument('--engines', nargs='*', choices=list(MATCHER_ENGINES), default=None,
+                            help="The engines to benchmark (all by default).")
+        parser.add_argument('--no-fixtures', action='store_true',
+                            help="Benchmark only the synthetic organizations.")
+        parser.add_argument('--no-memory', action='store_true',
+                            help="Don't measure peak memory (every step is run only once then).")
+        parser.add_argument('--list-graph-max-users', type=int, default=1000,
+                            help="Skip matching_graph() for bigger organizations.")
+        parser.add_argument('--blossom-max-users', type=int, default=200,
+                            help="Skip the blossom engine for bigger organizations. It takes about a second for 200 users.")
+        parser.add_argument('--seed', type=int, default=0,
+                            help="The seed for generating the synthetic organizations.")
+        parser.add_argument('--output', default='matcher_benchmark.json',
+                            help="The file to write the results to, or - for the standard output.")
+
+    def handle(self, *args, **options):
+        scenarios = []
+        if not options['no_fixtures']:
+            scenarios.extend((fixture, lambda fixture=fixture: load_fixture(fixture)) for fixture in FIXTURES)
+        scenarios.extend(("synthetic_{0}_users".format(size),
+                          lambda size=size: generate_synthetic_org(size, options['years'], options['seed']))
+                         for size in options['sizes'])
+
+        results = benchmark_info()
+        results['scenarios'] = []
+        old_database_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            for name, populate in scenarios:
+                call_command('flush', interactive=False, verbosity=0)
+                # Flushing doesn't send any model signals, so the cached penalties of the previous scenario stay.
+                invalidate_penalty_config()
+                populate()
+                result = benchmark_current_database(name, options['engines'], not options['no_memory'],
+                                                    options['list_graph_max_users'], options['blossom_max_users'])
+                results['scenarios'].append(result)
+                self._print_summary(result)
+        finally:
+            connection.creation.destroy_test_db(old_database_name, verbosity=0)
+
+        output = json.dumps(results, indent=2, default=str)
+        if options['output'] == '-':
+            self.stdout.write(output)
+        else:
+            with open(options['output'], 'w') as file:
+                file.write(output)
+            self.stderr.write(self.style.SUCCESS("Results written to {0}.".format(options['output'])))
+
+    def _print_summary(self, result):
+        self.stderr.write("{0}: {1} users, {2} edges".format(result['name'], result['users'], result['edges']))
+        for step, measurement in result['steps'].items():
+            if 'skipped' in measurement:
+                self.stderr.write("  {0}: skipped ({1})".format(step, measurement['skipped']))
+                continue
+            line = "  {0}: {1:.3f} s".format(step, measurement['wall_time_s'])
+            if 'peak_memory_bytes' in measurement:
+                line += ", peak memory {0:.1f} MiB".format(measurement['peak_memory_bytes'] / 2 ** 20)
+            if 'penalty' in measurement:
+                line += ", {0} iterations, penalty {1:.2f} ({2:.2f} after local search)".format(
+                    measurement['iterations'], measurement['penalty'], measurement['penalty_after_local_search'])
+            self.stderr.write(line)
@@ -0,0 +1,21 @@
+import csv
+from django.core.management.base import BaseCommand, CommandError
+from matcher.models import import_users
+
+
+class Command(BaseCommand):
+    help = "Imports roulette users from a CSV file with 'name' and 'email' columns. " \
+        "The users get default votes in the active roulettes. Users with an already existing email are skipped."
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help="Path to the CSV file. The first row must be the header: name,email")
+
+    def handle(self, *args, **options):
+        with open(options['csv_file'], newline='', encoding='utf-8') as file:
+            reader = csv.DictReader(file)
+            if reader.fieldnames is None or not {'name', 'email'}.issubset(reader.fieldnames):
+                raise CommandError("The CSV file must have the columns 'name' and 'email'.")
+            users = [(row['name'].strip(), row['email'].strip()) for row in reader]
+        created_count = import_users(users)
+        self.stdout.write(self.style.SUCCESS(
+            "Imported {0} new user(s), skipped {1} existing one(s).".format(created_count, len(users) - created_count)))
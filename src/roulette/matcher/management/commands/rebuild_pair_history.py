@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from matcher.models import PairHistory, rebuild_pair_history
+
+
+class Command(BaseCommand):
+    help = "Recreates the pair history (used for building the matching graph) from all the matches in the database."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            rebuild_pair_history()
+        self.stdout.write(self.style.SUCCESS(
+            "Rebuilt the history of {0} pair(s) of users.".format(PairHistory.objects.count())))
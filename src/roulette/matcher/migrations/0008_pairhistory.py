@@ -0,0 +1,55 @@
+# Generated by Django 3.1.8 on 2026-10-16 23:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+
+
+def populate_pair_history(apps, schema_editor):
+    Match = apps.get_model('matcher', 'Match')
+    PairHistory = apps.get_model('matcher', 'PairHistory')
+    histories = {}
+    matches = Match.objects.order_by('id').values_list(
+        'user_a_id', 'user_b_id', 'roulette__matchings_found_on')
+    for user_a_id, user_b_id, matchings_found_on in matches:
+        if user_a_id == user_b_id:
+            continue
+        pair = (min(user_a_id, user_b_id), max(user_a_id, user_b_id))
+        history = histories.setdefault(pair, PairHistory(
+            user_a_id=pair[0], user_b_id=pair[1]))
+        history.match_count += 1
+        if matchings_found_on is not None:
+            history.match_dates = (history.match_dates + [matchings_found_on.isoformat()])[
+                -settings.MATCHER_PAIR_HISTORY_DATES:]
+    PairHistory.objects.bulk_create(histories.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matcher', '0007_auto_20200512_1444'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PairHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('match_count', models.PositiveIntegerField(default=0)),
+                ('match_dates', models.JSONField(blank=True, default=list)),
+                ('user_a', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='matcher.rouletteuser')),
+                ('user_b', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='matcher.rouletteuser')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='pairhistory',
+            constraint=models.UniqueConstraint(fields=('user_a', 'user_b'), name='unique_pair_history'),
+        ),
+        migrations.AddConstraint(
+            model_name='pairhistory',
+            constraint=models.CheckConstraint(check=models.Q(user_a__lt=django.db.models.expressions.F('user_b')), name='pair_history_user_a_lt_user_b'),
+        ),
+        migrations.RunPython(populate_pair_history,
+                             migrations.RunPython.noop),
+    ]
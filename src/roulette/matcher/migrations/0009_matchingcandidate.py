@@ -0,0 +1,27 @@
+# Generated by Django 3.1.8 on 2026-10-17 00:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matcher', '0008_pairhistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MatchingCandidate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('total_penalty', models.FloatField()),
+                ('iterations', models.PositiveIntegerField(default=0)),
+                ('stop_reason', models.CharField(blank=True, max_length=64)),
+                ('groups', models.JSONField()),
+                ('quality', models.JSONField()),
+                ('roulette', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='matcher.roulette')),
+            ],
+        ),
+    ]
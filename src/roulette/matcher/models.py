@@ -1,11 +1,17 @@
 from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import F, Q, Value
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from enum import Enum
-from typing import List, Optional, Tuple
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+import numpy as np
 
 
 class RouletteUser(models.Model):
@@ -16,7 +22,17 @@ class RouletteUser(models.Model):
         return self.name
 
 
+class PairHistoryDeferringQuerySet(models.QuerySet):
+    """ Deleting the objects (and their Matches) updates the PairHistory once, see defer_pair_history_updates(). """
+
+    def delete(self):
+        with defer_pair_history_updates():
+            return super().delete()
+
+
 class Roulette(models.Model):
+    objects = PairHistoryDeferringQuerySet.as_manager()
+
     vote_deadline = models.DateTimeField()
     coffee_deadline = models.DateTimeField()
     matchings_found_on = models.DateTimeField(null=True, default=None, )
@@ -24,6 +40,10 @@ class Roulette(models.Model):
     def __str__(self):
         return "Roulette #{0} with coffee deadline {1}".format(self.pk, timezone.localtime(self.coffee_deadline))
 
+    def delete(self, *args, **kwargs):
+        with defer_pair_history_updates():
+            return super().delete(*args, **kwargs)
+
     def clean(self):
         if self.vote_deadline >= self.coffee_deadline:
             raise ValidationError(
@@ -135,10 +155,199 @@ class Match(models.Model):
         RouletteUser, on_delete=models.CASCADE, related_name='+')
     roulette = models.ForeignKey(Roulette, on_delete=models.CASCADE)
 
+    objects = PairHistoryDeferringQuerySet.as_manager()
+
     def __str__(self):
         return "Match of " + str(self.user_a) + " with " + str(self.user_b) + " on " + str(self.roulette)
 
 
+class PairHistory(models.Model):
+    """
+    Denormalized statistics of all the matches between two users, so that the matching graph can be built
+    without scanning the whole Match table. user_a is always the user with the smaller id.
+    It's updated together with the Match objects: the views call record_pair_history after creating the matches
+    in bulk (which sends no signals), and the signals of Match update it when a single Match is created or deleted
+    anywhere else (e.g. in the admin, in the shell or by loaddata). Changing the users or the roulette
+    of an existing Match isn't tracked. It can always be rebuilt from scratch
+    with 'python manage.py rebuild_pair_history'.
+    """
+    user_a = models.ForeignKey(
+        RouletteUser, on_delete=models.CASCADE, related_name='+')
+    user_b = models.ForeignKey(
+        RouletteUser, on_delete=models.CASCADE, related_name='+')
+    match_count = models.PositiveIntegerField(default=0)
+    # Matching dates of the roulettes, in which the users were matched - oldest first.
+    # Only the last settings.MATCHER_PAIR_HISTORY_DATES dates are kept.
+    match_dates = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user_a', 'user_b'], name='unique_pair_history'),
+            models.CheckConstraint(
+                check=Q(user_a__lt=F('user_b')), name='pair_history_user_a_lt_user_b'),
+        ]
+
+    def add_match(self, matchings_found_on: Optional[datetime]):
+        self.match_count += 1
+        if matchings_found_on is not None:
+            # A match may be added later than the newer ones (e.g. loaded from a backup), so the dates are sorted.
+            self.match_dates = sorted(self.match_dates + [matchings_found_on.isoformat()], key=parse_datetime)[
+                -settings.MATCHER_PAIR_HISTORY_DATES:]
+
+    def __str__(self):
+        return "History of matches of " + str(self.user_a) + " with " + str(self.user_b)
+
+
+def create_default_votes(roulette_ids: Iterable[int], user_ids: Iterable[int]):
+    """ Create the default (empty) votes of the users in the roulettes, in bulk. The existing votes are kept. """
+    user_ids = list(user_ids)
+    Vote.objects.bulk_create([Vote(roulette_id=roulette_id, user_id=user_id)
+                              for roulette_id in roulette_ids for user_id in user_ids], ignore_conflicts=True)
+
+
+def update_votes(roulette_id: int, choices: Dict[int, str]) -> List[Vote]:
+    """
+    Set the choices (user id => Vote.YES or Vote.NO) of the users in the roulette. The existing votes are loaded
+    with one query and only the changed ones are saved, in bulk. The missing votes are created.
+    Returns the votes that were changed or created.
+    """
+    votes = {vote.user_id: vote for vote in Vote.objects.filter(roulette_id=roulette_id, user_id__in=choices.keys())}
+    changed_votes = []
+    for user_id, choice in choices.items():
+        vote = votes.get(user_id)
+        if vote is not None and vote.choice != choice:
+            vote.choice = choice
+            changed_votes.append(vote)
+    Vote.objects.bulk_update(changed_votes, ['choice'])
+    missing_user_ids = [user_id for user_id in choices if user_id not in votes]
+    if len(missing_user_ids) > 0:
+        Vote.objects.bulk_create([Vote(roulette_id=roulette_id, user_id=user_id, choice=choices[user_id])
+                                  for user_id in missing_user_ids])
+        # bulk_create() doesn't set the primary keys on every database, so the votes are loaded again.
+        changed_votes.extend(Vote.objects.filter(roulette_id=roulette_id, user_id__in=missing_user_ids))
+    return changed_votes
+
+
+def import_users(users: Iterable[Tuple[str, str]]) -> int:
+    """
+    Create RouletteUsers from (name, email) pairs in a few batched statements, and add their default votes
+    to the active roulettes - just like the post_save signal does for a single user.
+    The emails that already exist are skipped. Returns the number of created users.
+    """
+    with transaction.atomic():
+        existing_emails = set(RouletteUser.objects.values_list('email', flat=True))
+        new_users = {}
+        for name, email in users:
+            if email not in existing_emails:
+                new_users.setdefault(email, RouletteUser(name=name, email=email))
+        RouletteUser.objects.bulk_create(new_users.values())
+        # bulk_create() doesn't set the primary keys on every database, so they are loaded again.
+        new_user_ids = [user_id for user_id, email in RouletteUser.objects.values_list('id', 'email')
+                        if email in new_users]
+        active_roulette_ids = Roulette.objects.filter(
+            matchings_found_on=None).values_list('id', flat=True)
+        create_default_votes(active_roulette_ids, new_user_ids)
+    return len(new_users)
+
+
+def _ordered_pair(user_a_id: int, user_b_id: int) -> Tuple[int, int]:
+    return (min(user_a_id, user_b_id), max(user_a_id, user_b_id))
+
+
+def record_pair_history(roulette: Roulette, user_id_pairs: Iterable[Tuple[int, int]]):
+    """
+    Update the PairHistory after matching the given pairs of user ids in roulette.
+    Call this in the same transaction that creates the Match objects.
+    """
+    pairs = [_ordered_pair(user_a_id, user_b_id)
+             for user_a_id, user_b_id in user_id_pairs]
+    if len(pairs) == 0:
+        return
+    unique_pairs = set(pairs)
+    user_a_ids = set(user_a_id for user_a_id, _ in unique_pairs)
+    histories = {}
+    for history in PairHistory.objects.filter(user_a__in=user_a_ids):
+        pair = (history.user_a_id, history.user_b_id)
+        if pair in unique_pairs:
+            histories[pair] = history
+    new_histories = {}
+    for pair in pairs:
+        history = histories.get(pair)
+        if history is None:
+            history = new_histories.setdefault(pair, PairHistory(
+                user_a_id=pair[0], user_b_id=pair[1]))
+        history.add_match(roulette.matchings_found_on)
+    PairHistory.objects.bulk_update(
+        histories.values(), ['match_count', 'match_dates'])
+    PairHistory.objects.bulk_create(new_histories.values())
+
+
+def rebuild_pair_history(pairs: Optional[Iterable[Tuple[int, int]]] = None):
+    """
+    Recreate the PairHistory objects from the Match table: all of them, or only those of the given pairs
+    of user ids (then in one query for the matches, whatever the number of pairs).
+    """
+    histories = {}
+    # Oldest first, so that the last dates are kept even for the matches added after the newer ones.
+    matches = Match.objects.order_by('roulette__matchings_found_on', 'id')
+    old_histories = PairHistory.objects.all()
+    if pairs is not None:
+        pairs = {_ordered_pair(user_a_id, user_b_id) for user_a_id, user_b_id in pairs}
+        if len(pairs) == 0:
+            return
+        user_ids = {user_id for pair in pairs for user_id in pair}
+        matches = matches.filter(user_a_id__in=user_ids, user_b_id__in=user_ids)
+        old_histories = [history for history in old_histories.filter(
+            user_a_id__in=user_ids, user_b_id__in=user_ids).only('id', 'user_a_id', 'user_b_id')
+            if (history.user_a_id, history.user_b_id) in pairs]
+    for user_a_id, user_b_id, matchings_found_on in matches.values_list(
+            'user_a_id', 'user_b_id', 'roulette__matchings_found_on'):
+        if user_a_id == user_b_id:
+            continue
+        pair = _ordered_pair(user_a_id, user_b_id)
+        if pairs is not None and pair not in pairs:
+            continue
+        history = histories.setdefault(pair, PairHistory(
+            user_a_id=pair[0], user_b_id=pair[1]))
+        history.add_match(matchings_found_on)
+    if pairs is None:
+        PairHistory.objects.all().delete()
+    else:
+        PairHistory.objects.filter(pk__in=[history.pk for history in old_histories]).delete()
+    PairHistory.objects.bulk_create(histories.values())
+
+
+# The pairs of the Matches deleted within defer_pair_history_updates(), in this thread. None outside of it.
+_deferred_pairs = threading.local()
+
+
+@contextmanager
+def defer_pair_history_updates():
+    """
+    Within this block, a created or deleted Match doesn't update its PairHistory right away (see matcher.signals):
+    its pair is only collected, and the PairHistory of all the collected pairs is rebuilt at the end, in one pass.
+    Deleting a roulette with many matches then takes a few queries, instead of a few queries per match.
+    The blocks can be nested: only the outermost one rebuilds the history.
+    """
+    if getattr(_deferred_pairs, 'pairs', None) is not None:
+        yield
+        return
+    _deferred_pairs.pairs = set()
+    try:
+        with transaction.atomic():
+            yield
+            pairs, _deferred_pairs.pairs = _deferred_pairs.pairs, None
+            rebuild_pair_history(pairs)
+    finally:
+        _deferred_pairs.pairs = None
+
+
+def deferred_pair_history_pairs() -> Optional[Set[Tuple[int, int]]]:
+    """ The set of pairs collected by the current defer_pair_history_updates() block, or None outside of it. """
+    return getattr(_deferred_pairs, 'pairs', None)
+
+
 class ExclusionGroup(models.Model):
     """ Describes a group of users, that should not be matched at all (if possible). """
     users = models.ManyToManyField(RouletteUser)
@@ -217,6 +426,58 @@ class PenaltyForGroupingWithForbiddenUser(SingletonModel):
     penalty = models.FloatField(default=10.0)
 
 
+@dataclass(frozen=True)
+class PenaltyConfig:
+    """ The values of all the penalty singletons, see penalty_config(). """
+    recent_match: float = PenaltyForRecentMatch._meta.get_field(
+        'penalty').default
+    number_of_matches: float = PenaltyForNumberOfMatches._meta.get_field(
+        'penalty').default
+    penalty_group: float = PenaltyForPenaltyGroup._meta.get_field(
+        'penalty').default
+    grouping_with_forbidden_user: float = PenaltyForGroupingWithForbiddenUser._meta.get_field(
+        'penalty').default
+
+
+# The penalty models, and the PenaltyConfig fields they are loaded to.
+PENALTY_CONFIG_FIELDS = {
+    PenaltyForRecentMatch: 'recent_match',
+    PenaltyForNumberOfMatches: 'number_of_matches',
+    PenaltyForPenaltyGroup: 'penalty_group',
+    PenaltyForGroupingWithForbiddenUser: 'grouping_with_forbidden_user',
+}
+PENALTY_CONFIG_CACHE_KEY = 'matcher.penalty_config'
+
+
+def load_penalty_config() -> PenaltyConfig:
+    """ Loads all the penalties from the database in one query. A penalty that was never saved has its default value. """
+    models_list = list(PENALTY_CONFIG_FIELDS)
+    querysets = [model.objects.annotate(kind=Value(index, output_field=models.IntegerField())).values_list('penalty', 'kind')
+                 for index, model in enumerate(models_list)]
+    penalties = {PENALTY_CONFIG_FIELDS[models_list[kind]]: penalty
+                 for penalty, kind in querysets[0].union(*querysets[1:], all=True)}
+    return PenaltyConfig(**penalties)
+
+
+def penalty_config() -> PenaltyConfig:
+    """
+    Returns the penalties, cached in the Django cache for settings.MATCHER_PENALTY_CONFIG_CACHE_SECONDS.
+    Saving or deleting any penalty invalidates the cache (see matcher.signals).
+    The penalties read inside a transaction aren't cached, because the transaction could still be rolled back.
+    """
+    config = cache.get(PENALTY_CONFIG_CACHE_KEY)
+    if config is None:
+        config = load_penalty_config()
+        if not transaction.get_connection().in_atomic_block:
+            cache.set(PENALTY_CONFIG_CACHE_KEY, config,
+                      settings.MATCHER_PENALTY_CONFIG_CACHE_SECONDS)
+    return config
+
+
+def invalidate_penalty_config():
+    cache.delete(PENALTY_CONFIG_CACHE_KEY)
+
+
 def get_last_roulette() -> Roulette:
     """ Returns either the last Roulette (by matching date) or None if there aren't any. """
     return Roulette.objects.exclude(matchings_found_on=None).order_by("-matchings_found_on").first()
@@ -306,6 +567,56 @@ class MatchQuality:
         return list(set(self.users_a).union(set(self.users_b)))
 
 
+class MatchingCandidate(models.Model):
+    """
+    A matching generated for a roulette, kept on the server until the results are submitted - so that the admin
+    can compare the matchings of several runs, and submit any of them without solving again.
+    groups: a list of groups, each of them a list of user ids.
+    quality: for each group, a dict with the 'color' (a MatchColor value), the 'total_penalty'
+     and the 'lines' of the description (see MatchQuality).
+    """
+    roulette = models.ForeignKey(Roulette, on_delete=models.CASCADE)
+    created_on = models.DateTimeField(auto_now_add=True)
+    total_penalty = models.FloatField()
+    iterations = models.PositiveIntegerField(default=0)
+    stop_reason = models.CharField(max_length=64, blank=True)
+    groups = models.JSONField()
+    quality = models.JSONField()
+
+    @classmethod
+    def from_matching(cls, roulette: Roulette, matching, matches_quality: List[MatchQuality]) -> 'MatchingCandidate':
+        """ Create (but don't save) a candidate from a matcher.algorithms.Matching and its quality. """
+        return cls(roulette=roulette, total_penalty=matching.total_penalty, iterations=matching.iterations,
+                   stop_reason=matching.stop_reason, groups=[[user.id for user in group] for group in matching.matches],
+                   quality=[{'color': match_quality.color.value, 'total_penalty': match_quality.total_penalty(),
+                             'lines': match_quality.str_lines()} for match_quality in matches_quality])
+
+    @classmethod
+    def prune(cls, roulette: Roulette, kept_candidate: 'MatchingCandidate'):
+        """
+        Delete the candidates of the roulette, except the settings.MATCHER_CANDIDATES_SHOWN best ones
+        and kept_candidate (the one that is about to be shown, even if it's worse).
+        """
+        best_ids = list(cls.objects.filter(roulette=roulette).order_by('total_penalty', 'created_on').values_list(
+            'id', flat=True)[:settings.MATCHER_CANDIDATES_SHOWN])
+        cls.objects.filter(roulette=roulette).exclude(id__in=best_ids + [kept_candidate.id]).delete()
+
+    def groups_by_id(self) -> Dict[str, List[int]]:
+        """ Returns the groups as a dict group_id => list of user ids that belong to the group. str => list(int) """
+        return {str(index): group for index, group in enumerate(self.groups, start=1)}
+
+    def groups_with_quality(self) -> List[Dict]:
+        """ Returns the quality dicts of the groups, with the RouletteUser objects of the group under 'users'. """
+        users = RouletteUser.objects.in_bulk(
+            [user_id for group in self.groups for user_id in group])
+        return [dict(quality, color=MatchColor(quality['color']),
+                     users=[users[user_id] for user_id in group if user_id in users])
+                for group, quality in zip(self.groups, self.quality)]
+
+    def __str__(self):
+        return "Matching candidate with penalty {0:.2f} for {1}".format(self.total_penalty, self.roulette)
+
+
 MatchingGraphEdge = Tuple[RouletteUser, float, PenaltyInfo]
 MatchingGraphVertex = Tuple[RouletteUser, List[MatchingGraphEdge]]
 """
@@ -314,67 +625,255 @@ A graph, where vertices are the users, and the edges have weights - the bigger t
 MatchingGraph = List[MatchingGraphVertex]
 
 
-def matching_graph(users: List[RouletteUser], custom_current_datetime: Optional[datetime] = None) -> MatchingGraph:
-    graph = []
-    penalty_for_penalty_group = PenaltyForPenaltyGroup.objects.get_or_create()[
-        0].penalty
-    penalty_for_number_matches = PenaltyForNumberOfMatches.objects.get_or_create()[
-        0].penalty
-    penalty_for_recent_match = PenaltyForRecentMatch.objects.get_or_create()[
-        0].penalty
-
-    if custom_current_datetime is None:
-        current_datetime = timezone.now()
-    else:
-        current_datetime = custom_current_datetime
+class CompactMatchingGraph:
+    """
+    A dense representation of MatchingGraph. The vertices (users) are identified by indices 0..N-1.
+    weights: N x N float64 matrix, weights[i, j] is the weight of the edge between users[i] and users[j].
+    forbidden: N x N boolean matrix, forbidden[i, j] is True if there is no edge between users[i] and users[j]
+     (then weights[i, j] is 0.0). The diagonal is always forbidden.
+    penalty_infos: a dict (i, j) -> PenaltyInfo, only for the edges whose PenaltyInfo is not the default PenaltyInfo().
+     This way, the memory usage stays low - most of the edges in a typical graph don't have any penalty.
+    """
 
-    for user in users:
+    def __init__(self, users: List[RouletteUser], weights: np.ndarray, forbidden: np.ndarray,
+                 penalty_infos: Optional[Dict[Tuple[int, int], PenaltyInfo]] = None):
+        self.users = list(users)
+        self.weights = weights
+        self.forbidden = forbidden
+        self.penalty_infos = penalty_infos if penalty_infos is not None else {}
+        self.user_ids = np.array([user.id for user in self.users], dtype=np.int64)
+        self._index_of_user_id = {user.id: index for index,
+                                  user in enumerate(self.users)}
+
+    def __len__(self):
+        return len(self.users)
+
+    def index_of(self, user_id: int) -> int:
+        return self._index_of_user_id[user_id]
+
+    def has_edge(self, i: int, j: int) -> bool:
+        return not self.forbidden[i, j]
+
+    def penalty_info(self, i: int, j: int) -> Optional[PenaltyInfo]:
+        """ Returns the PenaltyInfo of the edge between users[i] and users[j], or None if there is no such edge. """
+        if self.forbidden[i, j]:
+            return None
+        penalty_info = self.penalty_infos.get((i, j))
+        if penalty_info is None:
+            return PenaltyInfo()
+        return penalty_info
+
+    def cost_matrix(self, penalty_for_grouping_with_forbidden_user: float) -> np.ndarray:
+        """ Returns the weights matrix, where the missing edges have the weight of penalty_for_grouping_with_forbidden_user. """
+        return np.where(self.forbidden, penalty_for_grouping_with_forbidden_user, self.weights)
+
+    @classmethod
+    def from_matching_graph(cls, graph: MatchingGraph) -> 'CompactMatchingGraph':
+        users = [user for user, _ in graph]
+        n = len(users)
+        weights = np.zeros((n, n), dtype=np.float64)
+        forbidden = np.ones((n, n), dtype=bool)
+        penalty_infos = {}
+        index_of_user_id = {user.id: index for index,
+                            user in enumerate(users)}
+        for i, (_, edges) in enumerate(graph):
+            for user2, weight, penalty_info in edges:
+                j = index_of_user_id[user2.id]
+                weights[i, j] = weight
+                forbidden[i, j] = False
+                if penalty_info != PenaltyInfo():
+                    penalty_infos[(i, j)] = penalty_info
+        return cls(users, weights, forbidden, penalty_infos)
+
+    def to_matching_graph(self) -> MatchingGraph:
+        graph = []
+        for i, user in enumerate(self.users):
+            edges = []
+            for j in np.flatnonzero(~self.forbidden[i]):
+                edges.append((self.users[j], float(self.weights[i, j]),
+                              self.penalty_info(i, j)))
+            graph.append((user, edges))
+        return graph
+
+
+AnyMatchingGraph = Union[MatchingGraph, CompactMatchingGraph]
+
+
+def as_compact_matching_graph(graph: AnyMatchingGraph) -> CompactMatchingGraph:
+    if isinstance(graph, CompactMatchingGraph):
+        return graph
+    return CompactMatchingGraph.from_matching_graph(graph)
+
+
+class _MatchingGraphData:
+    """
+    All the data needed to compute the edges of a matching graph, fetched from the database in a constant
+    number of queries (independent of the number of users).
+    """
+
+    def __init__(self, custom_current_datetime: Optional[datetime] = None):
+        config = penalty_config()
+        self.penalty_for_penalty_group = config.penalty_group
+        self.penalty_for_number_matches = config.number_of_matches
+        self.penalty_for_recent_match = config.recent_match
+
+        if custom_current_datetime is None:
+            self.current_datetime = timezone.now()
+        else:
+            self.current_datetime = custom_current_datetime
+        self.recent_matches_since = self.current_datetime - \
+            timedelta(days=365)
+
+        self.exclusion_groups_of_user, self.exclusion_group_members = self._group_memberships(
+            ExclusionGroup)
+        self.penalty_groups_of_user, self.penalty_group_members = self._group_memberships(
+            PenaltyGroup)
+        self.last_roulette_partners = self._last_roulette_partners()
+        self.match_history = self._match_history()
+
+    @staticmethod
+    def _group_memberships(group_model) -> Tuple[Dict[int, List[int]], Dict[int, Set[int]]]:
+        """
+        Returns two dicts, for the groups of group_model type: user_id -> list of ids of the groups that the user
+        belongs to, and group_id -> set of ids of the users that belong to the group.
+        """
+        user_groups = {}
+        group_members = {}
+        memberships = group_model.users.through.objects.values_list(
+            group_model.__name__.lower() + '_id', 'rouletteuser_id')
+        for group_id, user_id in memberships:
+            user_groups.setdefault(user_id, []).append(group_id)
+            group_members.setdefault(group_id, set()).add(user_id)
+        return user_groups, group_members
+
+    @staticmethod
+    def _match_history() -> Dict[Tuple[int, int], Tuple[int, List[datetime]]]:
+        """
+        Returns a dict: (smaller_user_id, bigger_user_id) -> (number of matches, list of matching dates of the last
+        roulettes, in which the two users were matched, oldest first).
+        """
+        history = {}
+        pair_histories = PairHistory.objects.values_list(
+            'user_a_id', 'user_b_id', 'match_count', 'match_dates')
+        for user_a_id, user_b_id, match_count, match_dates in pair_histories:
+            history[(user_a_id, user_b_id)] = (
+                match_count, [parse_datetime(date) for date in match_dates])
+        return history
+
+    @staticmethod
+    def _last_roulette_partners() -> Dict[int, Set[int]]:
+        """ Returns a dict: user_id -> set of user ids that the user has been matched with in the last roulette. """
+        partners = {}
+        last_roulette = get_last_roulette()
+        if last_roulette is None:
+            return partners
+        for user_a_id, user_b_id in last_roulette.match_set.values_list('user_a_id', 'user_b_id'):
+            partners.setdefault(user_a_id, set()).add(user_b_id)
+            partners.setdefault(user_b_id, set()).add(user_a_id)
+        return partners
+
+    def excluded_user_ids(self, user_id: int) -> Set[int]:
+        """ Returns the ids of users that user_id can't be matched with (including user_id itself). """
         user_ids_excluded = set()
-        user_ids_excluded.add(user.id)
+        user_ids_excluded.add(user_id)
         # Exclude users from exclusion groups
-        groups = ExclusionGroup.objects.filter(users__id=user.id).all()
-        for group in groups:
-            for excluded_user in RouletteUser.objects.filter(exclusiongroup__id=group.id):
-                user_ids_excluded.add(excluded_user.id)
+        for group_id in self.exclusion_groups_of_user.get(user_id, []):
+            user_ids_excluded.update(self.exclusion_group_members[group_id])
         # Exclude pairs generated in last run
-        last_roulette = get_last_roulette()
-        if last_roulette is not None:
-            for match in last_roulette.match_set.all():
-                if match.user_a.id == user.id:
-                    user_ids_excluded.add(match.user_b.id)
-                if match.user_b.id == user.id:
-                    user_ids_excluded.add(match.user_a.id)
+        user_ids_excluded.update(
+            self.last_roulette_partners.get(user_id, set()))
+        return user_ids_excluded
+
+    def penalized_pairs(self) -> Set[Tuple[int, int]]:
+        """
+        Returns all the pairs (user_id, user2_id) that may have a penalty: the users share a penalty group,
+        or have been matched before. For any other pair, penalty_info() returns the default PenaltyInfo().
+        Both (a, b) and (b, a) are returned.
+        """
+        pairs = set()
+        for members in self.penalty_group_members.values():
+            for user_id in members:
+                for user2_id in members:
+                    if user_id != user2_id:
+                        pairs.add((user_id, user2_id))
+        for user_id, user2_id in self.match_history.keys():
+            pairs.add((user_id, user2_id))
+            pairs.add((user2_id, user_id))
+        return pairs
+
+    def penalty_info(self, user_id: int, user2_id: int) -> PenaltyInfo:
+        penalty_info = PenaltyInfo()
+        # Penalty for penalty group
+        user_penalty_groups = self.penalty_groups_of_user.get(user_id, [])
+        for group_id in self.penalty_groups_of_user.get(user2_id, []):
+            if group_id in user_penalty_groups:
+                penalty_info.penalty_group_count += 1
+                penalty_info.penalty_group_penalty += self.penalty_for_penalty_group
+        # Penalty for number of matches
+        match_count, matching_dates = self.match_history.get(
+            _ordered_pair(user_id, user2_id), (0, []))
+        penalty_info.number_matches = match_count
+        penalty_info.number_matches_penalty = penalty_info.number_matches * \
+            self.penalty_for_number_matches
+        # Penalties for recent matches
+        for matchings_found_on in matching_dates:
+            if matchings_found_on < self.recent_matches_since:
+                continue
+            time_passed = self.current_datetime - matchings_found_on
+            days_passed = time_passed.days
+            recent_match = RecentMatchInfo()
+            recent_match.penalty = max(0.0, self.penalty_for_recent_match *
+                                       (1.0 - days_passed / 365.0))  # linear relationship
+            recent_match.days_ago = days_passed
+            penalty_info.recent_matches.append(recent_match)
+        return penalty_info
+
+
+def matching_graph(users: List[RouletteUser], custom_current_datetime: Optional[datetime] = None) -> MatchingGraph:
+    """
+    Build the matching graph for given users.
+    All the data is fetched from the database in a constant number of queries (independent of the number of users),
+    then the edges are computed in memory.
+    """
+    users = list(users)
+    data = _MatchingGraphData(custom_current_datetime)
+    graph = []
+    for user in users:
+        user_ids_excluded = data.excluded_user_ids(user.id)
         edges = []
         for user2 in users:
-            # Add edges
             if user2.id in user_ids_excluded:
                 continue
-            penalty_info = PenaltyInfo()
-            # And calculate the weights for them - penalty for penalty group
-            groups_user2 = PenaltyGroup.objects.filter(
-                users__id=user2.id).all()
-            for group in groups_user2:
-                if RouletteUser.objects.filter(penaltygroup__id=group.id).filter(id=user.id).exists():
-                    penalty_info.penalty_group_count += 1
-                    penalty_info.penalty_group_penalty += penalty_for_penalty_group
-            # Penalty for number of matches
-            user_user2_matches = Match.objects.filter(
-                Q(user_a=user, user_b=user2) | Q(user_a=user2, user_b=user))
-            penalty_info.number_matches = len(user_user2_matches)
-            penalty_info.number_matches_penalty = penalty_info.number_matches * \
-                penalty_for_number_matches
-            # Penalties for recent matches
-            recent_user_user2_matches = user_user2_matches.filter(
-                roulette__matchings_found_on__gte=current_datetime - timedelta(days=365)).all()
-            for match in recent_user_user2_matches:
-                time_passed = current_datetime - match.roulette.matchings_found_on
-                days_passed = time_passed.days
-                recent_match = RecentMatchInfo()
-                recent_match.penalty = max(0.0, penalty_for_recent_match *
-                                           (1.0 - days_passed / 365.0))  # linear relationship
-                recent_match.days_ago = days_passed
-                penalty_info.recent_matches.append(recent_match)
+            penalty_info = data.penalty_info(user.id, user2.id)
             edges.append((user2, penalty_info.total_penalty(), penalty_info))
-
         graph.append((user, edges))
     return graph
+
+
+def compact_matching_graph(users: List[RouletteUser], custom_current_datetime: Optional[datetime] = None) -> CompactMatchingGraph:
+    """
+    Build the same graph as matching_graph(), but in the compact representation.
+    Only the pairs that may have a penalty are evaluated one by one, so this is much faster for big graphs.
+    """
+    users = list(users)
+    data = _MatchingGraphData(custom_current_datetime)
+    n = len(users)
+    index_of_user_id = {user.id: index for index, user in enumerate(users)}
+    weights = np.zeros((n, n), dtype=np.float64)
+    forbidden = np.zeros((n, n), dtype=bool)
+    for i, user in enumerate(users):
+        for excluded_user_id in data.excluded_user_ids(user.id):
+            j = index_of_user_id.get(excluded_user_id)
+            if j is not None:
+                forbidden[i, j] = True
+    penalty_infos = {}
+    for user_id, user2_id in data.penalized_pairs():
+        i = index_of_user_id.get(user_id)
+        j = index_of_user_id.get(user2_id)
+        if i is None or j is None or forbidden[i, j]:
+            continue
+        penalty_info = data.penalty_info(user_id, user2_id)
+        if penalty_info != PenaltyInfo():
+            weights[i, j] = penalty_info.total_penalty()
+            penalty_infos[(i, j)] = penalty_info
+    return CompactMatchingGraph(users, weights, forbidden, penalty_infos)
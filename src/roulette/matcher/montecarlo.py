@@ -0,0 +1,233 @@
+"""
+The core of the Monte Carlo matcher. It works on user indices of a CompactMatchingGraph, instead of RouletteUser objects.
+This module must not depend on Django, because it's imported by the worker processes of the parallel search.
+"""
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import math
+import random
+import time
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+
+# The reasons why the search stopped.
+STOP_TIMEOUT = "timeout"
+STOP_NO_IMPROVEMENT = "no improvement"
+STOP_LOWER_BOUND = "lower bound reached"
+
+# (groups of user indices, total penalty of the groups, number of iterations done, reason why the search stopped)
+SearchResult = Tuple[List[List[int]], float, int, str]
+
+
+def penalty_lower_bound(costs: np.ndarray) -> float:
+    """
+    No matching can have a lower total penalty than this: every user has at least one edge in his/her group,
+    and every edge is shared by two users. So it's the sum of the cheapest edge of every user, divided by two.
+    costs: the matrix of (non-negative) penalties, where missing edges have the penalty for grouping with a forbidden user.
+    """
+    if len(costs) <= 1:
+        return 0.0
+    costs_without_diagonal = costs.copy()
+    np.fill_diagonal(costs_without_diagonal, np.inf)
+    return float(costs_without_diagonal.min(axis=1).sum()) / 2.0
+
+
+def montecarlo_search(weights: np.ndarray, forbidden: np.ndarray, penalty_for_grouping_with_forbidden_user: float,
+                      timeout_seconds: float, seed: Optional[int] = None,
+                      max_iterations_without_improvement: Optional[int] = None) -> SearchResult:
+    """
+    Generate random matchings, and return the best one. The search stops when timeout_seconds pass,
+    when max_iterations_without_improvement (if not None) matchings in a row weren't better than the best one,
+    or when the best matching reaches the penalty_lower_bound - then it's certainly optimal.
+    weights, forbidden: the matrices of a CompactMatchingGraph with at least 2 vertices.
+    seed: the seed for the random number generator, or None to use a random one.
+
+    A random matching is built by taking a random not processed user, and pairing him/her with a random
+    not processed neighbor. Users left without a neighbor are added to random groups at the end.
+    The iterations don't allocate anything but the groups of a new best matching: all the state lives
+    in lists preallocated once per search.
+    """
+    end_after = time.monotonic() + timeout_seconds
+    n = len(weights)
+    rng = random.Random(seed)
+    random_fraction = rng.random
+    costs = np.where(forbidden, penalty_for_grouping_with_forbidden_user,
+                     weights)
+    lower_bound = penalty_lower_bound(costs)
+    # Arrays are much faster than numpy arrays when accessed element by element,
+    # and much smaller than lists of Python floats and ints.
+    # The rows are copied as raw buffers, because converting the elements one by one is slow for big graphs.
+    costs = [array('d', row.tobytes()) for row in costs]
+    weights = [array('d', row.astype(np.float64).tobytes()) for row in weights]
+    allowed = [bytes(row) for row in ~forbidden]
+    neighbors = [array('q', np.flatnonzero(row).astype(np.int64).tobytes()) for row in ~forbidden]
+    # Not processed users are alive[:alive_count], and position[i] is the index of user i in alive,
+    # so that a user can be removed by swapping him/her with the last alive one.
+    alive = list(range(n))
+    position = list(range(n))
+    # processed_in[i] == iterations if user i was already processed in the current iteration.
+    processed_in = [0] * n
+    pairs_first = [0] * (n // 2)
+    pairs_second = [0] * (n // 2)
+    singletons = [0] * n
+    best_groups = []
+    best_penalty = math.inf
+    stop_reason = None
+    iterations = 0
+    iterations_without_improvement = 0
+    while stop_reason is None:
+        iterations += 1
+        alive_count = n
+        pairs_count = 0
+        singletons_count = 0
+        total_penalty = 0.0
+        while alive_count > 0:
+            i = alive[int(random_fraction() * alive_count)]
+            processed_in[i] = iterations
+            alive_count -= 1
+            index, last = position[i], alive[alive_count]
+            alive[index], position[last] = last, index
+            alive[alive_count], position[i] = i, alive_count
+            j = _random_not_processed_neighbor(neighbors[i], allowed[i], alive, alive_count,
+                                               processed_in, iterations, random_fraction)
+            if j < 0:
+                singletons[singletons_count] = i
+                singletons_count += 1
+                continue
+            processed_in[j] = iterations
+            alive_count -= 1
+            index, last = position[j], alive[alive_count]
+            alive[index], position[last] = last, index
+            alive[alive_count], position[j] = j, alive_count
+            pairs_first[pairs_count] = i
+            pairs_second[pairs_count] = j
+            pairs_count += 1
+            total_penalty += weights[i][j]
+        # Add non-paired users to the groups randomly. They are rare, so they can live in temporary lists.
+        lonely_users = sorted(singletons[:singletons_count])
+        lonely_users_groups = []
+        for i in lonely_users:
+            # No users matched at all? Then all of them go to one artificial group
+            group = int(random_fraction() * pairs_count) if pairs_count > 0 else 0
+            if pairs_count > 0:
+                # A missing edge costs penalty_for_grouping_with_forbidden_user: we have to assign the user somewhere.
+                total_penalty += costs[i][pairs_first[group]] + costs[i][pairs_second[group]]
+            for other, other_group in zip(lonely_users, lonely_users_groups):
+                if other_group == group:
+                    total_penalty += costs[i][other]
+            lonely_users_groups.append(group)
+        if total_penalty < best_penalty:
+            best_groups = [[pairs_first[k], pairs_second[k]]
+                           for k in range(pairs_count)] or [[]]
+            for i, group in zip(lonely_users, lonely_users_groups):
+                best_groups[group].append(i)
+            best_penalty = total_penalty
+            iterations_without_improvement = 0
+        else:
+            iterations_without_improvement += 1
+        if best_penalty <= lower_bound + 1e-9:
+            stop_reason = STOP_LOWER_BOUND
+        elif max_iterations_without_improvement is not None and iterations_without_improvement >= max_iterations_without_improvement:
+            stop_reason = STOP_NO_IMPROVEMENT
+        elif time.monotonic() > end_after:
+            stop_reason = STOP_TIMEOUT
+    return best_groups, best_penalty, iterations, stop_reason
+
+
+# How many times a random candidate is drawn, before counting the suitable ones.
+_NEIGHBOR_DRAW_ATTEMPTS = 4
+
+
+def _random_not_processed_neighbor(user_neighbors: Sequence[int], allowed_row: bytes, alive: List[int], alive_count: int,
+                                   processed_in: List[int], iteration: int, random_fraction) -> int:
+    """
+    Return a uniformly random neighbor not processed in the iteration, or -1 if there is none.
+    The candidates are either the neighbors (that must be not processed) or the not processed users
+    (that must be neighbors), whichever is fewer: early in the iteration most neighbors are not processed,
+    late in the iteration there are only few not processed users left. Random candidates are drawn
+    until a suitable one is found, and if that takes too long, the suitable candidates are counted instead.
+    Both ways give every not processed neighbor the same chance.
+    """
+    if len(user_neighbors) <= alive_count:
+        return _draw_not_processed(user_neighbors, processed_in, iteration, random_fraction)
+    return _draw_allowed(alive, alive_count, allowed_row, random_fraction)
+
+
+def _draw_not_processed(user_neighbors: Sequence[int], processed_in: List[int], iteration: int, random_fraction) -> int:
+    count = len(user_neighbors)
+    if count == 0:
+        return -1
+    for _ in range(_NEIGHBOR_DRAW_ATTEMPTS):
+        j = user_neighbors[int(random_fraction() * count)]
+        if processed_in[j] != iteration:
+            return j
+    suitable_count = 0
+    for j in user_neighbors:
+        if processed_in[j] != iteration:
+            suitable_count += 1
+    if suitable_count == 0:
+        return -1
+    chosen = int(random_fraction() * suitable_count)
+    for j in user_neighbors:
+        if processed_in[j] != iteration:
+            if chosen == 0:
+                return j
+            chosen -= 1
+
+
+def _draw_allowed(alive: List[int], alive_count: int, allowed_row: bytes, random_fraction) -> int:
+    if alive_count == 0:
+        return -1
+    for _ in range(_NEIGHBOR_DRAW_ATTEMPTS):
+        j = alive[int(random_fraction() * alive_count)]
+        if allowed_row[j]:
+            return j
+    suitable_count = 0
+    for k in range(alive_count):
+        if allowed_row[alive[k]]:
+            suitable_count += 1
+    if suitable_count == 0:
+        return -1
+    chosen = int(random_fraction() * suitable_count)
+    for k in range(alive_count):
+        j = alive[k]
+        if allowed_row[j]:
+            if chosen == 0:
+                return j
+            chosen -= 1
+
+
+# The graph of the parallel search, set once in every worker process by _init_worker.
+_worker_graph = None
+
+
+def _init_worker(weights: np.ndarray, forbidden: np.ndarray, penalty_for_grouping_with_forbidden_user: float):
+    global _worker_graph
+    _worker_graph = (weights, forbidden,
+                     penalty_for_grouping_with_forbidden_user)
+
+
+def _worker_search(seed: int, timeout_seconds: float, max_iterations_without_improvement: Optional[int]) -> SearchResult:
+    # The time budget is counted from here, when the worker process has started and has the graph.
+    return montecarlo_search(*_worker_graph, timeout_seconds, seed, max_iterations_without_improvement)
+
+
+def parallel_montecarlo_search(weights: np.ndarray, forbidden: np.ndarray, penalty_for_grouping_with_forbidden_user: float,
+                               timeout_seconds: float, workers: int,
+                               max_iterations_without_improvement: Optional[int] = None) -> SearchResult:
+    """
+    Run montecarlo_search in 'workers' processes, each with its own seed, and return the best result.
+    The graph is sent to every worker process only once. Every worker searches for at most timeout_seconds,
+    counted from when it has started and received the graph: starting the processes doesn't take from the search,
+    it only adds to the wall time.
+    The number of iterations in the result is the sum of iterations done by all the workers,
+    and the stop reason is the one of the worker that found the best matching.
+    """
+    seeds = [random.randrange(2 ** 32) for _ in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(weights, forbidden, penalty_for_grouping_with_forbidden_user)) as executor:
+        results = list(executor.map(_worker_search, seeds, [timeout_seconds] * workers,
+                                    [max_iterations_without_improvement] * workers))
+    best_groups, best_penalty, _, stop_reason = min(
+        results, key=lambda result: result[1])
+    return best_groups, best_penalty, sum(result[2] for result in results), stop_reason
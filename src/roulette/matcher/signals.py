@@ -1,6 +1,8 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver, Signal
-from .models import Roulette, RouletteUser, Vote
+from django.db import transaction
+from .models import PENALTY_CONFIG_FIELDS, Match, PairHistory, Roulette, RouletteUser, create_default_votes, \
+    deferred_pair_history_pairs, invalidate_penalty_config, rebuild_pair_history
 
 # post_matching is sent when a matching completes successfully.
 # 'sender' will be the Roulette class.
@@ -12,10 +14,8 @@ post_matching = Signal(providing_args=["instance", "groups"])
 @receiver(post_save, sender=Roulette)
 def add_default_votes(sender, instance, created, **kwargs):
     # When roulette is saved for the first time, add default (empty) votes
-    roulette = instance
-    if created and len(roulette.vote_set.all()) == 0:
-        for user in RouletteUser.objects.all():
-            Vote.objects.create(roulette=roulette, user=user)
+    if created:
+        create_default_votes([instance.id], RouletteUser.objects.values_list('id', flat=True))
 
 
 @receiver(post_save, sender=RouletteUser)
@@ -23,8 +23,58 @@ def add_user_to_active_roulettes(sender, instance, created, **kwargs):
     # When a user is created, add default votes for active roulettes
     if not created:
         return
-    active_roulettes = Roulette.objects.filter(
-        matchings_found_on=None).filter()
-    for roulette in active_roulettes:
-        if not Vote.objects.filter(roulette=roulette).filter(user=instance).exists():
-            Vote.objects.create(roulette=roulette, user=instance)
+    active_roulette_ids = Roulette.objects.filter(
+        matchings_found_on=None).values_list('id', flat=True)
+    create_default_votes(active_roulette_ids, [instance.id])
+
+
+@receiver(post_save, sender=Match)
+def add_match_to_pair_history(sender, instance, created, **kwargs):
+    # When a single match is created (e.g. in the admin, or by loaddata), add it to the pair history too.
+    # The views create the matches in bulk, which sends no signals, and call record_pair_history themselves.
+    if not created:
+        return
+    user_a_id = min(instance.user_a_id, instance.user_b_id)
+    user_b_id = max(instance.user_a_id, instance.user_b_id)
+    deferred_pairs = deferred_pair_history_pairs()
+    if deferred_pairs is not None:
+        deferred_pairs.add((user_a_id, user_b_id))
+        return
+    rebuild_pair_history([(user_a_id, user_b_id)])
+
+
+@receiver(post_delete, sender=Match)
+def remove_match_from_pair_history(sender, instance, **kwargs):
+    # When a match (or the whole roulette) is deleted, forget it in the pair history too
+    user_a_id = min(instance.user_a_id, instance.user_b_id)
+    user_b_id = max(instance.user_a_id, instance.user_b_id)
+    deferred_pairs = deferred_pair_history_pairs()
+    if deferred_pairs is not None:
+        # Many matches are being deleted at once: their pairs are rebuilt together (see defer_pair_history_updates)
+        deferred_pairs.add((user_a_id, user_b_id))
+        return
+    history = PairHistory.objects.filter(
+        user_a=user_a_id, user_b=user_b_id).first()
+    if history is None:
+        return
+    if history.match_count <= 1:
+        history.delete()
+        return
+    history.match_count -= 1
+    matchings_found_on = Roulette.objects.filter(pk=instance.roulette_id).values_list(
+        'matchings_found_on', flat=True).first()
+    if matchings_found_on is not None and matchings_found_on.isoformat() in history.match_dates:
+        history.match_dates.remove(matchings_found_on.isoformat())
+    history.save()
+
+
+def penalty_changed(sender, **kwargs):
+    # When a penalty is saved or deleted, forget the cached penalties - now, and once more after the commit,
+    # in case another process has cached the old values in the meantime
+    invalidate_penalty_config()
+    transaction.on_commit(invalidate_penalty_config)
+
+
+for penalty_model in PENALTY_CONFIG_FIELDS:
+    post_save.connect(penalty_changed, sender=penalty_model)
+    post_delete.connect(penalty_changed, sender=penalty_model)
@@ -1,11 +1,27 @@
 from datetime import datetime, timedelta
 from django.shortcuts import get_object_or_404
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 from typing import List
+import io
+import itertools
+import json
+import math
+import numpy as np
+import os
+import random
+import tempfile
+import time
 
-from .models import PenaltyInfo, Roulette, Vote, Match, MatchQuality, RouletteUser, ExclusionGroup, PenaltyGroup, PenaltyForPenaltyGroup, PenaltyForNumberOfMatches, PenaltyForRecentMatch, get_last_roulette, matching_graph, MatchColor
-from .algorithms import get_matches_quality
+from .models import CompactMatchingGraph, MatchingCandidate, PenaltyConfig, PenaltyForGroupingWithForbiddenUser, PenaltyInfo, Roulette, Vote, Match, MatchQuality, RouletteUser, ExclusionGroup, PenaltyGroup, PenaltyForPenaltyGroup, PenaltyForNumberOfMatches, PenaltyForRecentMatch, compact_matching_graph, defer_pair_history_updates, get_last_roulette, import_users, invalidate_penalty_config, matching_graph, penalty_config, MatchColor, PairHistory, rebuild_pair_history, update_votes
+from .montecarlo import STOP_LOWER_BOUND, STOP_NO_IMPROVEMENT, STOP_TIMEOUT, montecarlo_search, penalty_lower_bound, \
+    _random_not_processed_neighbor
+from .benchmark import benchmark_current_database, generate_synthetic_org
+from .algorithms import STOP_LEFTOVER_ADDED, STOP_OPTIMAL, Matching, montecarlo_timeout_ms, generate_matches, generate_matches_annealing, generate_matches_blossom, generate_matches_montecarlo, get_matches_quality, improve_matching
 
 
 def create_positive_numbers_users(n_users):
@@ -101,6 +117,57 @@ class VoteModelTests(TestCase):
         self.assertEqual(2, len(all_votes))
 
 
+    def test_adding_roulette_adds_default_votes_in_constant_queries(self):
+        create_positive_numbers_users(50)
+        # All the votes are inserted by a single statement.
+        with CaptureQueriesContext(connection) as queries:
+            Roulette.objects.create(
+                vote_deadline=timezone.now(), coffee_deadline=timezone.now())
+        vote_queries = [query for query in queries if 'matcher_vote' in query['sql']]
+        self.assertEqual(1, len(vote_queries))
+        self.assertEqual(50, Vote.objects.count())
+
+    def test_update_votes(self):
+        users = list(create_positive_numbers_users(4))
+        roulette = Roulette.objects.create(
+            vote_deadline=timezone.now(), coffee_deadline=timezone.now())
+        Vote.objects.filter(user=users[0]).update(choice=Vote.YES)
+        Vote.objects.filter(user=users[3]).delete()
+        with CaptureQueriesContext(connection) as queries:
+            changed_votes = update_votes(roulette.id, {users[0].id: Vote.YES, users[1].id: Vote.NO,
+                                                       users[2].id: Vote.YES})
+        self.assertEqual(2, len(queries))
+        self.assertCountEqual([users[1].id, users[2].id], [vote.user_id for vote in changed_votes])
+        self.assertEqual([Vote.YES, Vote.NO, Vote.YES],
+                         [Vote.objects.get(user=user).choice for user in users[:3]])
+        changed_votes = update_votes(roulette.id, {users[3].id: Vote.NO})
+        self.assertEqual([users[3].id], [vote.user_id for vote in changed_votes])
+        self.assertEqual(Vote.NO, Vote.objects.get(user=users[3]).choice)
+
+    def test_import_users(self):
+        create_positive_numbers_users(2)
+        active_roulette = Roulette.objects.create(
+            vote_deadline=timezone.now(), coffee_deadline=timezone.now())
+        finished_roulette = Roulette.objects.create(
+            vote_deadline=timezone.now(), coffee_deadline=timezone.now(), matchings_found_on=timezone.now())
+        created_count = import_users([("Alice", "alice@example.com"), ("Bob", "bob@example.com"),
+                                      ("Existing", "1@example.com"), ("Alice again", "alice@example.com")])
+        self.assertEqual(2, created_count)
+        self.assertEqual(["1", "2", "Alice", "Bob"], sorted(RouletteUser.objects.values_list('name', flat=True)))
+        self.assertEqual(4, active_roulette.vote_set.count())
+        self.assertEqual(2, finished_roulette.vote_set.count())
+
+    def test_import_users_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write("name,email\nAlice,alice@example.com\nBob , bob@example.com\n")
+        try:
+            call_command('import_users', csv_file.name, stdout=io.StringIO())
+        finally:
+            os.remove(csv_file.name)
+        self.assertEqual([("Alice", "alice@example.com"), ("Bob", "bob@example.com")],
+                         list(RouletteUser.objects.order_by('name').values_list('name', 'email')))
+
+
 class RouletteModelTests(TestCase):
 
     def test_last_roulette_out_of_two(self):
@@ -117,6 +184,140 @@ class RouletteModelTests(TestCase):
         self.assertIsNone(get_last_roulette())
 
 
+class RouletteListViewTests(TestCase):
+
+    def setUp(self):
+        create_positive_numbers_users(4)
+        self.roulettes = [Roulette.objects.create(vote_deadline=timezone.now() - timedelta(days=7 * (k + 1)),
+                                                  coffee_deadline=timezone.now() - timedelta(days=7 * k + 1))
+                          for k in range(3)]
+        votes = Vote.objects.filter(roulette=self.roulettes[0]).order_by('user_id')
+        Vote.objects.filter(id__in=[vote.id for vote in votes[:2]]).update(choice=Vote.YES)
+        Vote.objects.filter(id=votes[2].id).update(choice=Vote.NO)
+
+    def test_vote_counts_are_fetched_in_one_query(self):
+        with self.assertNumQueries(2):  # the count of roulettes for pagination, and the roulettes with their votes
+            response = self.client.get(reverse('matcher:list_archive'))
+        roulettes = list(response.context['roulettes'])
+        self.assertEqual([r.id for r in reversed(self.roulettes)], [r.id for r in roulettes])
+        first_roulette = roulettes[-1]
+        self.assertEqual((2, 1, 1, 4), (first_roulette.votes_yes, first_roulette.votes_no,
+                                        first_roulette.votes_unknown, first_roulette.total_users))
+        self.assertEqual((0, 0, 4, 4), (roulettes[0].votes_yes, roulettes[0].votes_no,
+                                        roulettes[0].votes_unknown, roulettes[0].total_users))
+
+    @override_settings(MATCHER_ROULETTES_PER_PAGE=2)
+    def test_roulette_list_is_paginated(self):
+        response = self.client.get(reverse('matcher:list_all'))
+        self.assertEqual([self.roulettes[2].id, self.roulettes[1].id],
+                         [r.id for r in response.context['roulettes']])
+        self.assertContains(response, '?page=2')
+        response = self.client.get(reverse('matcher:list_all'), {'page': 2})
+        self.assertEqual([self.roulettes[0].id], [r.id for r in response.context['roulettes']])
+
+
+class RunAndSubmitRouletteViewTests(TestCase):
+
+    def setUp(self):
+        self.users = list(create_positive_numbers_users(14))
+
+    def create_roulette(self, participants):
+        roulette = Roulette.objects.create(vote_deadline=timezone.now() - timedelta(days=1),
+                                           coffee_deadline=timezone.now() + timedelta(days=7))
+        roulette.vote_set.filter(user__in=participants).update(choice=Vote.YES)
+        return roulette
+
+    def submit(self, roulette, groups):
+        candidate = MatchingCandidate.objects.create(roulette=roulette, total_penalty=0.0,
+                                                     groups=[[user.id for user in group] for group in groups],
+                                                     quality=[])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('matcher:submit', args=(roulette.id,)),
+                                        {'candidate': candidate.id})
+        return response, len(queries)
+
+    def test_run_stores_candidate(self):
+        roulette = self.create_roulette(self.users[:5])
+        response = self.client.post(reverse('matcher:run', args=(roulette.id,)))
+        candidate = MatchingCandidate.objects.get(roulette=roulette)
+        self.assertRedirects(response, reverse('matcher:candidate', args=(roulette.id, candidate.id)))
+        self.assertCountEqual([user.id for user in self.users[:5]],
+                              [user_id for group in candidate.groups for user_id in group])
+        self.assertEqual(len(candidate.groups), len(candidate.quality))
+        self.client.post(reverse('matcher:run', args=(roulette.id,)))
+        response = self.client.get(reverse('matcher:candidate', args=(roulette.id, candidate.id)))
+        self.assertEqual(candidate, response.context['candidate'])
+        self.assertEqual(2, len(response.context['best_candidates']))
+        self.assertCountEqual(self.users[:5], [user for group in response.context['groups'] for user in group['users']])
+
+    def test_run_requires_post(self):
+        roulette = self.create_roulette(self.users[:5])
+        self.assertEqual(405, self.client.get(reverse('matcher:run', args=(roulette.id,))).status_code)
+        self.assertFalse(MatchingCandidate.objects.exists())
+
+    @override_settings(MATCHER_CANDIDATES_SHOWN=2)
+    def test_run_keeps_only_best_candidates(self):
+        roulette = self.create_roulette(self.users[:5])
+        best_candidates = [MatchingCandidate.objects.create(roulette=roulette, total_penalty=penalty, groups=[],
+                                                            quality=[]) for penalty in (-2.0, -1.0, 5.0)]
+        self.client.post(reverse('matcher:run', args=(roulette.id,)))
+        last_candidate = MatchingCandidate.objects.latest('id')
+        self.assertCountEqual([best_candidates[0], best_candidates[1], last_candidate],
+                              MatchingCandidate.objects.filter(roulette=roulette))
+
+    def test_submit_deletes_candidates(self):
+        roulette = self.create_roulette(self.users[:4])
+        other_candidate = MatchingCandidate.objects.create(roulette=roulette, total_penalty=1.0,
+                                                           groups=[[user.id for user in self.users[:4]]], quality=[])
+        self.submit(roulette, [self.users[0:2], self.users[2:4]])
+        self.assertFalse(MatchingCandidate.objects.filter(pk=other_candidate.pk).exists())
+
+    def test_submit_rejects_candidate_of_other_roulette(self):
+        roulette = self.create_roulette(self.users[:4])
+        other_roulette = self.create_roulette(self.users[:4])
+        candidate = MatchingCandidate.objects.create(roulette=other_roulette, total_penalty=0.0,
+                                                     groups=[[user.id for user in self.users[:4]]], quality=[])
+        response = self.client.post(reverse('matcher:submit', args=(roulette.id,)), {'candidate': candidate.id})
+        self.assertEqual(404, response.status_code)
+        self.assertEqual(0, Match.objects.count())
+
+    def test_submit_rejects_invalid_candidate_id(self):
+        roulette = self.create_roulette(self.users[:4])
+        for data in ({'candidate': 'abc'}, {'candidate': ''}, {}):
+            response = self.client.post(reverse('matcher:submit', args=(roulette.id,)), data)
+            self.assertEqual(404, response.status_code)
+        roulette.refresh_from_db()
+        self.assertIsNone(roulette.matchings_found_on)
+
+    def test_submit_saves_matches_and_pair_history(self):
+        roulette = self.create_roulette(self.users[:5])
+        response, _ = self.submit(roulette, [self.users[0:2], self.users[2:5]])
+        self.assertRedirects(response, reverse('matcher:roulette', args=(roulette.id,)))
+        roulette.refresh_from_db()
+        self.assertIsNotNone(roulette.matchings_found_on)
+        u = [user.id for user in self.users]
+        self.assertCountEqual([(u[0], u[1]), (u[2], u[3]), (u[2], u[4]), (u[3], u[4])],
+                              roulette.match_set.values_list('user_a_id', 'user_b_id'))
+        self.assertEqual(4, PairHistory.objects.count())
+
+    def test_query_count_does_not_grow_with_users(self):
+        small_roulette = self.create_roulette(self.users[:4])
+        _, small_query_count = self.submit(small_roulette, [self.users[0:2], self.users[2:4]])
+        big_roulette = self.create_roulette(self.users[4:])
+        _, big_query_count = self.submit(big_roulette, [self.users[k:k + 2] for k in range(4, 12, 2)] +
+                                         [self.users[12:14]])
+        self.assertEqual(small_query_count, big_query_count)
+        self.assertEqual(2 + 5, Match.objects.count())
+
+    def test_submit_rejects_users_not_participating(self):
+        roulette = self.create_roulette(self.users[:3])
+        response, _ = self.submit(roulette, [self.users[0:2], self.users[2:4]])
+        self.assertEqual(404, response.status_code)
+        roulette.refresh_from_db()
+        self.assertIsNone(roulette.matchings_found_on)
+        self.assertEqual(0, Match.objects.count())
+
+
 class MatchingGraphGenerationTests(TestCase):
 
     def test_full_graph_for_no_exclusions(self):
@@ -252,9 +453,205 @@ class MatchingGraphGenerationTests(TestCase):
         self.assertAlmostEqual(penalty_info.number_matches_penalty, 0.0)
         self.assertListEqual(penalty_info.recent_matches, [])
 
+    def test_number_of_queries_does_not_depend_on_user_count(self):
+        users = list(create_positive_numbers_users(40))
+        create_groups_modulo_k(40, 3, ExclusionGroup)
+        create_groups_modulo_k(40, 4, PenaltyGroup)
+        first_roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now() - timedelta(days=1))
+        for i in range(1, 40, 2):
+            create_match(first_roulette, i, i + 1)
+        for user_count in [2, 10, 40]:
+            with self.assertNumQueries(6):
+                matching_graph(users[:user_count])
+
     # TODO test with a roulette with matches, but no matching time
 
 
+class PenaltyConfigTests(TransactionTestCase):
+    # A TransactionTestCase, because the penalties read inside a transaction are never cached.
+
+    def setUp(self):
+        invalidate_penalty_config()
+
+    def tearDown(self):
+        invalidate_penalty_config()
+
+    def test_defaults_are_loaded_in_one_query(self):
+        with self.assertNumQueries(1):
+            config = penalty_config()
+        self.assertEqual(PenaltyConfig(recent_match=1.0, number_of_matches=0.5, penalty_group=2.0,
+                                       grouping_with_forbidden_user=10.0), config)
+        self.assertEqual(0, PenaltyForRecentMatch.objects.count())
+
+    def test_penalties_are_cached_until_saved(self):
+        PenaltyForPenaltyGroup.objects.create(penalty=3.0)
+        PenaltyForGroupingWithForbiddenUser.objects.create(penalty=20.0)
+        self.assertEqual(3.0, penalty_config().penalty_group)
+        with self.assertNumQueries(0):
+            self.assertEqual(20.0, penalty_config().grouping_with_forbidden_user)
+        penalty = PenaltyForPenaltyGroup.objects.get()
+        penalty.penalty = 4.0
+        penalty.save()
+        self.assertEqual(4.0, penalty_config().penalty_group)
+        PenaltyForPenaltyGroup.objects.all().delete()
+        self.assertEqual(2.0, penalty_config().penalty_group)
+
+
+class PairHistoryTests(TestCase):
+
+    def setUp(self):
+        create_positive_numbers_users(4)
+        self.first_roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now() - timedelta(days=14))
+        create_match(self.first_roulette, 1, 2)
+        create_match(self.first_roulette, 4, 3)
+        self.second_roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now() - timedelta(days=7))
+        create_match(self.second_roulette, 2, 1)
+
+    def get_histories(self):
+        return list(PairHistory.objects.order_by('user_a', 'user_b').values_list(
+            'user_a', 'user_b', 'match_count', 'match_dates'))
+
+    def test_history_is_recorded_with_ordered_users(self):
+        self.assertListEqual(self.get_histories(), [
+            (1, 2, 2, [self.first_roulette.matchings_found_on.isoformat(
+            ), self.second_roulette.matchings_found_on.isoformat()]),
+            (3, 4, 1, [self.first_roulette.matchings_found_on.isoformat()]),
+        ])
+
+    def test_rebuilt_history_is_the_same_as_recorded(self):
+        recorded = self.get_histories()
+        rebuild_pair_history()
+        self.assertListEqual(recorded, self.get_histories())
+
+    @override_settings(MATCHER_PAIR_HISTORY_DATES=1)
+    def test_only_last_dates_are_kept(self):
+        rebuild_pair_history()
+        history = PairHistory.objects.get(user_a=1, user_b=2)
+        self.assertEqual(2, history.match_count)
+        self.assertListEqual(
+            [self.second_roulette.matchings_found_on.isoformat()], history.match_dates)
+
+    @override_settings(MATCHER_PAIR_HISTORY_DATES=2)
+    def test_backfilled_match_keeps_last_dates(self):
+        old_roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now() - timedelta(days=21))
+        create_match(old_roulette, 2, 1)
+        expected_history = (1, 2, 3, [self.first_roulette.matchings_found_on.isoformat(
+        ), self.second_roulette.matchings_found_on.isoformat()])
+        self.assertEqual(expected_history, self.get_histories()[0])
+        rebuild_pair_history()
+        self.assertEqual(expected_history, self.get_histories()[0])
+
+    def test_matches_created_in_deferred_block_update_history(self):
+        third_roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now())
+        with defer_pair_history_updates():
+            create_match(third_roulette, 3, 4)
+            create_match(third_roulette, 1, 3)
+            self.assertEqual(2, len(self.get_histories()))
+        self.assertListEqual(self.get_histories(), [
+            (1, 2, 2, [self.first_roulette.matchings_found_on.isoformat(
+            ), self.second_roulette.matchings_found_on.isoformat()]),
+            (1, 3, 1, [third_roulette.matchings_found_on.isoformat()]),
+            (3, 4, 2, [self.first_roulette.matchings_found_on.isoformat(
+            ), third_roulette.matchings_found_on.isoformat()]),
+        ])
+
+    def test_deleting_roulette_updates_history(self):
+        self.first_roulette.delete()
+        self.assertListEqual(self.get_histories(), [
+            (1, 2, 1, [self.second_roulette.matchings_found_on.isoformat()]),
+        ])
+
+    def test_deleting_matches_queryset_updates_history(self):
+        Match.objects.filter(roulette=self.second_roulette).delete()
+        Roulette.objects.filter(pk=self.first_roulette.pk).delete()
+        self.assertListEqual(self.get_histories(), [])
+
+    def test_deleting_roulette_updates_history_in_constant_queries(self):
+        for i in range(5, 21):
+            RouletteUser.objects.create(name=str(i), email=str(i)+"@example.com")
+        roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now())
+        for i in range(1, 21, 2):
+            create_match(roulette, i, i + 1)
+        # The histories of all the pairs are selected, deleted and inserted again at once, not per match.
+        with CaptureQueriesContext(connection) as queries:
+            roulette.delete()
+        history_queries = [query for query in queries if 'matcher_pairhistory' in query['sql']]
+        self.assertEqual(3, len(history_queries))
+        self.assertListEqual(self.get_histories(), [
+            (1, 2, 2, [self.first_roulette.matchings_found_on.isoformat(
+            ), self.second_roulette.matchings_found_on.isoformat()]),
+            (3, 4, 1, [self.first_roulette.matchings_found_on.isoformat()]),
+        ])
+
+
+class CompactMatchingGraphTests(TestCase):
+
+    def setUp(self):
+        self.users = list(create_positive_numbers_users(8))
+        create_groups_modulo_k(8, 3, ExclusionGroup)
+        create_groups_modulo_k(8, 2, PenaltyGroup)
+        first_roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now() - timedelta(days=30))
+        create_match(first_roulette, 1, 2)
+        create_match(first_roulette, 3, 4)
+        second_roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now())
+        create_match(second_roulette, 5, 6)
+
+    def assertGraphsEqual(self, expected_graph, actual_graph):
+        def as_comparable(graph):
+            return [(user.id, [(user2.id, weight, penalty_info) for user2, weight, penalty_info in edges]) for user, edges in graph]
+        self.assertEqual(as_comparable(expected_graph),
+                         as_comparable(actual_graph))
+
+    def test_conversion_round_trip(self):
+        graph = matching_graph(self.users)
+        compact_graph = CompactMatchingGraph.from_matching_graph(graph)
+        self.assertEqual(len(self.users), len(compact_graph))
+        self.assertGraphsEqual(graph, compact_graph.to_matching_graph())
+
+    def test_compact_builder_gives_the_same_graph(self):
+        graph = matching_graph(self.users)
+        compact_graph = compact_matching_graph(self.users)
+        self.assertGraphsEqual(graph, compact_graph.to_matching_graph())
+
+    def test_missing_edges_are_forbidden(self):
+        compact_graph = compact_matching_graph(self.users)
+        user_1 = compact_graph.index_of(1)
+        user_4 = compact_graph.index_of(4)
+        user_5 = compact_graph.index_of(5)
+        user_6 = compact_graph.index_of(6)
+        # Same exclusion group
+        self.assertFalse(compact_graph.has_edge(user_1, user_4))
+        self.assertIsNone(compact_graph.penalty_info(user_1, user_4))
+        # Matched in the last roulette
+        self.assertFalse(compact_graph.has_edge(user_5, user_6))
+        self.assertFalse(compact_graph.has_edge(user_1, user_1))
+        costs = compact_graph.cost_matrix(100.0)
+        self.assertEqual(100.0, costs[user_1, user_4])
+
+    def test_matches_quality_is_the_same_for_both_representations(self):
+        graph = matching_graph(self.users)
+        matches = [tuple(self.users[:3]), tuple(self.users[3:5]), tuple(self.users[5:])]
+        expected = get_matches_quality(graph, matches, 100.0, 33.3, 66.6)
+        actual = get_matches_quality(
+            compact_matching_graph(self.users), matches, 100.0, 33.3, 66.6)
+        self.assertEqual(expected, actual)
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=10)
+    def test_montecarlo_accepts_compact_graph(self):
+        matching = generate_matches_montecarlo(
+            compact_matching_graph(self.users), 100.0)
+        matched_users = [user for group in matching.matches for user in group]
+        self.assertCountEqual(self.users, matched_users)
+
+
 class MatchQualityAnalysisTests(TestCase):
     GREEN_PERCENTILE = 33.3
     YELLOW_PERCENTILE = 66.6
@@ -360,9 +757,337 @@ class MatchQualityAnalysisTests(TestCase):
         self.assertEqual(6, len(match_quality.users_b))
         self.assertCountEqual(match_quality.users_in_match_group(), users)
 
+    def test_colors_match_sorted_weights_thresholds(self):
+        users = list(create_positive_numbers_users(12))
+        rng = np.random.default_rng(0)
+        # Mostly zero weights, some negative ones, and some missing edges.
+        weights = rng.choice([0.0, 0.0, 0.0, -0.5, 0.5, 1.0, 2.5], size=(12, 12))
+        weights = np.triu(weights, 1) + np.triu(weights, 1).T
+        forbidden = np.triu(rng.random((12, 12)) < 0.2, 1)
+        forbidden = forbidden | forbidden.T
+        np.fill_diagonal(forbidden, True)
+        weights[forbidden] = 0.0
+        graph = CompactMatchingGraph(users, weights, forbidden)
+        sorted_weights = np.sort(weights[~forbidden])
+        for green_percentile, yellow_percentile in ((33.3, 66.6), (0.0, 100.0), (10.0, 95.0), (60.0, 80.0)):
+            green_threshold = sorted_weights[max(0, math.ceil(len(sorted_weights) * green_percentile / 100.0) - 1)] \
+                if green_percentile > 0 else -math.inf
+            yellow_threshold = sorted_weights[math.ceil(len(sorted_weights) * yellow_percentile / 100.0) - 1]
+            pairs = [(i, j) for i in range(12) for j in range(i + 1, 12) if not forbidden[i, j]]
+            match_qualities = get_matches_quality(graph, [(users[i], users[j]) for i, j in pairs], 100.0,
+                                                  green_percentile, yellow_percentile)
+            for (i, j), match_quality in zip(pairs, match_qualities):
+                if weights[i, j] <= green_threshold:
+                    expected_color = MatchColor.GREEN
+                elif weights[i, j] <= yellow_threshold:
+                    expected_color = MatchColor.YELLOW
+                else:
+                    expected_color = MatchColor.RED
+                self.assertEqual(expected_color, match_quality.color)
+
 
 class MatchingAlgorithmsTest(TestCase):
-    pass
+
+    def assertMatchingIsValid(self, users, matching, graph, penalty_for_grouping_with_forbidden_user):
+        matched_users = [user for group in matching.matches for user in group]
+        self.assertCountEqual(users, matched_users)
+        for group in matching.matches:
+            self.assertIn(len(group), [2, 3])
+        match_qualities = get_matches_quality(
+            graph, matching.matches, penalty_for_grouping_with_forbidden_user)
+        self.assertAlmostEqual(matching.total_penalty, sum(
+            quality.total_penalty() for quality in match_qualities))
+
+
+def min_pairs_penalty(costs, vertices):
+    """ Brute force: the lowest total penalty of splitting an even number of vertices into pairs. """
+    if len(vertices) == 0:
+        return 0.0
+    first, rest = vertices[0], vertices[1:]
+    return min(costs[first, second] + min_pairs_penalty(costs, rest[:k] + rest[k+1:]) for k, second in enumerate(rest))
+
+
+class MonteCarloMatchingTests(MatchingAlgorithmsTest):
+
+    def setUp(self):
+        self.users = list(create_positive_numbers_users(9))
+        create_groups_modulo_k(9, 3, ExclusionGroup)
+        create_groups_modulo_k(9, 2, PenaltyGroup)
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=20, MATCHER_MONTECARLO_WORKERS=1)
+    def test_montecarlo_generates_valid_matching(self):
+        graph = compact_matching_graph(self.users)
+        matching = generate_matches_montecarlo(graph, 10.0)
+        self.assertMatchingIsValid(self.users, matching, graph, 10.0)
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=200, MATCHER_MONTECARLO_WORKERS=2)
+    def test_parallel_montecarlo_generates_valid_matching(self):
+        graph = compact_matching_graph(self.users)
+        matching = generate_matches_montecarlo(graph, 10.0)
+        self.assertMatchingIsValid(self.users, matching, graph, 10.0)
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=10000, MATCHER_MONTECARLO_TIMEOUT_MS_PER_USER=10000)
+    def test_montecarlo_stops_when_lower_bound_is_reached(self):
+        users = self.users[:4]
+        graph = compact_matching_graph(users)
+        started = time.monotonic()
+        matching = generate_matches_montecarlo(graph, 10.0)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(STOP_LOWER_BOUND, matching.stop_reason)
+        self.assertAlmostEqual(0.0, matching.total_penalty)
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=10000, MATCHER_MONTECARLO_TIMEOUT_MS_PER_USER=10000,
+                       MATCHER_MONTECARLO_MAX_ITERATIONS_WITHOUT_IMPROVEMENT=50)
+    def test_montecarlo_stops_without_improvement(self):
+        # Users 1, 4 and 7 are in the same exclusion group, so the lower bound can't be reached.
+        users = [self.users[0], self.users[3], self.users[6]]
+        graph = compact_matching_graph(users)
+        matching = generate_matches_montecarlo(graph, 10.0)
+        self.assertEqual(STOP_NO_IMPROVEMENT, matching.stop_reason)
+        self.assertEqual(51, matching.iterations)
+        self.assertAlmostEqual(30.0, matching.total_penalty)
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=20, MATCHER_MONTECARLO_MAX_ITERATIONS_WITHOUT_IMPROVEMENT=None)
+    def test_montecarlo_stops_on_timeout(self):
+        users = [self.users[0], self.users[3], self.users[6]]
+        matching = generate_matches_montecarlo(
+            compact_matching_graph(users), 10.0)
+        self.assertEqual(STOP_TIMEOUT, matching.stop_reason)
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=1000, MATCHER_MONTECARLO_TIMEOUT_MS_PER_USER=20)
+    def test_montecarlo_timeout_grows_with_users(self):
+        self.assertEqual(80, montecarlo_timeout_ms(4))
+        self.assertEqual(1000, montecarlo_timeout_ms(500))
+
+    def test_penalty_lower_bound(self):
+        costs = np.array([[0.0, 1.0, 4.0], [1.0, 0.0, 2.0], [4.0, 2.0, 0.0]])
+        self.assertAlmostEqual((1.0 + 1.0 + 2.0) / 2.0,
+                               penalty_lower_bound(costs))
+
+    def test_random_not_processed_neighbor(self):
+        rng = random.Random(0)
+        iteration = 1
+        # Users 0..9 are alive, users 1, 2 and 7 are processed, and the neighbors are 1, 2, 3 and 5.
+        processed_in = [0] * 10
+        for user in (1, 2, 7):
+            processed_in[user] = iteration
+        alive = [0, 3, 4, 5, 6, 8, 9, 1, 2, 7]
+        allowed_row = bytes(1 if user in (1, 2, 3, 5) else 0 for user in range(10))
+        for alive_count in (7, 3):
+            # With 7 alive users, the neighbors are drawn, with 3 (users 0, 3 and 4) - the alive users.
+            expected = {3, 5} if alive_count == 7 else {3}
+            drawn = {_random_not_processed_neighbor([1, 2, 3, 5], allowed_row, alive, alive_count,
+                                                    processed_in, iteration, rng.random)
+                     for _ in range(100)}
+            self.assertEqual(expected, drawn)
+        self.assertEqual(-1, _random_not_processed_neighbor([1, 2], allowed_row, alive, 7,
+                                                             processed_in, iteration, rng.random))
+        self.assertEqual(-1, _random_not_processed_neighbor([1, 2, 3, 5], allowed_row, alive, 1,
+                                                             processed_in, iteration, rng.random))
+
+
+@override_settings(MATCHER_ANNEALING_TIMEOUT_MS=1000, MATCHER_ANNEALING_ITERATIONS=20000)
+class AnnealingMatchingTests(MatchingAlgorithmsTest):
+
+    def setUp(self):
+        random.seed(0)
+
+    def create_users(self, user_count):
+        users = list(create_positive_numbers_users(user_count))
+        create_groups_modulo_k(user_count, 4, ExclusionGroup)
+        create_groups_modulo_k(user_count, 3, PenaltyGroup)
+        return users
+
+    def test_annealing_finds_optimal_matching(self):
+        users = self.create_users(10)
+        graph = compact_matching_graph(users)
+        matching = generate_matches_annealing(graph, 10.0)
+        self.assertMatchingIsValid(users, matching, graph, 10.0)
+        self.assertAlmostEqual(generate_matches_blossom(
+            graph, 10.0).total_penalty, matching.total_penalty)
+
+    def test_annealing_with_odd_number_of_users(self):
+        for user_count in [3, 9]:
+            RouletteUser.objects.all().delete()
+            users = self.create_users(user_count)
+            graph = compact_matching_graph(users)
+            matching = generate_matches_annealing(graph, 10.0)
+            self.assertMatchingIsValid(users, matching, graph, 10.0)
+
+    def test_annealing_stops_at_lower_bound(self):
+        # Without any penalties, every matching is optimal.
+        users = list(create_positive_numbers_users(10))
+        matching = generate_matches_annealing(compact_matching_graph(users), 10.0)
+        self.assertEqual((STOP_LOWER_BOUND, 0), (matching.stop_reason, matching.iterations))
+
+    @override_settings(MATCHER_ANNEALING_ITERATIONS=None, MATCHER_ANNEALING_MAX_ITERATIONS_WITHOUT_IMPROVEMENT=1000)
+    def test_annealing_stops_without_improvement(self):
+        users = list(create_positive_numbers_users(9))
+        # Everybody is excluded from everybody: no matching is better than another, and the lower bound isn't reached.
+        create_groups_modulo_k(9, 1, ExclusionGroup)
+        started = time.monotonic()
+        matching = generate_matches_annealing(compact_matching_graph(users), 10.0)
+        self.assertEqual(STOP_NO_IMPROVEMENT, matching.stop_reason)
+        self.assertLess(matching.iterations, 1000 + 256)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_annealing_with_not_enough_users(self):
+        users = list(create_positive_numbers_users(1))
+        self.assertEqual(Matching(), generate_matches_annealing(
+            matching_graph(users), 10.0))
+
+    @override_settings(MATCHER_ENGINE='annealing')
+    def test_engine_is_chosen_by_settings(self):
+        users = self.create_users(6)
+        graph = compact_matching_graph(users)
+        matching = generate_matches(graph, 10.0)
+        self.assertMatchingIsValid(users, matching, graph, 10.0)
+
+
+class LocalSearchTests(MatchingAlgorithmsTest):
+
+    def test_swapping_users_removes_penalties(self):
+        users = list(create_positive_numbers_users(4))
+        penalty_group = PenaltyGroup.objects.create()
+        penalty_group.users.add(users[0], users[1])
+        penalty_group = PenaltyGroup.objects.create()
+        penalty_group.users.add(users[2], users[3])
+        graph = compact_matching_graph(users)
+        matching = Matching(
+            matches=[(users[0], users[1]), (users[2], users[3])], total_penalty=4.0)
+        improved_matching = improve_matching(graph, matching, 10.0, 1000)
+        self.assertMatchingIsValid(users, improved_matching, graph, 10.0)
+        self.assertAlmostEqual(0.0, improved_matching.total_penalty)
+
+    def test_moving_leftover_user_removes_penalties(self):
+        users = list(create_positive_numbers_users(5))
+        # User 1 has penalties with users 3, 4 and 5. No swap between groups (1, 2, 3) and (4, 5) helps,
+        # but moving user 3 to the other group does.
+        for other_user in users[2:]:
+            penalty_group = PenaltyGroup.objects.create()
+            penalty_group.users.add(users[0], other_user)
+        graph = compact_matching_graph(users)
+        matching = Matching(
+            matches=[(users[0], users[1], users[2]), (users[3], users[4])], total_penalty=2.0)
+        improved_matching = improve_matching(graph, matching, 10.0, 1000)
+        self.assertMatchingIsValid(users, improved_matching, graph, 10.0)
+        self.assertAlmostEqual(0.0, improved_matching.total_penalty)
+
+    def test_improvement_is_not_worse_than_blossom_for_even_users(self):
+        users = list(create_positive_numbers_users(10))
+        create_groups_modulo_k(10, 3, PenaltyGroup)
+        create_groups_modulo_k(10, 4, ExclusionGroup)
+        graph = compact_matching_graph(users)
+        matching = Matching(matches=[tuple(users[i:i+2]) for i in range(0, 10, 2)])
+        improved_matching = improve_matching(graph, matching, 10.0, 1000)
+        self.assertMatchingIsValid(users, improved_matching, graph, 10.0)
+        self.assertLessEqual(generate_matches_blossom(
+            graph, 10.0).total_penalty, improved_matching.total_penalty + 1e-9)
+
+    def test_no_matches(self):
+        graph = compact_matching_graph([])
+        self.assertEqual(Matching(), improve_matching(graph, Matching(), 10.0))
+
+
+class LocalSearchFixtureTest(MatchingAlgorithmsTest):
+    fixtures = ['35_users_one_year.json']
+    today = datetime(2021, 2, 1, 12)
+
+    def test_local_search_beats_montecarlo_alone_in_the_same_time(self):
+        rebuild_pair_history()
+        users = list(RouletteUser.objects.all())
+        graph = compact_matching_graph(users, timezone.make_aware(self.today))
+        budget_seconds = 0.3
+
+        def montecarlo(timeout_seconds):
+            # With this seed, the Monte Carlo search needs about 175 000 matchings to find a matching without penalty.
+            groups, total_penalty, _, _ = montecarlo_search(
+                graph.weights, graph.forbidden, 10.0, timeout_seconds, seed=6)
+            return Matching(matches=[tuple(graph.users[i] for i in group) for group in groups],
+                            total_penalty=total_penalty)
+
+        montecarlo_matching = montecarlo(budget_seconds)
+        started = time.monotonic()
+        improved_matching = improve_matching(graph, montecarlo(budget_seconds * 0.9), 10.0, budget_seconds * 100)
+        self.assertLessEqual(time.monotonic() - started, budget_seconds * 1.5)
+        self.assertMatchingIsValid(users, improved_matching, graph, 10.0)
+        self.assertGreater(montecarlo_matching.total_penalty, 1.0)
+        self.assertAlmostEqual(0.0, improved_matching.total_penalty)
+
+
+class BlossomMatchingTests(MatchingAlgorithmsTest):
+
+    def create_penalties(self, user_count):
+        users = list(create_positive_numbers_users(user_count))
+        create_groups_modulo_k(user_count, 4, ExclusionGroup)
+        create_groups_modulo_k(user_count, 3, PenaltyGroup)
+        roulette = Roulette.objects.create(vote_deadline=timezone.now(
+        ), coffee_deadline=timezone.now(), matchings_found_on=timezone.now() - timedelta(days=20))
+        for i in range(1, user_count, 3):
+            create_match(roulette, i, i + 1)
+        return users
+
+    def test_blossom_finds_optimal_matching(self):
+        users = self.create_penalties(8)
+        graph = compact_matching_graph(users)
+        matching = generate_matches_blossom(graph, 10.0)
+        self.assertMatchingIsValid(users, matching, graph, 10.0)
+        self.assertAlmostEqual(min_pairs_penalty(
+            graph.cost_matrix(10.0), list(range(8))), matching.total_penalty)
+
+    def test_blossom_with_odd_number_of_users(self):
+        users = self.create_penalties(7)
+        graph = matching_graph(users)
+        matching = generate_matches_blossom(graph, 10.0)
+        self.assertMatchingIsValid(users, matching, graph, 10.0)
+        self.assertEqual(1, len([group for group in matching.matches if len(group) == 3]))
+
+    def test_blossom_with_odd_number_of_users_is_optimal_when_it_says_so(self):
+        users = list(create_positive_numbers_users(7))
+        rng = np.random.default_rng(0)
+        optimal_count = 0
+        for _ in range(20):
+            weights = rng.integers(0, 6, size=(7, 7)).astype(np.float64)
+            weights = np.triu(weights, 1) + np.triu(weights, 1).T
+            forbidden = np.eye(7, dtype=bool)
+            graph = CompactMatchingGraph(users, weights, forbidden)
+            costs = graph.cost_matrix(10.0)
+            best_penalty = min(costs[a, b] + costs[a, c] + costs[b, c] +
+                               min_pairs_penalty(costs, [k for k in range(7) if k not in (a, b, c)])
+                               for a, b, c in itertools.combinations(range(7), 3))
+            matching = generate_matches_blossom(graph, 10.0)
+            # The weights have no PenaltyInfos, so the penalty is checked with the costs instead of the match quality.
+            self.assertCountEqual(users, [user for group in matching.matches for user in group])
+            groups = [[graph.index_of(user.id) for user in group] for group in matching.matches]
+            self.assertAlmostEqual(sum(costs[a, b] for group in groups for a, b in itertools.combinations(group, 2)),
+                                   matching.total_penalty)
+            self.assertGreaterEqual(matching.total_penalty, best_penalty - 1e-9)
+            if matching.stop_reason == STOP_OPTIMAL:
+                optimal_count += 1
+                self.assertAlmostEqual(best_penalty, matching.total_penalty)
+            else:
+                self.assertEqual(STOP_LEFTOVER_ADDED, matching.stop_reason)
+        self.assertGreater(optimal_count, 0)
+
+    def test_blossom_with_forbidden_edges_only(self):
+        users = list(create_positive_numbers_users(3))
+        create_groups_modulo_k(3, 1, ExclusionGroup)
+        graph = compact_matching_graph(users)
+        matching = generate_matches_blossom(graph, 10.0)
+        self.assertMatchingIsValid(users, matching, graph, 10.0)
+        self.assertAlmostEqual(30.0, matching.total_penalty)
+
+    def test_blossom_with_not_enough_users(self):
+        users = list(create_positive_numbers_users(1))
+        matching = generate_matches_blossom(matching_graph(users), 10.0)
+        self.assertListEqual([], matching.matches)
+
+    @override_settings(MATCHER_ENGINE='blossom')
+    def test_engine_is_chosen_by_settings(self):
+        users = self.create_penalties(8)
+        graph = compact_matching_graph(users)
+        self.assertEqual(generate_matches_blossom(graph, 10.0),
+                         generate_matches(graph, 10.0))
 
 
 class HarryPotterMatchingTest(MatchingAlgorithmsTest):
@@ -376,3 +1101,44 @@ class HarryPotterMatchingTest(MatchingAlgorithmsTest):
     def test_reads_all_users_in_fixture(self):
         user_count = RouletteUser.objects.count()
         self.assertEquals(14, user_count)
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=100)
+    def test_blossom_is_not_worse_than_montecarlo(self):
+        rebuild_pair_history()
+        users = list(RouletteUser.objects.all())
+        graph = compact_matching_graph(
+            users, timezone.make_aware(self.today))
+        blossom_matching = generate_matches_blossom(graph, 10.0)
+        montecarlo_matching = generate_matches_montecarlo(graph, 10.0)
+        self.assertMatchingIsValid(users, blossom_matching, graph, 10.0)
+        self.assertLessEqual(blossom_matching.total_penalty,
+                             montecarlo_matching.total_penalty + 1e-9)
+
+
+class MatcherBenchmarkTests(TestCase):
+    def test_synthetic_org(self):
+        generate_synthetic_org(30, years=0.2, seed=1)
+        self.assertEqual(30, RouletteUser.objects.count())
+        self.assertEqual(4, ExclusionGroup.objects.count())
+        self.assertEqual(1, PenaltyGroup.objects.count())
+        self.assertEqual(10, Roulette.objects.count())
+        # 18 participants in every roulette: 9 pairs
+        self.assertEqual(90, Match.objects.count())
+        self.assertEqual(90, sum(PairHistory.objects.values_list('match_count', flat=True)))
+
+    @override_settings(MATCHER_MONTECARLO_TIMEOUT_MS=50, MATCHER_ANNEALING_TIMEOUT_MS=50)
+    def test_benchmark_reports_every_step(self):
+        generate_synthetic_org(30, years=0.2, seed=1)
+        result = benchmark_current_database('synthetic', blossom_max_users=20)
+        self.assertEqual(30, result['users'])
+        steps = result['steps']
+        self.assertEqual(['matching_graph', 'compact_matching_graph', 'engine_montecarlo', 'engine_blossom',
+                          'engine_annealing', 'get_matches_quality'], list(steps))
+        self.assertIn('skipped', steps['engine_blossom'])
+        for step in ('matching_graph', 'compact_matching_graph', 'engine_montecarlo', 'get_matches_quality'):
+            self.assertGreaterEqual(steps[step]['wall_time_s'], 0.0)
+            self.assertGreater(steps[step]['peak_memory_bytes'], 0)
+        self.assertGreater(steps['engine_annealing']['iterations'], 0)
+        self.assertLessEqual(steps['engine_montecarlo']['penalty_after_local_search'],
+                             steps['engine_montecarlo']['penalty'])
+        json.dumps(result)
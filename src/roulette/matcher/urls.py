@@ -8,6 +8,8 @@ urlpatterns = [
     path('all', views.roulette_list_all, name='list_all'),
     path('roulette/<int:roulette_id>/', views.roulette, name='roulette'),
     path('roulette/<int:roulette_id>/run/', views.run_roulette, name='run'),
+    path('roulette/<int:roulette_id>/candidate/<int:candidate_id>/',
+         views.matching_candidate, name='candidate'),
     path('roulette/<int:roulette_id>/submit/',
          views.submit_roulette, name='submit'),
 ]
@@ -1,45 +1,51 @@
+from django.conf import settings
+from django.core.paginator import Paginator
 from django.db import transaction
+from django.db.models import Count, Q
 from django.shortcuts import render, get_object_or_404
 from django.http import HttpResponseRedirect, Http404
 from django.utils import timezone
 from django.urls import reverse
 from django.views.decorators.http import require_POST
-from .algorithms import generate_matches_montecarlo, get_matches_quality, merge_matches
-from .models import Match, Roulette, RouletteUser, PenaltyForGroupingWithForbiddenUser, matching_graph
+from .algorithms import generate_matches, get_matches_quality, improve_matching, merge_matches
+from .models import Match, MatchingCandidate, Roulette, RouletteUser, Vote, compact_matching_graph, penalty_config, record_pair_history
 from .signals import post_matching
-from typing import List, Tuple
-import re
+from typing import Iterable, List, Tuple
 
 # TODO all the views should be accessible only after login
 
 
-def insert_roulette_data_columns(roulettes):
-    for r in roulettes:
-        votes = r.vote_set.order_by('user__name')
-        r.votes_yes = len(votes.filter(choice='Y'))
-        r.votes_no = len(votes.filter(choice='N'))
-        r.votes_unknown = len(votes.filter(choice='0'))
-        r.total_users = r.votes_yes + r.votes_no + r.votes_unknown
+def with_vote_counts(roulettes):
+    """ Annotates every roulette with the number of votes of each kind, counted by the database in a single query. """
+    return roulettes.annotate(
+        votes_yes=Count('vote', filter=Q(vote__choice=Vote.YES)),
+        votes_no=Count('vote', filter=Q(vote__choice=Vote.NO)),
+        votes_unknown=Count('vote', filter=Q(vote__choice=Vote.NO_CHOICE_YET)),
+        total_users=Count('vote'))
+
+
+def render_roulette_list(request, roulettes, template_name):
+    paginator = Paginator(with_vote_counts(roulettes),
+                          settings.MATCHER_ROULETTES_PER_PAGE)
+    page = paginator.get_page(request.GET.get('page'))
+    return render(request, template_name, {'roulettes': page})
 
 
 def roulette_list_active(request):
     roulettes = Roulette.objects.filter(
-        coffee_deadline__gte=timezone.now()).order_by("-id").all()
-    insert_roulette_data_columns(roulettes)
-    return render(request, 'matcher/roulette_list_active.html', {'roulettes': roulettes})
+        coffee_deadline__gte=timezone.now()).order_by("-id")
+    return render_roulette_list(request, roulettes, 'matcher/roulette_list_active.html')
 
 
 def roulette_list_archive(request):
     roulettes = Roulette.objects.filter(
-        coffee_deadline__lt=timezone.now()).order_by("-id").all()
-    insert_roulette_data_columns(roulettes)
-    return render(request, 'matcher/roulette_list_archive.html', {'roulettes': roulettes})
+        coffee_deadline__lt=timezone.now()).order_by("-id")
+    return render_roulette_list(request, roulettes, 'matcher/roulette_list_archive.html')
 
 
 def roulette_list_all(request):
-    roulettes = Roulette.objects.order_by("-id").all()
-    insert_roulette_data_columns(roulettes)
-    return render(request, 'matcher/roulette_list_all.html', {'roulettes': roulettes})
+    roulettes = Roulette.objects.order_by("-id")
+    return render_roulette_list(request, roulettes, 'matcher/roulette_list_all.html')
 
 
 def roulette(request, roulette_id):
@@ -51,92 +57,88 @@ def roulette(request, roulette_id):
     return render(request, 'matcher/roulette.html', context)
 
 
+@require_POST
 def run_roulette(request, roulette_id):
     r = get_object_or_404(Roulette, pk=roulette_id)
     if not r.canAdminGenerateMatches():
         return render(request, 'matcher/cant_generate_matches.html', {'roulette': r})
     users = r.participatingUsers()
-    graph = matching_graph(users)
-    penalty_for_grouping_with_forbidden_user = PenaltyForGroupingWithForbiddenUser.objects.get_or_create()[
-        0].penalty
-    matching = generate_matches_montecarlo(
+    graph = compact_matching_graph(users)
+    penalty_for_grouping_with_forbidden_user = penalty_config().grouping_with_forbidden_user
+    matching = generate_matches(
         graph, penalty_for_grouping_with_forbidden_user)
+    matching = improve_matching(
+        graph, matching, penalty_for_grouping_with_forbidden_user)
+    if len(matching.matches) == 0:
+        return render(request, 'matcher/matcher.html', {'roulette': r})
     matches_quality = get_matches_quality(graph,
                                           matching.matches, penalty_for_grouping_with_forbidden_user)
-    context = {'matching': matching, 'roulette': r,
-               'matches_quality': matches_quality}
-    # TODO refactor this to use session data instead
+    candidate = MatchingCandidate.from_matching(r, matching, matches_quality)
+    candidate.save()
+    MatchingCandidate.prune(r, candidate)
+    return HttpResponseRedirect(reverse('matcher:candidate', args=(r.id, candidate.id)))
+
+
+def matching_candidate(request, roulette_id, candidate_id):
+    candidate = get_object_or_404(MatchingCandidate.objects.select_related(
+        'roulette'), pk=candidate_id, roulette_id=roulette_id)
+    best_candidates = MatchingCandidate.objects.filter(roulette_id=roulette_id).order_by(
+        'total_penalty', 'created_on').only('id', 'roulette_id', 'total_penalty', 'created_on')[:settings.MATCHER_CANDIDATES_SHOWN]
+    context = {'roulette': candidate.roulette, 'candidate': candidate,
+               'groups': candidate.groups_with_quality(), 'best_candidates': best_candidates}
     return render(request, 'matcher/matcher.html', context)
 
 
+def group_pairs(groups: Iterable[List[int]]) -> List[Tuple[int, int]]:
+    """ Returns all the pairs (smaller user id, bigger user id) of users in the same group. """
+    return [(user_a, user_b) for group in groups for user_a in group for user_b in group if user_a < user_b]
+
+
 @require_POST
 def submit_roulette(request, roulette_id):
-    autocommit = transaction.get_autocommit()
-    transaction.set_autocommit(False)
-    exception = None
     try:
-        r = Roulette.objects.select_for_update().get(id=roulette_id)
+        candidate_id = int(request.POST.get('candidate'))
+    except (TypeError, ValueError):
+        # A tampered form, or no candidate chosen at all
+        raise Http404("No such matching candidate")
+    # The roulette row stays locked only for a few statements, independent of the number of users.
+    with transaction.atomic():
+        r = get_object_or_404(
+            Roulette.objects.select_for_update(), id=roulette_id)
         if r.matchings_found_on is not None:
             raise Exception("Someone else has already saved the results")
+        candidate = get_object_or_404(
+            MatchingCandidate, pk=candidate_id, roulette=r)
+        groups = candidate.groups_by_id()
+        matched_pairs = group_pairs(groups.values())
+        user_ids = {user_id for group in groups.values()
+                    for user_id in group}
+        participant_ids = set(r.vote_set.filter(choice=Vote.YES, user_id__in=user_ids).values_list(
+            'user_id', flat=True))
+        if participant_ids != user_ids:
+            raise Http404("Users {0} don't participate in the roulette".format(
+                sorted(user_ids - participant_ids)))
         r.matchings_found_on = timezone.now()
         r.save()
-        groups = {}
-        user_ids_affected = set()
-        for key, value in request.POST.items():
-            pattern = r'user(\d+)$'
-            match = re.match(pattern, key)
-            if match:
-                group_id = value
-                user_id = int(match.group(1))
-                group = groups.get(group_id, [])
-                group.append(user_id)
-                if user_id in user_ids_affected:
-                    raise Exception("A user can't have more than 1 match")
-                user_ids_affected.add(user_id)
-                groups[group_id] = group
-        for group in groups.values():
-            for user_a in group:
-                for user_b in group:
-                    if user_a >= user_b:
-                        continue
-                    Match.objects.create(user_a=get_object_or_404(RouletteUser, pk=user_a),
-                                         user_b=get_object_or_404(
-                                             RouletteUser, pk=user_b),
-                                         roulette=r)
-        transaction.commit()
-        post_matching.send(sender=Roulette.__class__,
-                           instance=r, groups=groups)
-    except (KeyError, Roulette.DoesNotExist):
-        exception = Http404()
-        transaction.rollback()
-    except Exception as e:
-        exception = e
-        transaction.rollback()
-    transaction.set_autocommit(autocommit)
-    if exception is None:
-        return HttpResponseRedirect(reverse('matcher:roulette', args=(r.id,)))
-    else:
-        raise exception
+        Match.objects.bulk_create([Match(user_a_id=user_a, user_b_id=user_b, roulette=r)
+                                   for user_a, user_b in matched_pairs])
+        record_pair_history(r, matched_pairs)
+        # The other candidates can't be submitted anymore.
+        r.matchingcandidate_set.all().delete()
+    post_matching.send(sender=Roulette.__class__,
+                       instance=r, groups=groups)
+    return HttpResponseRedirect(reverse('matcher:roulette', args=(r.id,)))
 
 # A debug method, for adding matches to an existing roulette
 def fix_roulette(roulette_id: int, matches: List[Tuple[RouletteUser]]):
-    autocommit = transaction.get_autocommit()
-    transaction.set_autocommit(False)
-    exception = None
-    try:
+    with transaction.atomic():
         r = Roulette.objects.select_for_update().get(id=roulette_id)
         if not r.canAdminGenerateMatches():
             raise Exception("Someone else has already saved the results")
         r.matchings_found_on = timezone.now()
         r.save()
-        for user_a, user_b in matches:
-            Match.objects.create(user_a=user_a, user_b=user_b, roulette=r)
-        transaction.commit()
-    except Exception as e:
-        exception = e
-        transaction.rollback()
-    transaction.set_autocommit(autocommit)
-    if exception is None:
-        return "OK"
-    else:
-        raise exception
\ No newline at end of file
+        Match.objects.bulk_create([Match(user_a=user_a, user_b=user_b, roulette=r)
+                                   for user_a, user_b in matches])
+        record_pair_history(
+            r, [(user_a.id, user_b.id) for user_a, user_b in matches])
+    return "OK"
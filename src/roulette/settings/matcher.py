@@ -1,6 +1,47 @@
-# Time in milliseconds that the monte carlo matcher can take to generate pairs.
+# The algorithm used for generating matches. Allowed values:
+# 'montecarlo' - random matchings are generated until the timeout, and the best one is taken.
+# 'blossom' - the pairs are found with Edmonds' blossom algorithm (networkx, pure Python). The matching is optimal
+#  for an even number of users. For an odd number, the leftover user joins the best pair afterwards, which is not
+#  always optimal (the stop reason tells whether it is). It takes milliseconds for a few dozen users, about 0.1 s
+#  for 100 users, and about a second for 200 users. Not recommended for more users.
+# 'annealing' - simulated annealing. Recommended for thousands of users.
+MATCHER_ENGINE = 'montecarlo'
+
+# Maximum time in milliseconds that the monte carlo matcher can take to generate pairs.
 MATCHER_MONTECARLO_TIMEOUT_MS = 1000
 
+# The time budget of the monte carlo matcher grows by this many milliseconds for every participating user,
+# up to MATCHER_MONTECARLO_TIMEOUT_MS.
+MATCHER_MONTECARLO_TIMEOUT_MS_PER_USER = 20
+
+# The monte carlo matcher stops earlier, if this many matchings in a row weren't better than the best one.
+# None means that only the time budget is used. The matcher also stops as soon as the matching is certainly optimal.
+MATCHER_MONTECARLO_MAX_ITERATIONS_WITHOUT_IMPROVEMENT = 2000
+
+# The number of processes that the monte carlo matcher generates pairs in, in parallel.
+# 1 means no additional processes. None means the number of CPUs.
+MATCHER_MONTECARLO_WORKERS = 1
+
+# Time in milliseconds that the simulated annealing matcher can take to generate pairs.
+MATCHER_ANNEALING_TIMEOUT_MS = 1000
+
+# The maximum number of moves tried by the simulated annealing matcher, or None for no limit (only the timeout).
+MATCHER_ANNEALING_ITERATIONS = None
+
+# The simulated annealing matcher stops earlier, if this many moves in a row didn't find a better matching than the
+# best one. None means that only the time budget is used. The matcher also stops as soon as the matching is certainly
+# optimal.
+MATCHER_ANNEALING_MAX_ITERATIONS_WITHOUT_IMPROVEMENT = 50000
+
+# The cooling schedule of the simulated annealing matcher. The temperature falls exponentially from start to end.
+# A move that increases the total penalty by x is accepted with probability exp(-x / temperature).
+MATCHER_ANNEALING_START_TEMPERATURE = 2.0
+MATCHER_ANNEALING_END_TEMPERATURE = 0.01
+
+# Maximum time in milliseconds for improving the generated matches by local search (swapping users between groups).
+# The search usually stops much earlier, when no swap lowers the total penalty. 0 disables the improvement.
+MATCHER_LOCAL_SEARCH_TIMEOUT_MS = 100
+
 # The percentile, at or below which the weight is considered good (green). This is used for evaluation of matches.
 # Allowed values: [0, 100]
 MATCHER_GREEN_PERCENTILE = 33.3
@@ -8,3 +49,21 @@ MATCHER_GREEN_PERCENTILE = 33.3
 # The percentile, at or below which the weight is considered average (yellow). This is used for evaluation of matches.
 # Allowed values: [0, 100]
 MATCHER_YELLOW_PERCENTILE = 66.6
+
+# How many last matching dates are remembered for each pair of users (see matcher.models.PairHistory).
+# Penalties for recent matches consider the matches from the last year, so this should be at least
+# the number of roulettes held in a year.
+MATCHER_PAIR_HISTORY_DATES = 52
+
+# How many roulettes are shown on one page of the roulette lists.
+MATCHER_ROULETTES_PER_PAGE = 25
+
+# Every run of the matcher is stored as a candidate, until the results are submitted.
+# The results page lists this many best candidates of the roulette, so that the admin can compare them.
+# Only these best candidates (and the one of the last run) are kept, the other ones are deleted.
+MATCHER_CANDIDATES_SHOWN = 5
+
+# How long (in seconds) the penalties are kept in the Django cache. Saving a penalty clears the cache immediately,
+# but with the default (per-process) cache, only in the process that saved it. None means forever,
+# which is safe with a cache shared by all the processes (e.g. Memcached).
+MATCHER_PENALTY_CONFIG_CACHE_SECONDS = 60
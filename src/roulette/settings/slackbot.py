@@ -0,0 +1,60 @@
+# The URL of the Slack Web API. It only needs to be changed for testing, e.g. with a local fake Slack server.
+SLACKBOT_API_URL = 'https://www.slack.com/api/'
+
+# How long (in seconds) the Slack directory (the emails and names of all the users in the Slack workspace)
+# is kept in the Django cache. Slack users are correlated with the roulette users by email using this directory,
+# so a user that joins Slack is found after at most this time. Messages of unknown Slack users are looked up at once.
+SLACKBOT_DIRECTORY_CACHE_SECONDS = 60 * 60
+
+# How many users are requested from Slack in one page of users.list, when the directory is loaded.
+SLACKBOT_DIRECTORY_PAGE_SIZE = 200
+
+# How many instant messages (e.g. the matching results) are sent to Slack at the same time.
+SLACKBOT_NOTIFICATION_CONCURRENCY = 8
+
+# How many keep-alive connections to Slack are kept open between the API calls (see slackbot.webclient).
+SLACKBOT_HTTP_MAX_IDLE_CONNECTIONS = SLACKBOT_NOTIFICATION_CONCURRENCY
+
+# For how long (in seconds) the Slack workspace settings (e.g. the bot token) are cached.
+# Saving the workspace in the admin site invalidates the cache.
+SLACKBOT_WORKSPACE_CACHE_SECONDS = 60
+
+# How many Slack API calls per minute are made in each rate limit tier (see slackbot.ratelimit.METHOD_TIERS and
+# https://api.slack.com/docs/rate-limits). A tier allows a burst of this many calls, then the calls wait for their turn.
+# chat.postMessage has a 'special' limit of about 1 message per second in every channel, and the IMs to different
+# users are in different channels, so a higher rate is allowed for it.
+SLACKBOT_RATE_LIMITS = {
+    'tier1': 1,
+    'tier2': 20,
+    'tier3': 50,
+    'tier4': 100,
+    'special': 300,
+}
+
+# How many times a Slack API call is retried, if Slack rejects it because of the rate limit (HTTP 429).
+SLACKBOT_RATE_LIMIT_MAX_RETRIES = 5
+
+# The messages to Slack are queued in the database, and sent by the process_slack_outbox command.
+# How many queued messages are sent in one batch.
+SLACKBOT_OUTBOX_BATCH_SIZE = 20
+
+# How many times a message is tried to be sent, before it's marked as failed and the admins are notified.
+SLACKBOT_OUTBOX_MAX_ATTEMPTS = 5
+
+# The time (in seconds) before a message that couldn't be sent is retried. It's doubled after every failed attempt.
+SLACKBOT_OUTBOX_RETRY_SECONDS = 60
+
+# A worker takes a message for this many seconds. If the worker dies while sending it, it's retried after that time.
+SLACKBOT_OUTBOX_LEASE_SECONDS = 10 * 60
+
+# If True, the matching results are sent as one message to every group, in a conversation of the bot with all
+# the members of the group, instead of an IM to every user. This needs fewer Slack API calls, and the members
+# can agree on the meeting in the same conversation. The bot needs the mpim:write permission then.
+SLACKBOT_GROUP_NOTIFICATIONS = False
+
+# How many replies are requested from Slack in one page, when the votes are downloaded from a roulette thread.
+SLACKBOT_REPLIES_PAGE_SIZE = 200
+
+# For how long (in seconds) the result of downloading the votes is kept, if the admin doesn't see it
+# (e.g. the browser was closed before the redirect). The expired results are deleted by the next download.
+SLACKBOT_VOTE_FETCH_EXPIRY_SECONDS = 60 * 60
@@ -11,3 +11,9 @@ class SlackAdminUserInline(admin.TabularInline):
 
 
 admin.site.register(SlackWorkspace)
+
+
+@admin.register(SlackOutboxMessage)
+class SlackOutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('idempotency_key', 'kind', 'status', 'attempts', 'created_on', 'next_attempt_on', 'sent_on')
+    list_filter = ('status', 'kind')
@@ -0,0 +1,125 @@
+"""
+Receiving votes through the Slack Events API. Slack sends every message posted on a roulette thread
+to the 'events' view, and the message is applied as a vote right away, so the votes don't need to be downloaded
+from the thread (see BotClient.fetch_votes).
+https://api.slack.com/apis/connections/events-api
+"""
+from decimal import Decimal
+from django.core.cache import cache
+from django.db import transaction
+from slack.signature import SignatureVerifier
+from matcher.models import Roulette, Vote
+from .models import SlackOutboxMessage, SlackRoulette, SlackUser, SlackVoteMessage
+from .webapi import SLACK_DIRECTORY_CACHE_KEY, BotClient, parse_vote_choice
+
+# The results of handle_message_event(), mostly useful for logging and tests.
+EVENT_VOTE_SAVED = 'vote_saved'
+EVENT_IGNORED = 'ignored'
+EVENT_DUPLICATE = 'duplicate'
+EVENT_UNKNOWN_USER = 'unknown_user'
+EVENT_NOT_A_VOTE = 'not_a_vote'
+EVENT_TOO_LATE = 'too_late'
+EVENT_QUEUED = 'queued'
+
+# The subtypes of the messages that are votes: replies that are also sent to the channel, and replies with files.
+# The other subtypes (edits, deletions, bot messages, channel joins...) aren't votes.
+VOTE_SUBTYPES = {None, 'thread_broadcast', 'file_share'}
+
+
+def sign_request(signing_secret, timestamp, body):
+    """ Compute the X-Slack-Signature header of a request body sent at timestamp (seconds since the epoch). """
+    return SignatureVerifier(signing_secret).generate_signature(timestamp=str(timestamp), body=body)
+
+
+def is_request_signed(signing_secret, body, headers):
+    """
+    Check the X-Slack-Signature and X-Slack-Request-Timestamp headers of a request.
+    Requests older than 5 minutes are rejected too, so that recorded requests can't be replayed.
+    """
+    if len(signing_secret) == 0:
+        return False
+    try:
+        return SignatureVerifier(signing_secret).is_valid_request(body, headers)
+    except ValueError:
+        # The timestamp header is not a number.
+        return False
+
+
+def vote_event_key(event):
+    """ The idempotency key of the outbox message applying a message event as a vote later. """
+    return "vote-{0}-{1}".format(event.get("channel"), event["ts"])
+
+
+def _can_corellate_from_cache(slack_user_id):
+    directory = cache.get(SLACK_DIRECTORY_CACHE_KEY)
+    return directory is not None and slack_user_id in directory["profiles"]
+
+
+def _corellate_slack_user(slack_user_id, client):
+    """
+    Return the new SlackUser with given Slack user ID, correlated by email with the directory (which is loaded
+    through the Slack API if needed), or None if the user is not in our database.
+    """
+    user_dict = (client or BotClient()).get_or_corellate_slack_user(slack_user_id)
+    if user_dict["database_slack_user_id"] is None:
+        return None
+    return SlackUser.objects.select_related('user').get(pk=int(user_dict["database_slack_user_id"]))
+
+
+def handle_message_event(event, client=None):
+    """
+    Apply a 'message' event as a vote, if it's a reply on a roulette thread. Return one of the EVENT_* constants.
+    Only the newest message of every user counts: an event that is redelivered, or that arrives after a newer message
+    of the same user, doesn't change the vote.
+    Slack expects an answer to the event within 3 seconds. So without a client (a BotClient), the Slack API isn't
+    called: the vote of a user who can't be correlated with the cached directory is queued in the outbox,
+    and applied later by the process_slack_outbox command, with its client.
+    """
+    if event.get("type") != "message" or event.get("subtype") not in VOTE_SUBTYPES or "user" not in event:
+        return EVENT_IGNORED
+    thread_timestamp = event.get("thread_ts")
+    if thread_timestamp is None or thread_timestamp == event["ts"]:
+        return EVENT_IGNORED
+    slack_roulette = SlackRoulette.objects.filter(
+        channel_id=event.get("channel"), thread_timestamp=thread_timestamp).first()
+    if slack_roulette is None:
+        return EVENT_IGNORED
+
+    choice = parse_vote_choice(event.get("text", ""))
+    if choice is None:
+        return EVENT_NOT_A_VOTE
+    slack_user = SlackUser.objects.select_related('user').filter(slack_user_id=event["user"]).first()
+    if slack_user is None:
+        if client is None and not _can_corellate_from_cache(event["user"]):
+            SlackOutboxMessage.enqueue(SlackOutboxMessage.VOTE_EVENT, vote_event_key(event), {"event": event})
+            return EVENT_QUEUED
+        slack_user = _corellate_slack_user(event["user"], client)
+    if slack_user is None:
+        return EVENT_UNKNOWN_USER
+
+    with transaction.atomic():
+        roulette = Roulette.objects.select_for_update().get(pk=slack_roulette.roulette_id)
+        if not roulette.canVotesBeChanged():
+            return EVENT_TOO_LATE
+        last_message, created = SlackVoteMessage.objects.select_for_update().get_or_create(
+            slack_roulette=slack_roulette, slack_user_id=event["user"],
+            defaults={"message_timestamp": event["ts"]})
+        if not created:
+            if Decimal(event["ts"]) <= Decimal(last_message.message_timestamp):
+                return EVENT_DUPLICATE
+            last_message.message_timestamp = event["ts"]
+            last_message.save(update_fields=["message_timestamp"])
+        Vote.objects.update_or_create(roulette=roulette, user=slack_user.user, defaults={"choice": choice})
+    return EVENT_VOTE_SAVED
+
+
+def handle_event_payload(payload):
+    """
+    Handle the JSON payload of an Events API request, which has already been verified.
+    Return the response data for Slack: the challenge for url_verification requests, otherwise None.
+    """
+    if payload.get("type") == "url_verification":
+        return {"challenge": payload.get("challenge")}
+    if payload.get("type") == "event_callback":
+        handle_message_event(payload.get("event", {}))
+    return None
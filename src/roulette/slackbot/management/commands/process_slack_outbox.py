@@ -0,0 +1,27 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from slackbot.outbox import process_outbox
+
+
+class Command(BaseCommand):
+    help = "Sends the queued Slack messages (new roulettes and matching results) in batches. " \
+        "Run it periodically (e.g. from cron), or keep it running with --loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.SLACKBOT_OUTBOX_BATCH_SIZE,
+                            help="How many messages are sent in one batch.")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep running, and check for new messages every --interval seconds.")
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help="Seconds between the checks for new messages, with --loop.")
+
+    def handle(self, *args, **options):
+        while True:
+            processed_count = process_outbox(options['batch_size'])
+            while processed_count == options['batch_size']:
+                # There may be more messages waiting.
+                processed_count = process_outbox(options['batch_size'])
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
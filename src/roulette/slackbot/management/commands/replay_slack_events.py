@@ -0,0 +1,42 @@
+import time
+import urllib.error
+import urllib.request
+from django.core.management.base import BaseCommand, CommandError
+from slackbot.events import sign_request
+from slackbot.models import SlackWorkspace
+
+
+class Command(BaseCommand):
+    help = "Sends recorded Slack Events API payloads (JSON files) to the events endpoint of a running server, " \
+        "signed like Slack does. Useful for testing the Events API integration locally, without Slack."
+
+    def add_arguments(self, parser):
+        parser.add_argument('payload_files', nargs='+', help="Paths to the JSON files with the event payloads.")
+        parser.add_argument('--url', default='http://localhost:8000/slack/events',
+                            help="The Request URL of the events endpoint.")
+        parser.add_argument('--signing-secret', default=None,
+                            help="The signing secret. By default, the one of the configured Slack workspace.")
+
+    def handle(self, *args, **options):
+        signing_secret = options['signing_secret']
+        if signing_secret is None:
+            slack_workspace = SlackWorkspace.objects.first()
+            if slack_workspace is None or len(slack_workspace.signing_secret) == 0:
+                raise CommandError("No signing secret is configured. Pass --signing-secret.")
+            signing_secret = slack_workspace.signing_secret
+
+        for payload_file in options['payload_files']:
+            with open(payload_file, 'rb') as file:
+                body = file.read()
+            timestamp = int(time.time())
+            request = urllib.request.Request(options['url'], data=body, method='POST', headers={
+                'Content-Type': 'application/json',
+                'X-Slack-Request-Timestamp': str(timestamp),
+                'X-Slack-Signature': sign_request(signing_secret, timestamp, body),
+            })
+            try:
+                with urllib.request.urlopen(request) as response:
+                    self.stdout.write("{0}: {1} {2}".format(
+                        payload_file, response.status, response.read().decode('utf-8')))
+            except urllib.error.HTTPError as error:
+                self.stderr.write(self.style.ERROR("{0}: {1}".format(payload_file, error)))
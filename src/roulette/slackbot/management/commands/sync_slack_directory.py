@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from slackbot.webapi import BotClient
+
+
+class Command(BaseCommand):
+    help = "Loads the directory of the Slack workspace again, and connects all the roulette users " \
+        "that aren't connected with Slack yet with their Slack accounts, by email."
+
+    def handle(self, *args, **options):
+        created_count = BotClient().sync_slack_users(refresh=True)
+        self.stdout.write(self.style.SUCCESS(
+            "Connected {0} user(s) with their Slack accounts.".format(created_count)))
@@ -0,0 +1,32 @@
+# Generated by Django 3.1.8 on 2026-10-17 00:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slackbot', '0009_slackworkspace'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='slackworkspace',
+            name='signing_secret',
+            field=models.CharField(blank=True, default='', help_text='The Signing Secret of the Slack app, from its Basic Information page. Needed only for receiving votes through the Events API. Without it, the votes can only be downloaded from the Slack thread by the admin.', max_length=255),
+        ),
+        migrations.CreateModel(
+            name='SlackVoteMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slack_user_id', models.CharField(max_length=20)),
+                ('message_timestamp', models.CharField(max_length=30)),
+                ('slack_roulette', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='slackbot.slackroulette')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='slackvotemessage',
+            constraint=models.UniqueConstraint(fields=('slack_roulette', 'slack_user_id'), name='unique_slack_vote_message'),
+        ),
+    ]
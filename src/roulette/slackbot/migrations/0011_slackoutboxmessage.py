@@ -0,0 +1,33 @@
+# Generated by Django 3.1.8 on 2026-10-17 00:38
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slackbot', '0010_events_api'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlackOutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('new_roulette', 'New roulette'), ('matching_results', 'Matching results')], max_length=30)),
+                ('idempotency_key', models.CharField(max_length=100, unique=True)),
+                ('payload', models.JSONField(default=dict)),
+                ('status', models.CharField(choices=[('P', 'Pending'), ('S', 'Sent'), ('F', 'Failed')], default='P', max_length=1)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('next_attempt_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('sent_on', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='slackoutboxmessage',
+            index=models.Index(fields=['status', 'next_attempt_on'], name='slackbot_sl_status_e17dd9_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.8 on 2026-10-17 00:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matcher', '0009_matchingcandidate'),
+        ('slackbot', '0011_slackoutboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlackVoteFetch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fetched_on', models.DateTimeField(auto_now_add=True)),
+                ('vote_ids', models.JSONField(default=list)),
+                ('unknown_messages', models.JSONField(default=list)),
+                ('roulette', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='matcher.roulette')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.8 on 2026-10-17 00:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slackbot', '0012_slackvotefetch'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='slackoutboxmessage',
+            name='kind',
+            field=models.CharField(choices=[('new_roulette', 'New roulette'), ('matching_results', 'Matching results'), ('vote_event', 'Vote event')], max_length=30),
+        ),
+    ]
@@ -1,5 +1,9 @@
+from datetime import timedelta
+from django.conf import settings
 from django.contrib import auth
-from django.db import models
+from django.core.cache import cache
+from django.db import models, transaction
+from django.utils import timezone
 from matcher.models import Roulette, RouletteUser
 
 
@@ -27,6 +31,33 @@ class SlackWorkspace(AtMostOneInstanceModel):
         max_length=255, help_text="Name of the Slack channel that the bot will post public messages on. Starts with #.")
     bot_api_token = models.CharField(
         max_length=255, help_text="A secret token that allows using Slack Web API, tied to a Slack app installation.")
+    signing_secret = models.CharField(
+        max_length=255, default="", blank=True,
+        help_text="The Signing Secret of the Slack app, from its Basic Information page. Needed only for receiving votes"
+        " through the Events API. Without it, the votes can only be downloaded from the Slack thread by the admin.")
+
+
+SLACK_WORKSPACE_CACHE_KEY = 'slackbot.workspace'
+
+
+def get_workspace():
+    """
+    Returns the SlackWorkspace, or None if there's none, cached in the Django cache for
+    settings.SLACKBOT_WORKSPACE_CACHE_SECONDS. Saving or deleting the workspace invalidates the cache
+    (see slackbot.signals). The workspace read inside a transaction isn't cached, because the transaction could
+    still be rolled back.
+    """
+    # A missing workspace is cached as False, because None means that nothing is cached.
+    workspace = cache.get(SLACK_WORKSPACE_CACHE_KEY)
+    if workspace is None:
+        workspace = SlackWorkspace.objects.first() or False
+        if not transaction.get_connection().in_atomic_block:
+            cache.set(SLACK_WORKSPACE_CACHE_KEY, workspace, settings.SLACKBOT_WORKSPACE_CACHE_SECONDS)
+    return workspace or None
+
+
+def invalidate_workspace():
+    cache.delete(SLACK_WORKSPACE_CACHE_KEY)
 
 
 class SlackUser(models.Model):
@@ -65,3 +96,89 @@ class SlackRoulette(models.Model):
     thread_timestamp = models.CharField(max_length=30)
     latest_response_timestamp = models.CharField(max_length=30, default="0")
     channel_id = models.CharField(max_length=20)
+
+
+class SlackVoteMessage(models.Model):
+    """ The last vote message of a Slack user on a roulette thread, received through the Events API.
+        Slack may deliver an event more than once, and not necessarily in order, so a message is applied
+        only if it's newer than the last one applied for the user.
+    """
+    slack_roulette = models.ForeignKey(SlackRoulette, on_delete=models.CASCADE)
+    slack_user_id = models.CharField(max_length=20)
+    # message_timestamp The Slack 'ts' of the message, which identifies it in the channel.
+    message_timestamp = models.CharField(max_length=30)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['slack_roulette', 'slack_user_id'], name='unique_slack_vote_message')
+        ]
+
+
+class SlackOutboxMessage(models.Model):
+    """ A message waiting to be sent to Slack by the process_slack_outbox command (see slackbot.outbox).
+        The messages are queued by the signal handlers, so that the web requests don't wait for Slack,
+        and so that the messages aren't lost if Slack is not available for a while.
+    """
+    NEW_ROULETTE = 'new_roulette'
+    MATCHING_RESULTS = 'matching_results'
+    # A vote received through the Events API, from a user who has to be correlated through the Slack API first.
+    VOTE_EVENT = 'vote_event'
+    KIND_CHOICES = [
+        (NEW_ROULETTE, 'New roulette'),
+        (MATCHING_RESULTS, 'Matching results'),
+        (VOTE_EVENT, 'Vote event'),
+    ]
+    kind = models.CharField(max_length=30, choices=KIND_CHOICES)
+    # idempotency_key Identifies what the message is about, e.g. 'roulette-5-matching'. A message is queued only once.
+    idempotency_key = models.CharField(max_length=100, unique=True)
+    payload = models.JSONField(default=dict)
+
+    PENDING = 'P'
+    SENT = 'S'
+    FAILED = 'F'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+    created_on = models.DateTimeField(auto_now_add=True)
+    # next_attempt_on A pending message is sent (again) after this time.
+    next_attempt_on = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(default="", blank=True)
+    sent_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_on'])
+        ]
+
+    @classmethod
+    def enqueue(cls, kind, idempotency_key, payload):
+        """ Queue a message, unless a message with the same idempotency key has been queued already. """
+        message, _ = cls.objects.get_or_create(idempotency_key=idempotency_key,
+                                               defaults={'kind': kind, 'payload': payload})
+        return message
+
+    def __str__(self):
+        return "{0} ({1})".format(self.idempotency_key, self.get_status_display())
+
+
+class SlackVoteFetch(models.Model):
+    """ The result of downloading the votes from a roulette thread, until the admin has seen it.
+        It's kept in the database instead of the session, because there can be many unknown messages.
+    """
+    roulette = models.ForeignKey(Roulette, on_delete=models.CASCADE)
+    fetched_on = models.DateTimeField(auto_now_add=True)
+    # vote_ids The votes that were changed by the fetched messages.
+    vote_ids = models.JSONField(default=list)
+    # unknown_messages The messages that couldn't be applied, as returned by BotClient.fetch_votes.
+    unknown_messages = models.JSONField(default=list)
+
+    @classmethod
+    def delete_expired(cls):
+        """ Delete the results that the admin hasn't seen within settings.SLACKBOT_VOTE_FETCH_EXPIRY_SECONDS. """
+        cls.objects.filter(fetched_on__lt=timezone.now() - timedelta(
+            seconds=settings.SLACKBOT_VOTE_FETCH_EXPIRY_SECONDS)).delete()
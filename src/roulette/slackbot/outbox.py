@@ -0,0 +1,108 @@
+"""
+The outbox of Slack messages. The signal handlers only queue SlackOutboxMessages, when the transaction that
+created the roulette or the matches is committed. The messages are sent by the process_slack_outbox command,
+outside of the web requests. A message that couldn't be sent is retried later, with an exponential back-off,
+until settings.SLACKBOT_OUTBOX_MAX_ATTEMPTS; then the admins are notified.
+The votes received through the Events API that need Slack API calls are applied here too (see slackbot.events).
+"""
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from matcher.models import Roulette
+from .events import handle_message_event
+from .models import SlackOutboxMessage
+from .signals import send_matching_results, send_new_roulette
+from .webapi import BotClient
+
+logger = logging.getLogger(__name__)
+
+
+def _send_new_roulette(client, payload):
+    send_new_roulette(client, Roulette.objects.get(pk=payload["roulette_id"]))
+
+
+def _send_matching_results(client, payload):
+    send_matching_results(client, Roulette.objects.get(pk=payload["roulette_id"]), payload["groups"])
+
+
+def _handle_vote_event(client, payload):
+    handle_message_event(payload["event"], client)
+
+
+# The functions sending each kind of messages. Called with a BotClient and the payload of the message.
+OUTBOX_HANDLERS = {
+    SlackOutboxMessage.NEW_ROULETTE: _send_new_roulette,
+    SlackOutboxMessage.MATCHING_RESULTS: _send_matching_results,
+    SlackOutboxMessage.VOTE_EVENT: _handle_vote_event,
+}
+
+
+def _claim(message, now):
+    """
+    Try to take the message for this worker: it's hidden from the other workers for SLACKBOT_OUTBOX_LEASE_SECONDS
+    (and retried after that time, if this worker dies). Return False if another worker has taken it first.
+    """
+    lease_end = now + timedelta(seconds=settings.SLACKBOT_OUTBOX_LEASE_SECONDS)
+    claimed = SlackOutboxMessage.objects.filter(
+        pk=message.pk, status=SlackOutboxMessage.PENDING, next_attempt_on=message.next_attempt_on).update(
+        next_attempt_on=lease_end)
+    return claimed == 1
+
+
+def _record_failure(client, message, exception):
+    message.attempts += 1
+    message.last_error = str(exception)
+    if message.attempts >= settings.SLACKBOT_OUTBOX_MAX_ATTEMPTS:
+        message.status = SlackOutboxMessage.FAILED
+    else:
+        message.next_attempt_on = timezone.now() + timedelta(
+            seconds=settings.SLACKBOT_OUTBOX_RETRY_SECONDS * 2 ** (message.attempts - 1))
+    message.save(update_fields=['attempts', 'last_error', 'status', 'next_attempt_on'])
+    if message.status == SlackOutboxMessage.FAILED and client is not None:
+        try:
+            client.post_im_to_all_admins("Sending the Slack message {0} failed {1} times, and it won't be retried."
+                                         " Consider fixing the issue and sending it again from the admin site."
+                                         " Error was:\n{2}".format(message.idempotency_key, message.attempts,
+                                                                   message.last_error))
+        except Exception:
+            logger.exception("Could not tell the admins that the Slack message %s failed.", message.idempotency_key)
+
+
+def process_outbox(batch_size=None):
+    """
+    Send the pending outbox messages that are due, at most batch_size of them (by default,
+    settings.SLACKBOT_OUTBOX_BATCH_SIZE), oldest first. Return the number of messages that were processed.
+    """
+    if batch_size is None:
+        batch_size = settings.SLACKBOT_OUTBOX_BATCH_SIZE
+    now = timezone.now()
+    messages = list(SlackOutboxMessage.objects.filter(
+        status=SlackOutboxMessage.PENDING, next_attempt_on__lte=now).order_by('id')[:batch_size])
+    if len(messages) == 0:
+        return 0
+    try:
+        client = BotClient()
+    except Exception as exception:
+        # Without a workspace (or a working client) nothing can be sent. The messages are retried later.
+        client = None
+        client_exception = exception
+    processed_count = 0
+    for message in messages:
+        if not _claim(message, now):
+            continue
+        processed_count += 1
+        if client is None:
+            _record_failure(client, message, client_exception)
+            continue
+        try:
+            OUTBOX_HANDLERS[message.kind](client, message.payload)
+        except Exception as exception:
+            logger.exception("Sending the Slack message %s failed.", message.idempotency_key)
+            _record_failure(client, message, exception)
+            continue
+        message.attempts += 1
+        message.status = SlackOutboxMessage.SENT
+        message.sent_on = timezone.now()
+        message.save(update_fields=['attempts', 'status', 'sent_on'])
+    return processed_count
@@ -0,0 +1,158 @@
+"""
+Scheduling the Slack Web API calls within Slack's rate limits.
+Every API method belongs to a rate limit tier, which allows a number of calls per minute
+(https://api.slack.com/docs/rate-limits). The calls of every tier go through a token bucket shared by the whole
+process, so that many concurrent calls (see BotClient.post_ims) are spread over time instead of being rejected.
+A call that is rejected anyway (HTTP 429) is retried after the time that Slack asks for in the Retry-After header.
+"""
+import threading
+import time
+from django.conf import settings
+from slack.errors import SlackApiError
+
+# The rate limit tiers of the Slack API methods used by the bot. The other methods are in DEFAULT_TIER.
+METHOD_TIERS = {
+    'chat.postMessage': 'special',
+    'conversations.open': 'tier3',
+    'conversations.replies': 'tier3',
+    'users.info': 'tier4',
+    'users.list': 'tier2',
+    'users.lookupByEmail': 'tier3',
+}
+DEFAULT_TIER = 'tier3'
+
+# The back-off (in seconds) before retrying a rate limited call, if Slack doesn't say how long to wait.
+# It's doubled for every following retry.
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class TokenBucket():
+    """
+    A thread-safe token bucket: 'rate_per_minute' tokens are added per minute, up to 'capacity' tokens.
+    Every call takes one token, and waits for it, if there are none left. The tokens are reserved in the order
+    of the calls, so waiting calls are served first in, first out.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self._rate = rate_per_minute / 60.0
+        self._capacity = float(capacity if capacity is not None else rate_per_minute)
+        self._tokens = self._capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated_on = clock()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token, waiting for it if needed. Return the time waited, in seconds. """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_on) * self._rate)
+            self._updated_on = now
+            self._tokens -= 1
+            ready_on = max(self._blocked_until, now + max(0.0, -self._tokens) / self._rate)
+        delay = max(0.0, ready_on - now)
+        if delay > 0:
+            self._sleep(delay)
+        return delay
+
+    def block(self, seconds):
+        """ Don't give out any tokens for the next 'seconds' seconds, e.g. when Slack asks to retry later. """
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, self._clock() + seconds)
+
+
+class SlackRequestScheduler():
+    """
+    Runs the Slack API calls of all BotClients within the rate limits, and keeps the metrics of the calls:
+    how many there were, how many were rate limited by Slack, and how long they waited for their turn.
+    'rate_limits' maps the tiers to the allowed calls per minute (by default, settings.SLACKBOT_RATE_LIMITS).
+    """
+
+    def __init__(self, rate_limits=None, max_retries=None, clock=time.monotonic, sleep=time.sleep):
+        self._rate_limits = rate_limits if rate_limits is not None else settings.SLACKBOT_RATE_LIMITS
+        self._max_retries = max_retries if max_retries is not None else settings.SLACKBOT_RATE_LIMIT_MAX_RETRIES
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, tier):
+        with self._lock:
+            if tier not in self._buckets:
+                self._buckets[tier] = TokenBucket(self._rate_limits[tier], clock=self._clock, sleep=self._sleep)
+            return self._buckets[tier]
+
+    def _record(self, method_name, delay, retried):
+        with self._lock:
+            metrics = self._metrics.setdefault(
+                method_name, {'calls': 0, 'retries': 0, 'total_delay_s': 0.0, 'max_delay_s': 0.0})
+            metrics['calls'] += 1
+            metrics['retries'] += int(retried)
+            metrics['total_delay_s'] += delay
+            metrics['max_delay_s'] = max(metrics['max_delay_s'], delay)
+
+    def call(self, method_name, function, **kwargs):
+        """
+        Call function(**kwargs), which calls the Slack API method 'method_name' (e.g. 'chat.postMessage'),
+        when the rate limit of its tier allows. Retry it, if Slack responds with HTTP 429 Too Many Requests.
+        """
+        bucket = self._bucket(METHOD_TIERS.get(method_name, DEFAULT_TIER))
+        retry = 0
+        while True:
+            delay = bucket.acquire()
+            try:
+                response = function(**kwargs)
+                self._record(method_name, delay, retry > 0)
+                return response
+            except SlackApiError as error:
+                self._record(method_name, delay, retry > 0)
+                if error.response.status_code != 429 or retry >= self._max_retries:
+                    raise
+                retry_after = error.response.headers.get('Retry-After')
+                bucket.block(float(retry_after) if retry_after is not None else DEFAULT_RETRY_AFTER * 2 ** retry)
+                retry += 1
+
+    def metrics(self):
+        """
+        Return the metrics of every called method, e.g.
+        {'chat.postMessage': {'calls': 12, 'retries': 1, 'total_delay_s': 2.5, 'max_delay_s': 1.0}}
+        'retries' is the number of calls repeated after a 429 response, the delays are the time spent waiting
+        for a token of the rate limit (including the Retry-After time).
+        """
+        with self._lock:
+            return {method_name: dict(metrics) for method_name, metrics in self._metrics.items()}
+
+
+class ScheduledWebClient():
+    """
+    Wraps a slack.WebClient, so that all its API calls go through a SlackRequestScheduler.
+    The methods are called the same way as on the WebClient, e.g. client.chat_postMessage(channel=..., text=...).
+    """
+
+    def __init__(self, webclient, scheduler):
+        self._webclient = webclient
+        self._scheduler = scheduler
+
+    def __getattr__(self, name):
+        function = getattr(self._webclient, name)
+        # The WebClient methods are named after the API methods, e.g. users_lookupByEmail is users.lookupByEmail.
+        method_name = name.replace('_', '.', 1)
+
+        def scheduled_call(**kwargs):
+            return self._scheduler.call(method_name, function, **kwargs)
+        return scheduled_call
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """ Return the SlackRequestScheduler shared by the whole process. """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = SlackRequestScheduler()
+        return _scheduler
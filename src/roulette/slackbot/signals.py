@@ -1,82 +1,179 @@
-from django.db.models.signals import post_save
+import logging
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from matcher.models import Roulette, RouletteUser
 from matcher.signals import post_matching
-from .exceptions import NoWorkspaceError
-from .models import SlackRoulette, SlackUser
-from .webapi import BotClient
+from .exceptions import SlackbotError
+from .models import SlackOutboxMessage, SlackRoulette, SlackUser, SlackWorkspace, get_workspace, invalidate_workspace
 from django.conf import settings
 from django.utils import timezone
 
+logger = logging.getLogger(__name__)
+
+
+def new_roulette_key(roulette_id):
+    """ The idempotency key of the outbox message broadcasting a new roulette. """
+    return "roulette-{0}-created".format(roulette_id)
+
+
+def matching_results_key(roulette_id):
+    """ The idempotency key of the outbox message with the matching results of a roulette. """
+    return "roulette-{0}-matching".format(roulette_id)
+
+
+def _enqueue_if_slack_connected_(kind, idempotency_key, payload):
+    if get_workspace() is not None:
+        SlackOutboxMessage.enqueue(kind, idempotency_key, payload)
+
+
+@receiver(post_save, sender=SlackWorkspace)
+@receiver(post_delete, sender=SlackWorkspace)
+def workspace_changed(sender, **kwargs):
+    # When the workspace is saved or deleted, forget the cached workspace - now, and once more after the commit,
+    # in case another thread has cached the old one in the meantime
+    invalidate_workspace()
+    transaction.on_commit(invalidate_workspace)
+
 
 @receiver(post_save, sender=Roulette)
 def broadcast_new_roulette(sender, instance, created, **kwargs):
-    # When a roulette is created, create a new thread on Slack
+    # When a roulette is created, queue creating a new thread on Slack (see slackbot.outbox)
     if not created:
         return
-    try:
-        client = BotClient()
+    transaction.on_commit(lambda: _enqueue_if_slack_connected_(
+        SlackOutboxMessage.NEW_ROULETTE, new_roulette_key(instance.pk), {"roulette_id": instance.pk}))
+
+
+def send_new_roulette(client, roulette):
+    """
+    Create a new thread for the roulette on Slack, and post the first reply with the voting instructions.
+    This can be called again after an error: what has been posted already isn't posted again.
+    """
+    slack_roulette = SlackRoulette.objects.filter(roulette=roulette).first()
+    if slack_roulette is None:
         thread_ts, channel_id = client.post_on_roulette_channel((
             "A new coffee roulette #{0} is going to start!"
             " If you want to participate, please reply in this thread.\n"
             "The voting deadline is {1}. Coffee will end on {2}\n"
-        ).format(instance.pk, timezone.localtime(instance.vote_deadline), timezone.localtime(instance.coffee_deadline)))
-        first_reply_ts = client.post_on_thread(channel_id, thread_ts,
-                                               ("Please vote by writing YES or NO (case is ignored).\n"
-                                                " If you make a typo or want to change your vote, just write again. Only the last vote will count.")
-                                               )
-        SlackRoulette.objects.create(roulette=instance, thread_timestamp=thread_ts,
-                                     latest_response_timestamp=first_reply_ts, channel_id=channel_id)
-    except NoWorkspaceError:
-        return
-    except Exception as exception:
-        print(str(exception))
-        try:
-            client = BotClient()
-            client.post_im_to_all_admins("While saving the roulette #{0}, an error occured."
-                                         " Consider fixing the issue and deleting the faulty roulette."
-                                         " Error was:\n{1}".format(instance.pk, str(exception)))
-        except Exception as nestedException:
-            print(str(nestedException))
-        return
+        ).format(roulette.pk, timezone.localtime(roulette.vote_deadline), timezone.localtime(roulette.coffee_deadline)))
+        # Until the first reply is posted, the latest response is the thread itself.
+        slack_roulette = SlackRoulette.objects.create(roulette=roulette, thread_timestamp=thread_ts,
+                                                      latest_response_timestamp=thread_ts, channel_id=channel_id)
+    if slack_roulette.latest_response_timestamp == slack_roulette.thread_timestamp:
+        slack_roulette.latest_response_timestamp = client.post_on_thread(
+            slack_roulette.channel_id, slack_roulette.thread_timestamp,
+            ("Please vote by writing YES or NO (case is ignored).\n"
+             " If you make a typo or want to change your vote, just write again. Only the last vote will count."))
+        slack_roulette.save(update_fields=['latest_response_timestamp'])
 
 
-def _notify_matching_result_(client, roulette, slack_user, other_users):
+def _matching_result_message_(roulette, user, other_users):
+    """ Return the text of the IM telling the user about his/her match, or None if there's nothing to tell. """
     if len(other_users) == 0:
         print("User {0} got matched with noone. This shouldn't have happened.".format(
-            slack_user.roulette_user.name))
-        return
-    other_user_names = [user.name for user in other_users]
-    message = "As a result of roulette #{0}, you got matched with {1}. Please organize a meeting until {2}.".format(
+            user.name))
+        return None
+    other_user_names = [other_user.name for other_user in other_users]
+    return "As a result of roulette #{0}, you got matched with {1}. Please organize a meeting until {2}.".format(
         roulette.pk, " and ".join(other_user_names), timezone.localtime(roulette.coffee_deadline))
-    client.post_im(slack_user, message)
+
+
+def _group_matching_result_message_(roulette, users, slack_users):
+    """
+    Return the text of the message introducing the whole group to each other, or None if there's nothing to tell.
+    The members that are on Slack are mentioned, so that their names are links to their profiles.
+    """
+    if len(users) < 2:
+        logger.warning("Group of %s user(s) got matched in roulette #%s. This shouldn't have happened.",
+                       len(users), roulette.pk)
+        return None
+    names = ["<@{0}>".format(slack_users[user.id].slack_user_id)
+             if user.id in slack_users else user.name for user in users]
+    return "As a result of roulette #{0}, you got matched together: {1}. Please organize a meeting until {2}.".format(
+        roulette.pk, ", ".join(names[:-1]) + " and " + names[-1], timezone.localtime(roulette.coffee_deadline))
+
+
+def _not_on_slack_error_(user):
+    return (user.name, "User {0} could not be found on Slack. His email {1} is not tied to his/her Slack account".format(user.name, user.email))
+
+
+def _notification_error_(user, exception):
+    return (user.name, "Error happened while sending a notification to {0}: {1}.".format(user.name, exception))
+
+
+def _notify_users_(client, roulette, groups, roulette_users, slack_users):
+    """ Send an IM to every user, telling about his/her match. Return the errors, as _notify_all_matching_results_. """
+    errors = []
+    messages = []
+    notified_users = []
+    for _, group in groups.items():
+        users = [roulette_users[user_id] for user_id in group]
+        for user in users:
+            if user.id not in slack_users:
+                errors.append(_not_on_slack_error_(user))
+                continue
+            message = _matching_result_message_(
+                roulette, user, [u for u in users if u.id != user.id])
+            if message is not None:
+                messages.append((slack_users[user.id], message))
+                notified_users.append(user)
+    for user, exception in zip(notified_users, client.post_ims(messages)):
+        if exception is not None:
+            errors.append(_notification_error_(user, exception))
+    return errors
+
+
+def _notify_groups_(client, roulette, groups, roulette_users, slack_users):
+    """
+    Send one message to every group, in a conversation with all its members that are on Slack.
+    Return the errors, as _notify_all_matching_results_: if a message couldn't be sent,
+    there's an error for every member of the group.
+    """
+    errors = []
+    messages = []
+    notified_groups = []
+    for _, group in groups.items():
+        users = [roulette_users[user_id] for user_id in group]
+        errors.extend(_not_on_slack_error_(user)
+                      for user in users if user.id not in slack_users)
+        users_on_slack = [user for user in users if user.id in slack_users]
+        message = _group_matching_result_message_(roulette, users, slack_users)
+        if message is not None and len(users_on_slack) > 0:
+            messages.append(
+                ([slack_users[user.id] for user in users_on_slack], message))
+            notified_groups.append(users_on_slack)
+    for users, exception in zip(notified_groups, client.post_group_messages(messages)):
+        if exception is not None:
+            errors.extend(_notification_error_(user, exception) for user in users)
+    return errors
 
 
 def _notify_all_matching_results_(client, roulette, groups):
     """
-    Try to notify all users participating in roulette about matching results.
+    Try to notify all users participating in roulette about matching results: with an IM to every user,
+    or with one message to every group, if settings.SLACKBOT_GROUP_NOTIFICATIONS is True.
+    The messages are sent concurrently (see BotClient.post_ims).
     'client' is a BotClient instance.
     'roulette' is the Roulette instance.
     'groups' is a dict of group_id => list of user ids that belong to the group. str => list(int)
     Return a list of pairs, (not_notified_user_name, error_detail_string).
     """
     errors = []
-    for _, group in groups.items():
-        users = [RouletteUser.objects.get(pk=user_id) for user_id in group]
-        for user in users:
-            try:
-                other_users = [u for u in users if u.id != user.id]
-                if not SlackUser.objects.filter(user=user).exists():
-                    client.corellate_slack_user_by_email(user)
-                slack_user = SlackUser.objects.get(user=user)
-                _notify_matching_result_(
-                    client, roulette, slack_user, other_users)
-            except SlackUser.DoesNotExist:
-                errors.append(
-                    (user.name, "User {0} could not be found on Slack. His email {1} is not tied to his/her Slack account".format(user.name, user.email)))
-            except Exception as exception:
-                errors.append((user.name, "Error happened while sending a notification to {0}: {1}.".format(
-                    user.name, exception)))
+    user_ids = [user_id for group in groups.values() for user_id in group]
+    roulette_users = RouletteUser.objects.in_bulk(user_ids)
+    try:
+        # The users that aren't on Slack yet are correlated by email all at once, using the Slack directory.
+        client.sync_slack_users(roulette_users.values())
+    except Exception as exception:
+        errors.append(
+            (None, "Could not correlate the users with Slack: {0}".format(exception)))
+    slack_users = {slack_user.user_id: slack_user
+                   for slack_user in SlackUser.objects.filter(user_id__in=user_ids)}
+    if settings.SLACKBOT_GROUP_NOTIFICATIONS:
+        errors.extend(_notify_groups_(client, roulette, groups, roulette_users, slack_users))
+    else:
+        errors.extend(_notify_users_(client, roulette, groups, roulette_users, slack_users))
     return errors
 
 
@@ -112,13 +209,30 @@ def _notify_admins_about_errors_(client, errors):
 
 @receiver(post_matching)
 def broadcast_matching_results(sender, instance, groups, **kwargs):
-    # When a matching is done, send IMs to affected users on Slack
+    # When a matching is done, queue sending IMs to affected users on Slack (see slackbot.outbox)
+    transaction.on_commit(lambda: _enqueue_if_slack_connected_(
+        SlackOutboxMessage.MATCHING_RESULTS, matching_results_key(instance.pk),
+        {"roulette_id": instance.pk, "groups": groups}))
+
+
+def send_matching_results(client, roulette, groups):
+    """
+    Notify the users about the matching results, post the summary on the roulette thread,
+    and tell the admins about the users that couldn't be notified.
+    Once the users have been notified, nothing raises, so that a retry of the outbox message doesn't notify them twice.
+    """
+    if not SlackRoulette.objects.filter(roulette=roulette).exists():
+        if SlackOutboxMessage.objects.filter(idempotency_key=new_roulette_key(roulette.pk),
+                                             status=SlackOutboxMessage.PENDING).exists():
+            # The thread will be created by a retry of that message. The results have to wait.
+            raise SlackbotError(
+                "Roulette #{0} hasn't been broadcast on Slack yet.".format(roulette.pk))
+        return  # A roulette without Slack Roulette - do nothing.
+    errors = _notify_all_matching_results_(client, roulette, groups)
+    errors.extend(_post_matching_summary_(client, roulette, groups))
     try:
-        client = BotClient()
-        if not SlackRoulette.objects.filter(roulette=instance).exists():
-            return  # A roulette without Slack Roulette - do nothing.
-        errors = _notify_all_matching_results_(client, instance, groups)
-        errors.extend(_post_matching_summary_(client, instance, groups))
         _notify_admins_about_errors_(client, errors)
-    except NoWorkspaceError:
-        pass
+    except Exception:
+        # The users have been notified already. Raising would retry the whole outbox message, and notify them again.
+        logger.exception("Could not tell the admins about the errors while notifying the users of roulette #%s.",
+                         roulette.pk)
@@ -1,5 +1,32 @@
 from django.contrib import auth
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+import json
+import os
+import threading
+import time
+
+from datetime import timedelta
+from matcher.models import MatchingCandidate, Roulette, RouletteUser, Vote
+from matcher.signals import post_matching
+from .events import sign_request
+from slack.errors import SlackApiError
+from .models import (SlackAdminUser, SlackOutboxMessage, SlackRoulette, SlackUser, SlackVoteFetch, SlackVoteMessage,
+                     SlackWorkspace, get_workspace)
+from .outbox import process_outbox
+from .ratelimit import SlackRequestScheduler, TokenBucket, get_scheduler
+from .signals import _notify_all_matching_results_
+from .webapi import BotClient
+from .webclient import close_webclients, get_webclient
+
+EVENTS_DIR = os.path.join(os.path.dirname(__file__), 'testdata', 'events')
+SIGNING_SECRET = '8f742231b10e8888abcd99yyyzzz85a5'
 
 
 def create_natural_number_users(n_users):
@@ -7,3 +34,751 @@ def create_natural_number_users(n_users):
         auth.models.User.objects.create(
             username=str(i), email=str(i)+"@example.com")
     return auth.models.User.objects.all()
+
+
+def create_slack_roulette():
+    """
+    Create a roulette with a Slack thread, as in the recorded events, and two users on Slack.
+    The workspace is created after the roulette, so that nothing is sent to Slack.
+    """
+    roulette = Roulette.objects.create(vote_deadline=timezone.now(), coffee_deadline=timezone.now())
+    for k in (1, 2):
+        user = RouletteUser.objects.create(name=str(k), email=str(k) + "@example.com")
+        SlackUser.objects.create(user=user, slack_user_id="U000000000{0}".format(k))
+    SlackWorkspace.objects.create(roulette_channel="#coffee", bot_api_token="xoxb-test",
+                                  signing_secret=SIGNING_SECRET)
+    SlackRoulette.objects.create(roulette=roulette, thread_timestamp="1600000000.000100",
+                                 latest_response_timestamp="1600000000.000150", channel_id="C0000ROULETTE")
+    return roulette
+
+
+class FakeWebClient():
+    """
+    Answers the Slack Web API calls of BotClient like Slack would, for a workspace with the given members,
+    and records the calls: self.calls is a list of (method_name, kwargs).
+    """
+
+    def __init__(self, members):
+        self.members = members
+        self.calls = []
+
+    def users_list(self, limit, cursor=None):
+        self.calls.append(('users_list', {'limit': limit, 'cursor': cursor}))
+        start = int(cursor) if cursor else 0
+        next_cursor = str(start + limit) if start + limit < len(self.members) else ""
+        return {"ok": True, "members": self.members[start:start + limit],
+                "response_metadata": {"next_cursor": next_cursor}}
+
+    def users_info(self, user):
+        self.calls.append(('users_info', {'user': user}))
+        return {"ok": True, "user": {"id": user, "profile": {"email": user.lower() + "@new.example.com",
+                                                             "display_name": user, "real_name": user}}}
+
+    def conversations_open(self, users):
+        self.calls.append(('conversations_open', {'users': users}))
+        return {"ok": True, "channel": {"id": "D" + users}}
+
+    def chat_postMessage(self, channel, text, thread_ts=None):
+        self.calls.append(('chat_postMessage', {'channel': channel, 'text': text, 'thread_ts': thread_ts}))
+        return {"ok": True, "ts": "1600000000.000200", "channel": channel}
+
+    def call_count(self, method_name):
+        return len([call for call in self.calls if call[0] == method_name])
+
+
+class FakeSlackServer():
+    """
+    A local HTTP server that answers the Slack Web API calls like Slack would. Use it as a context manager,
+    and point BotClient at it with override_settings(SLACKBOT_API_URL=server.url).
+    Every call takes 'latency' seconds. Opening a conversation with any of 'failing_users' fails,
+    and so do posting on any of 'failing_channels' and all the calls of 'failing_methods'.
+    The first 'rate_limited_calls' calls are rejected with HTTP 429, asking to retry after 'retry_after' seconds.
+    'replies' are the messages on every thread, returned by conversations.replies.
+    The server closes every connection after 'requests_per_connection' requests (by default, never), without
+    telling the client, like a server closing idle keep-alive connections.
+    The calls are recorded in self.calls, as (method_name, params), the highest number of calls
+    handled at the same time in self.max_concurrent_calls, and the number of accepted connections
+    in self.connections.
+    """
+
+    def __init__(self, members=(), latency=0.0, failing_users=(), failing_methods=(), rate_limited_calls=0,
+                 retry_after=0, replies=(), requests_per_connection=None, failing_channels=()):
+        self.members = list(members)
+        self.replies = list(replies)
+        self.latency = latency
+        self.failing_users = set(failing_users)
+        self.failing_methods = set(failing_methods)
+        self.failing_channels = set(failing_channels)
+        self.rate_limited_calls = rate_limited_calls
+        self.retry_after = retry_after
+        self.requests_per_connection = requests_per_connection
+        self.calls = []
+        self.max_concurrent_calls = 0
+        self.connections = 0
+        self._concurrent_calls = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        fake_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                self.request_count = 0
+                with fake_server._lock:
+                    fake_server.connections += 1
+
+            def do_GET(self):
+                self._answer(dict(parse_qsl(urlparse(self.path).query)))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    self._answer(json.loads(body))
+                else:
+                    self._answer(dict(parse_qsl(body)))
+
+            def _answer(self, params):
+                method_name = urlparse(self.path).path.rsplit('/', 1)[-1]
+                status, headers, data = fake_server.call(method_name, params)
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                self.request_count += 1
+                if self.request_count == fake_server.requests_per_connection:
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = "http://127.0.0.1:{0}/api/".format(self._server.server_address[1])
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def call(self, method_name, params):
+        """ Handle one API call. Return (HTTP status, HTTP headers, JSON data). """
+        with self._lock:
+            self.calls.append((method_name, params))
+            if self.rate_limited_calls > 0:
+                self.rate_limited_calls -= 1
+                return 429, {'Retry-After': str(self.retry_after)}, {"ok": False, "error": "ratelimited"}
+            self._concurrent_calls += 1
+            self.max_concurrent_calls = max(self.max_concurrent_calls, self._concurrent_calls)
+        try:
+            time.sleep(self.latency)
+            return self.answer(method_name, params)
+        finally:
+            with self._lock:
+                self._concurrent_calls -= 1
+
+    def answer(self, method_name, params):
+        if method_name in self.failing_methods:
+            return 200, {}, {"ok": False, "error": "internal_error"}
+        if method_name == 'conversations.open':
+            user_ids = params['users'].split(',')
+            if self.failing_users.intersection(user_ids):
+                return 200, {}, {"ok": False, "error": "user_not_found"}
+            return 200, {}, {"ok": True, "channel": {"id": "D" + "".join(user_ids)}}
+        if method_name == 'chat.postMessage':
+            if params['channel'] in self.failing_channels:
+                return 200, {}, {"ok": False, "error": "channel_not_found"}
+            with self._lock:
+                ts = "1600000000.{0:06d}".format(len(self.calls))
+            return 200, {}, {"ok": True, "channel": params['channel'], "ts": ts}
+        if method_name == 'users.list':
+            start = int(params.get('cursor') or 0)
+            end = start + int(params['limit'])
+            return 200, {}, {"ok": True, "members": self.members[start:end],
+                             "response_metadata": {"next_cursor": str(end) if end < len(self.members) else ""}}
+        if method_name == 'users.info':
+            member = next((member for member in self.members if member["id"] == params['user']), None)
+            if member is None:
+                return 200, {}, {"ok": False, "error": "user_not_found"}
+            return 200, {}, {"ok": True, "user": member}
+        if method_name == 'conversations.replies':
+            # The parent message comes first on every page.
+            replies = [reply for reply in self.replies if float(reply["ts"]) > float(params.get('oldest', 0))]
+            start = int(params.get('cursor') or 0)
+            end = start + int(params.get('limit', 10))
+            parent = {"ts": params['ts'], "user": "UBOT", "bot_id": "B1", "text": "A new coffee roulette"}
+            return 200, {}, {"ok": True, "messages": [parent] + replies[start:end], "has_more": end < len(replies),
+                             "response_metadata": {"next_cursor": str(end) if end < len(replies) else ""}}
+        return 200, {}, {"ok": False, "error": "unknown_method"}
+
+    def call_count(self, method_name):
+        return len([call for call in self.calls if call[0] == method_name])
+
+
+def slack_member(slack_user_id, email, **kwargs):
+    member = {"id": slack_user_id, "profile": {"email": email, "display_name": slack_user_id, "real_name": email}}
+    member.update(kwargs)
+    return member
+
+
+@override_settings(SLACKBOT_DIRECTORY_PAGE_SIZE=2)
+class SlackDirectoryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [RouletteUser.objects.create(name=str(k), email="{0}@example.com".format(k)) for k in range(1, 6)]
+        # The roulette is created before the workspace, so that it isn't broadcast on Slack.
+        self.roulette = Roulette.objects.create(vote_deadline=timezone.now(), coffee_deadline=timezone.now())
+        SlackWorkspace.objects.create(roulette_channel="#coffee", bot_api_token="xoxb-test")
+        self.webclient = FakeWebClient([
+            slack_member("U1", "1@Example.com"),
+            slack_member("U2", "2@example.com"),
+            slack_member("U3", "3@example.com", deleted=True),
+            slack_member("UBOT", "4@example.com", is_bot=True),
+            slack_member("U5", "5@example.com"),
+            slack_member("U6", "somebody@example.com"),
+        ])
+
+    def bot_client(self):
+        client = BotClient()
+        client._webclient = self.webclient
+        return client
+
+    def test_sync_slack_users(self):
+        client = self.bot_client()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(3, client.sync_slack_users())
+        self.assertEqual(3, len(queries))
+        self.assertEqual({"1@example.com": "U1", "2@example.com": "U2", "5@example.com": "U5"},
+                         {slack_user.user.email: slack_user.slack_user_id for slack_user in SlackUser.objects.all()})
+        self.assertEqual(3, self.webclient.call_count('users_list'))
+        # The directory is cached, and the existing SlackUsers are kept.
+        self.assertEqual(0, self.bot_client().sync_slack_users())
+        self.assertEqual(3, self.webclient.call_count('users_list'))
+        self.assertEqual(0, self.bot_client().sync_slack_users(refresh=True))
+        self.assertEqual(6, self.webclient.call_count('users_list'))
+
+    def test_sync_only_given_users(self):
+        self.assertEqual(1, self.bot_client().sync_slack_users(self.users[:1]))
+        self.assertEqual(["U1"], list(SlackUser.objects.values_list('slack_user_id', flat=True)))
+
+    def test_correlation_is_a_lookup(self):
+        client = self.bot_client()
+        self.assertEqual("U2", client.corellate_slack_user_by_email(self.users[1]).slack_user_id)
+        self.assertEqual("somebody@example.com", client.get_or_corellate_slack_user("U6")["email"])
+        self.assertEqual("U1", client.get_or_corellate_slack_user("U1")["slack_id"])
+        self.assertEqual(0, self.webclient.call_count('users_info'))
+        self.assertEqual(3, self.webclient.call_count('users_list'))
+
+    def test_unknown_slack_users_are_added_to_directory(self):
+        client = self.bot_client()
+        self.assertIsNone(client.get_or_corellate_slack_user("UNEW")["database_slack_user_id"])
+        self.assertIsNone(self.bot_client().get_or_corellate_slack_user("UNEW")["database_slack_user_id"])
+        self.assertEqual(1, self.webclient.call_count('users_info'))
+        self.assertEqual("UNEW", client.get_directory()["emails"]["unew@new.example.com"])
+
+    def test_notify_matching_results(self):
+        groups = {"1": [self.users[0].id, self.users[1].id], "2": [self.users[2].id, self.users[4].id]}
+        errors = _notify_all_matching_results_(self.bot_client(), self.roulette, groups)
+        self.assertEqual([self.users[2].name], [user_name for user_name, _ in errors])
+        self.assertEqual(3, self.webclient.call_count('chat_postMessage'))
+        self.assertEqual(0, self.webclient.call_count('users_info'))
+
+
+class NotificationFanOutTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [RouletteUser.objects.create(name=str(k), email="{0}@example.com".format(k)) for k in range(1, 13)]
+        self.roulette = Roulette.objects.create(vote_deadline=timezone.now(), coffee_deadline=timezone.now())
+        SlackWorkspace.objects.create(roulette_channel="#coffee", bot_api_token="xoxb-test")
+        self.members = [slack_member("U{0}".format(user.name), user.email) for user in self.users]
+        self.groups = {str(k): [self.users[2 * k].id, self.users[2 * k + 1].id] for k in range(6)}
+
+    def bot_client(self):
+        # Every test gets its own rate limits.
+        return BotClient(scheduler=SlackRequestScheduler())
+
+    @override_settings(SLACKBOT_NOTIFICATION_CONCURRENCY=4)
+    def test_notifications_are_sent_concurrently(self):
+        with FakeSlackServer(self.members, latency=0.05) as server, override_settings(SLACKBOT_API_URL=server.url):
+            errors = _notify_all_matching_results_(self.bot_client(), self.roulette, self.groups)
+        self.assertEqual([], errors)
+        self.assertEqual(12, server.call_count('chat.postMessage'))
+        self.assertLessEqual(server.max_concurrent_calls, 4)
+        self.assertGreater(server.max_concurrent_calls, 1)
+        posted = {params['channel']: params['text'] for method_name, params in server.calls
+                  if method_name == 'chat.postMessage'}
+        self.assertIn("you got matched with 2.", posted["DU1"])
+
+    def test_errors_are_collected_per_user(self):
+        with FakeSlackServer(self.members, failing_users=["U3"]) as server, \
+                override_settings(SLACKBOT_API_URL=server.url):
+            errors = _notify_all_matching_results_(self.bot_client(), self.roulette, self.groups)
+            self.assertEqual(["3"], [user_name for user_name, _ in errors])
+            self.assertIn("Error happened while sending a notification to 3", errors[0][1])
+            self.assertIn("user_not_found", errors[0][1])
+            # The opened IM channels are saved, so they are not opened again.
+            self.assertEqual("DU1", SlackUser.objects.get(slack_user_id="U1").im_channel)
+            self.assertEqual("", SlackUser.objects.get(slack_user_id="U3").im_channel)
+            _notify_all_matching_results_(self.bot_client(), self.roulette, self.groups)
+        self.assertEqual(12 + 1, server.call_count('conversations.open'))
+
+
+    @override_settings(SLACKBOT_GROUP_NOTIFICATIONS=True)
+    def test_group_notifications(self):
+        groups = {"1": [user.id for user in self.users[0:3]], "2": [user.id for user in self.users[3:5]],
+                  "3": [user.id for user in self.users[5:7]]}
+        # User 7 is not on Slack, and the conversation with user 5 can't be opened.
+        members = [member for member in self.members if member["id"] != "U7"]
+        with FakeSlackServer(members, failing_users=["U5"]) as server, override_settings(SLACKBOT_API_URL=server.url):
+            errors = _notify_all_matching_results_(self.bot_client(), self.roulette, groups)
+        self.assertCountEqual(["4", "5", "7"], [user_name for user_name, _ in errors])
+        self.assertCountEqual(["U1,U2,U3", "U4,U5", "U6"],
+                              [params['users'] for method_name, params in server.calls
+                               if method_name == 'conversations.open'])
+        posted = {params['channel']: params['text'] for method_name, params in server.calls
+                  if method_name == 'chat.postMessage'}
+        self.assertEqual(2, len(posted))
+        self.assertIn("you got matched together: <@U1>, <@U2> and <@U3>.", posted["DU1U2U3"])
+        self.assertIn("you got matched together: <@U6> and 7.", posted["DU6"])
+
+    @override_settings(SLACKBOT_GROUP_NOTIFICATIONS=True)
+    def test_group_of_one_user_is_logged(self):
+        with FakeSlackServer(self.members) as server, override_settings(SLACKBOT_API_URL=server.url):
+            with self.assertLogs('slackbot.signals', 'WARNING'):
+                _notify_all_matching_results_(self.bot_client(), self.roulette, {"1": [self.users[0].id]})
+        self.assertEqual(0, server.call_count('chat.postMessage'))
+
+
+@override_settings(SLACKBOT_REPLIES_PAGE_SIZE=200)
+class FetchVotesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.roulette = create_slack_roulette()
+        # 50 users vote 20 times each, the last vote is YES for the even users and NO for the odd ones.
+        # Users 1 and 2 are on Slack already (see create_slack_roulette), the other ones are found by email.
+        users = [RouletteUser.objects.create(name=str(k), email="{0}@example.com".format(k)) for k in range(3, 51)]
+        self.members = [slack_member("U{0:010d}".format(k), "{0}@example.com".format(k)) for k in range(1, 51)]
+        self.members.append(slack_member("UNOBODY", "nobody@example.com"))
+        self.replies = []
+        for round in range(20):
+            for k in range(1, 51):
+                text = ("yes" if (k + round) % 2 == 0 else "no") if round < 19 else ("YES" if k % 2 == 0 else "no!")
+                self.replies.append({"ts": "1600000{0:03d}.{1:06d}".format(round + 1, k),
+                                     "user": "U{0:010d}".format(k), "text": text})
+        self.replies.append({"ts": "1600000999.000001", "user": "UNOBODY", "text": "yes"})
+        self.replies.append({"ts": "1600000999.000002", "user": "U0000000001", "text": "what's a roulette?"})
+
+    def fetch_votes(self, server):
+        with override_settings(SLACKBOT_API_URL=server.url):
+            client = BotClient(scheduler=SlackRequestScheduler())
+            slack_roulette = SlackRoulette.objects.get()
+            with CaptureQueriesContext(connection) as queries:
+                vote_list = client.fetch_votes(slack_roulette)
+        return vote_list, len(queries)
+
+    def test_fetch_votes_pages_with_cursor(self):
+        with FakeSlackServer(self.members, replies=self.replies) as server:
+            vote_list, _ = self.fetch_votes(server)
+        self.assertEqual(6, server.call_count('conversations.replies'))
+        cursors = [params.get('cursor') for method_name, params in server.calls
+                   if method_name == 'conversations.replies']
+        self.assertEqual([None, "200", "400", "600", "800", "1000"], cursors)
+        self.assertEqual("1600000999.000002", vote_list["last_message_timestamp"])
+        # Only the last vote of every user is kept.
+        self.assertEqual(50, len(vote_list["votes"]))
+        for vote in vote_list["votes"]:
+            user = RouletteUser.objects.get(pk=int(vote["roulette_user_id"]))
+            self.assertEqual(Vote.YES if int(user.name) % 2 == 0 else Vote.NO, vote["choice"])
+        self.assertCountEqual(["Could not correlate our data with Slack using email field.",
+                               "Could not parse user's message."],
+                              [message["reason"] for message in vote_list["unknown_messages"]])
+        self.assertEqual(50, SlackUser.objects.count())
+
+    def test_fetch_votes_queries(self):
+        with FakeSlackServer(self.members, replies=self.replies) as server:
+            self.fetch_votes(server)
+            # Now all the voters are known SlackUsers.
+            vote_list, query_count = self.fetch_votes(server)
+        self.assertLessEqual(query_count, 2)
+        self.assertEqual(1, server.call_count('users.list'))
+        self.assertEqual(0, server.call_count('users.info'))
+        self.assertEqual(50, len(vote_list["votes"]))
+
+
+    def test_fetch_votes_of_users_with_the_same_email(self):
+        first_twin = RouletteUser.objects.create(name="twin", email="twin@example.com")
+        RouletteUser.objects.create(name="Twin", email="TWIN@example.com")
+        members = [slack_member("UTWIN", "Twin@example.com")]
+        replies = [{"ts": "1600000001.000001", "user": "UTWIN", "text": "maybe"}]
+        with FakeSlackServer(members, replies=replies) as server:
+            vote_list, _ = self.fetch_votes(server)
+        slack_user = SlackUser.objects.get(slack_user_id="UTWIN")
+        self.assertEqual(first_twin, slack_user.user)
+        self.assertEqual([{"user": {"slack_id": "UTWIN", "database_slack_user_id": str(slack_user.pk),
+                                    "display_name": "twin", "real_name": None, "email": "twin@example.com"},
+                           "text": "maybe", "reason": "Could not parse user's message."}],
+                         vote_list["unknown_messages"])
+        self.assertEqual([], vote_list["votes"])
+
+    def test_fetched_votes_are_saved_in_bulk(self):
+        with FakeSlackServer(self.members, replies=self.replies) as server, \
+                override_settings(SLACKBOT_API_URL=server.url), CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('slackbot:fetch_votes', args=(self.roulette.id,)))
+        self.assertRedirects(response, reverse('slackbot:fetch_votes_success', args=(self.roulette.id,)),
+                             fetch_redirect_response=False)
+        vote_queries = [query for query in queries if 'matcher_vote' in query['sql']]
+        self.assertEqual(2, len(vote_queries))
+        self.assertIsInstance(self.client.session['slackbot_vote_fetch_id'], int)
+
+    def test_unseen_vote_fetches_expire(self):
+        old_fetch = SlackVoteFetch.objects.create(roulette=self.roulette)
+        recent_fetch = SlackVoteFetch.objects.create(roulette=self.roulette)
+        SlackVoteFetch.objects.filter(pk=old_fetch.pk).update(fetched_on=timezone.now() - timedelta(days=1))
+        with FakeSlackServer(self.members, replies=self.replies) as server, \
+                override_settings(SLACKBOT_API_URL=server.url):
+            self.client.post(reverse('slackbot:fetch_votes', args=(self.roulette.id,)))
+        self.assertFalse(SlackVoteFetch.objects.filter(pk=old_fetch.pk).exists())
+        self.assertTrue(SlackVoteFetch.objects.filter(pk=recent_fetch.pk).exists())
+        self.assertEqual(2, SlackVoteFetch.objects.count())
+        self.assertEqual(25, Vote.objects.filter(roulette=self.roulette, choice=Vote.YES).count())
+        self.assertEqual(25, Vote.objects.filter(roulette=self.roulette, choice=Vote.NO).count())
+        self.assertEqual("1600000999.000002", SlackRoulette.objects.get().latest_response_timestamp)
+
+        response = self.client.get(reverse('slackbot:fetch_votes_success', args=(self.roulette.id,)))
+        self.assertEqual(50, len(response.context['vote_list']['votes']))
+        self.assertEqual(2, len(response.context['vote_list']['unknown_messages']))
+        # The result is shown only once.
+        response = self.client.get(reverse('slackbot:fetch_votes_success', args=(self.roulette.id,)))
+        self.assertRedirects(response, reverse('slackbot:fetch_votes_failure', args=(self.roulette.id, 'no_vote_list')))
+
+
+class FakeClock():
+    """ A clock for the rate limit tests: sleeping only moves the time forward. """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class RateLimitTests(TestCase):
+
+    def test_token_bucket(self):
+        fake_clock = FakeClock()
+        bucket = TokenBucket(60, capacity=2, clock=fake_clock.clock, sleep=fake_clock.sleep)
+        self.assertEqual([0.0, 0.0], [bucket.acquire(), bucket.acquire()])
+        self.assertAlmostEqual(1.0, bucket.acquire())
+        fake_clock.now += 10.0
+        self.assertEqual([0.0, 0.0], [bucket.acquire(), bucket.acquire()])
+        bucket.block(5.0)
+        self.assertAlmostEqual(5.0, bucket.acquire())
+
+    def test_rate_limited_calls_are_retried_after_the_requested_time(self):
+        fake_clock = FakeClock()
+        scheduler = SlackRequestScheduler({'tier3': 50}, max_retries=2, clock=fake_clock.clock,
+                                          sleep=fake_clock.sleep)
+        responses = [429, 429, 200]
+
+        def conversations_open(users):
+            status_code = responses.pop(0)
+            if status_code == 429:
+                response = type('Response', (), {'status_code': 429, 'headers': {'Retry-After': '7'}})
+                raise SlackApiError("The request to the Slack API failed.", response)
+            return {"ok": True, "channel": {"id": "D" + users}}
+
+        self.assertEqual("DU1", scheduler.call('conversations.open', conversations_open, users="U1")["channel"]["id"])
+        self.assertEqual([7.0, 7.0], fake_clock.sleeps)
+        self.assertEqual({'calls': 3, 'retries': 2, 'total_delay_s': 14.0, 'max_delay_s': 7.0},
+                         scheduler.metrics()['conversations.open'])
+        responses.extend([429, 429, 429])
+        with self.assertRaises(SlackApiError):
+            scheduler.call('conversations.open', conversations_open, users="U1")
+
+    def test_fan_out_survives_rate_limiting(self):
+        cache.clear()
+        users = [RouletteUser.objects.create(name=str(k), email="{0}@example.com".format(k)) for k in range(1, 5)]
+        roulette = Roulette.objects.create(vote_deadline=timezone.now(), coffee_deadline=timezone.now())
+        SlackWorkspace.objects.create(roulette_channel="#coffee", bot_api_token="xoxb-test")
+        for user in users:
+            SlackUser.objects.create(user=user, slack_user_id="U" + user.name, im_channel="DU" + user.name)
+        scheduler = SlackRequestScheduler()
+        with FakeSlackServer(rate_limited_calls=3) as server, override_settings(SLACKBOT_API_URL=server.url):
+            errors = _notify_all_matching_results_(BotClient(scheduler=scheduler), roulette,
+                                                   {"1": [users[0].id, users[1].id], "2": [users[2].id, users[3].id]})
+        self.assertEqual([], errors)
+        self.assertEqual(4 + 3, server.call_count('chat.postMessage'))
+        self.assertEqual(3, scheduler.metrics()['chat.postMessage']['retries'])
+
+
+    def test_settings_page_shows_metrics(self):
+        get_scheduler().call('users.list', lambda: {"ok": True})
+        response = self.client.get(reverse('slackbot:settings'))
+        self.assertIn('users.list', dict(response.context['api_metrics']))
+
+
+class SlackOutboxTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [RouletteUser.objects.create(name=str(k), email="{0}@example.com".format(k)) for k in range(1, 5)]
+        for user in self.users:
+            SlackUser.objects.create(user=user, slack_user_id="U" + user.name, im_channel="DU" + user.name)
+        SlackWorkspace.objects.create(roulette_channel="C0000ROULETTE", bot_api_token="xoxb-test")
+
+    def create_roulette(self):
+        return Roulette.objects.create(vote_deadline=timezone.now() - timedelta(days=1),
+                                       coffee_deadline=timezone.now() + timedelta(days=7))
+
+    def test_new_roulette_is_queued_and_sent(self):
+        with FakeSlackServer() as server, override_settings(SLACKBOT_API_URL=server.url):
+            roulette = self.create_roulette()
+            roulette.save()
+            self.assertEqual([], server.calls)
+            message = SlackOutboxMessage.objects.get()
+            self.assertEqual(SlackOutboxMessage.NEW_ROULETTE, message.kind)
+            self.assertEqual(1, process_outbox())
+            self.assertEqual(0, process_outbox())
+        self.assertEqual(2, server.call_count('chat.postMessage'))
+        slack_roulette = SlackRoulette.objects.get(roulette=roulette)
+        self.assertEqual("C0000ROULETTE", slack_roulette.channel_id)
+        self.assertNotEqual(slack_roulette.thread_timestamp, slack_roulette.latest_response_timestamp)
+        message.refresh_from_db()
+        self.assertEqual(SlackOutboxMessage.SENT, message.status)
+
+    def test_failed_messages_are_retried(self):
+        with FakeSlackServer(failing_methods=['chat.postMessage']) as server, \
+                override_settings(SLACKBOT_API_URL=server.url):
+            roulette = self.create_roulette()
+            with self.assertLogs('slackbot.outbox', 'ERROR'):
+                self.assertEqual(1, process_outbox())
+            message = SlackOutboxMessage.objects.get()
+            self.assertEqual((SlackOutboxMessage.PENDING, 1), (message.status, message.attempts))
+            self.assertIn("internal_error", message.last_error)
+            self.assertGreater(message.next_attempt_on, timezone.now())
+            self.assertEqual(0, process_outbox())
+
+            server.failing_methods.clear()
+            SlackOutboxMessage.objects.update(next_attempt_on=timezone.now())
+            self.assertEqual(1, process_outbox())
+        message.refresh_from_db()
+        self.assertEqual((SlackOutboxMessage.SENT, 2), (message.status, message.attempts))
+        self.assertTrue(SlackRoulette.objects.filter(roulette=roulette).exists())
+
+    @override_settings(SLACKBOT_OUTBOX_MAX_ATTEMPTS=1)
+    def test_messages_fail_after_max_attempts(self):
+        with FakeSlackServer(failing_methods=['chat.postMessage']) as server, \
+                override_settings(SLACKBOT_API_URL=server.url):
+            self.create_roulette()
+            with self.assertLogs('slackbot.outbox', 'ERROR'):
+                process_outbox()
+        self.assertEqual(SlackOutboxMessage.FAILED, SlackOutboxMessage.objects.get().status)
+
+    def test_matching_results_are_sent_after_submit(self):
+        with FakeSlackServer() as server, override_settings(SLACKBOT_API_URL=server.url):
+            roulette = self.create_roulette()
+            process_outbox()
+            roulette.vote_set.update(choice=Vote.YES)
+            candidate = MatchingCandidate.objects.create(
+                roulette=roulette, total_penalty=0.0, quality=[],
+                groups=[[self.users[0].id, self.users[1].id], [self.users[2].id, self.users[3].id]])
+            call_count = len(server.calls)
+            self.client.post(reverse('matcher:submit', args=(roulette.id,)), {'candidate': candidate.id})
+            self.assertEqual(call_count, len(server.calls))
+            self.assertEqual(1, process_outbox())
+        posted_channels = [params['channel'] for method_name, params in server.calls[call_count:]
+                           if method_name == 'chat.postMessage']
+        self.assertCountEqual(["DU1", "DU2", "DU3", "DU4", "C0000ROULETTE"], posted_channels)
+        self.assertEqual(SlackOutboxMessage.SENT,
+                         SlackOutboxMessage.objects.get(kind=SlackOutboxMessage.MATCHING_RESULTS).status)
+
+    def test_failed_admin_notification_doesnt_notify_users_again(self):
+        # User 5 isn't on Slack, so the admin is told about it - but that message fails.
+        self.users.append(RouletteUser.objects.create(name="5", email="5@example.com"))
+        admin = auth.models.User.objects.create(username="admin")
+        SlackAdminUser.objects.create(user=admin, slack_user_id="UADMIN", im_channel="DUADMIN")
+        with FakeSlackServer(failing_channels=["DUADMIN"]) as server, override_settings(SLACKBOT_API_URL=server.url):
+            roulette = self.create_roulette()
+            process_outbox()
+            post_matching.send(sender=Roulette, instance=roulette, groups={
+                "1": [self.users[0].id, self.users[1].id], "2": [user.id for user in self.users[2:5]]})
+            with self.assertLogs('slackbot.signals', 'ERROR'):
+                self.assertEqual(1, process_outbox())
+            server.failing_channels.clear()
+            SlackOutboxMessage.objects.update(next_attempt_on=timezone.now())
+            self.assertEqual(0, process_outbox())
+        posted_channels = [params['channel'] for method_name, params in server.calls
+                           if method_name == 'chat.postMessage']
+        for channel in ["DU1", "DU2", "DU3", "DU4", "DUADMIN"]:
+            self.assertEqual(1, posted_channels.count(channel))
+        self.assertEqual(SlackOutboxMessage.SENT,
+                         SlackOutboxMessage.objects.get(kind=SlackOutboxMessage.MATCHING_RESULTS).status)
+
+
+class SharedWebClientTests(TransactionTestCase):
+    # Not a TestCase: the workspace isn't cached inside a transaction.
+
+    def setUp(self):
+        cache.clear()
+        close_webclients()
+        self.users = [RouletteUser.objects.create(name=str(k), email="{0}@example.com".format(k)) for k in range(1, 9)]
+        for user in self.users:
+            SlackUser.objects.create(user=user, slack_user_id="U" + user.name)
+        SlackWorkspace.objects.create(roulette_channel="C0000ROULETTE", bot_api_token="xoxb-test")
+
+    def tearDown(self):
+        close_webclients()
+
+    def bot_client(self):
+        # Every test gets its own rate limits.
+        return BotClient(scheduler=SlackRequestScheduler())
+
+    def test_calls_reuse_one_connection(self):
+        with FakeSlackServer() as server, override_settings(SLACKBOT_API_URL=server.url):
+            for k in range(10):
+                self.bot_client().post_on_roulette_channel("Message {0}".format(k))
+            pool_stats = get_webclient("xoxb-test").pool.stats()
+        self.assertEqual(10, server.call_count('chat.postMessage'))
+        self.assertEqual(1, server.connections)
+        self.assertEqual({'requests': 10, 'connections_opened': 1}, pool_stats)
+
+    @override_settings(SLACKBOT_NOTIFICATION_CONCURRENCY=4)
+    def test_concurrent_calls_share_the_pool(self):
+        slack_users = list(SlackUser.objects.all())
+        with FakeSlackServer(latency=0.02) as server, override_settings(SLACKBOT_API_URL=server.url):
+            self.assertEqual([None] * 8, self.bot_client().post_ims([(slack_user, "Hi") for slack_user in slack_users]))
+            connections = server.connections
+            self.assertEqual([None] * 8, self.bot_client().post_ims([(slack_user, "Hi") for slack_user in slack_users]))
+        self.assertEqual(8 + 16, len(server.calls))
+        self.assertGreater(connections, 1)
+        self.assertLessEqual(connections, 4)
+        # The connections of the first notifications are reused by the next ones.
+        self.assertEqual(connections, server.connections)
+
+    def test_reconnects_when_the_server_closes_the_connection(self):
+        with FakeSlackServer(requests_per_connection=2) as server, override_settings(SLACKBOT_API_URL=server.url):
+            for k in range(5):
+                self.bot_client().post_on_roulette_channel("Message {0}".format(k))
+        self.assertEqual(5, server.call_count('chat.postMessage'))
+        self.assertEqual(3, server.connections)
+
+    def test_workspace_is_cached(self):
+        with FakeSlackServer() as server, override_settings(SLACKBOT_API_URL=server.url):
+            client = self.bot_client()
+            with CaptureQueriesContext(connection) as queries:
+                other_client = self.bot_client()
+            self.assertEqual(0, len(queries))
+            self.assertIs(client._webclient._webclient, other_client._webclient._webclient)
+
+            # Saving the workspace invalidates the cache.
+            SlackWorkspace.objects.create(roulette_channel="C0000OTHER", bot_api_token="xoxb-other")
+            client = self.bot_client()
+            self.assertEqual("xoxb-other", client._webclient._webclient.token)
+            self.assertEqual(("1600000000.000001", "C0000OTHER"), client.post_on_roulette_channel("Hello"))
+            SlackWorkspace.objects.all().delete()
+            self.assertIsNone(get_workspace())
+
+
+class EventsApiTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.roulette = create_slack_roulette()
+
+    def replay(self, payload_file, signing_secret=SIGNING_SECRET, timestamp=None):
+        """ Send a recorded event payload to the events endpoint, signed like Slack does. """
+        with open(os.path.join(EVENTS_DIR, payload_file), 'rb') as file:
+            body = file.read()
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        return self.client.post(reverse('slackbot:events'), body, content_type='application/json',
+                                HTTP_X_SLACK_REQUEST_TIMESTAMP=str(timestamp),
+                                HTTP_X_SLACK_SIGNATURE=sign_request(signing_secret, timestamp, body))
+
+    def vote_of(self, slack_user_id):
+        return Vote.objects.get(roulette=self.roulette, user__slackuser__slack_user_id=slack_user_id).choice
+
+    def test_url_verification(self):
+        response = self.replay('url_verification.json')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("3eZbrw1aBm2rZgRNFdxV2595E9CY3gmdALWMmHkvFXO7tYXAYM8P", response.json()['challenge'])
+
+    def test_unsigned_requests_are_rejected(self):
+        self.assertEqual(403, self.replay('vote_yes.json', signing_secret='wrong').status_code)
+        self.assertEqual(403, self.replay('vote_yes.json', timestamp=int(time.time()) - 3600).status_code)
+        self.assertEqual(403, self.client.post(reverse('slackbot:events'), '{}',
+                                               content_type='application/json').status_code)
+        SlackWorkspace.objects.update(signing_secret="")
+        self.assertEqual(403, self.replay('vote_yes.json', signing_secret="").status_code)
+        self.assertEqual(Vote.NO_CHOICE_YET, self.vote_of("U0000000001"))
+
+    def test_vote_is_saved(self):
+        self.assertEqual(200, self.replay('vote_yes.json').status_code)
+        self.assertEqual(Vote.YES, self.vote_of("U0000000001"))
+        self.assertEqual(Vote.NO_CHOICE_YET, self.vote_of("U0000000002"))
+        self.replay('vote_no.json')
+        self.assertEqual(Vote.NO, self.vote_of("U0000000001"))
+
+    def test_events_are_idempotent(self):
+        self.replay('vote_no.json')
+        # A retried delivery, and an older message delivered late, don't change the vote.
+        self.replay('vote_no.json')
+        self.replay('vote_yes.json')
+        self.assertEqual(Vote.NO, self.vote_of("U0000000001"))
+        self.assertEqual(1, SlackVoteMessage.objects.count())
+        self.assertEqual(1, Vote.objects.filter(roulette=self.roulette, user__slackuser__slack_user_id="U0000000001")
+                         .count())
+
+    def test_other_messages_are_ignored(self):
+        for payload_file in ('not_a_vote.json', 'other_thread.json', 'message_changed.json'):
+            self.assertEqual(200, self.replay(payload_file).status_code)
+        self.assertEqual(Vote.NO_CHOICE_YET, self.vote_of("U0000000001"))
+        self.assertEqual(Vote.NO_CHOICE_YET, self.vote_of("U0000000002"))
+
+    def test_thread_broadcast_is_a_vote(self):
+        # A reply that is also sent to the channel counts, as when the votes are downloaded from the thread.
+        self.assertEqual(200, self.replay('thread_broadcast.json').status_code)
+        self.assertEqual(Vote.YES, self.vote_of("U0000000002"))
+
+    def test_unknown_user_vote_is_queued(self):
+        user = RouletteUser.objects.create(name="3", email="3@example.com")
+        members = [slack_member("U0000000003", "3@example.com")]
+        with FakeSlackServer(members) as server, override_settings(SLACKBOT_API_URL=server.url):
+            # The Slack API isn't called before the event is answered.
+            self.assertEqual(200, self.replay('vote_unknown_user.json').status_code)
+            self.replay('vote_unknown_user.json')
+            self.assertEqual([], server.calls)
+            self.assertEqual(SlackOutboxMessage.VOTE_EVENT, SlackOutboxMessage.objects.get().kind)
+            self.assertEqual(1, process_outbox())
+        self.assertEqual(Vote.YES, Vote.objects.get(roulette=self.roulette, user=user).choice)
+        self.assertEqual("U0000000003", user.slackuser.slack_user_id)
+
+    def test_unknown_user_in_cached_directory_votes_right_away(self):
+        user = RouletteUser.objects.create(name="3", email="3@example.com")
+        with FakeSlackServer([slack_member("U0000000003", "3@example.com")]) as server, \
+                override_settings(SLACKBOT_API_URL=server.url):
+            BotClient().get_directory()
+            self.replay('vote_unknown_user.json')
+        self.assertEqual(1, len(server.calls))
+        self.assertEqual(Vote.YES, Vote.objects.get(roulette=self.roulette, user=user).choice)
+        self.assertFalse(SlackOutboxMessage.objects.exists())
+
+    def test_votes_cannot_be_changed_after_matching(self):
+        Roulette.objects.filter(pk=self.roulette.pk).update(matchings_found_on=timezone.now())
+        self.replay('vote_yes.json')
+        self.assertEqual(Vote.NO_CHOICE_YET, self.vote_of("U0000000001"))
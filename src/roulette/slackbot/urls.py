@@ -15,4 +15,5 @@ urlpatterns = [
          views.fetch_votes_success, name='fetch_votes_success'),
     path('fetch_votes/<int:roulette_id>/failure/<slug:failure_type>',
          views.fetch_votes_failure, name='fetch_votes_failure'),
+    path('events', views.events, name='events'),
 ]
@@ -1,13 +1,18 @@
+import json
 from django.conf import settings as django_settings
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import HttpResponseRedirect, HttpResponse
+from django.db import transaction
+from django.http import HttpResponseBadRequest, HttpResponseForbidden, HttpResponseRedirect, HttpResponse, JsonResponse
 from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 from django.urls import reverse
 
+from .events import handle_event_payload, is_request_signed
 from .exceptions import NoWorkspaceError, SlackbotError
-from .models import SlackAdminUser, SlackRoulette, SlackWorkspace
-from matcher.models import Vote, Roulette, RouletteUser
+from .ratelimit import get_scheduler
+from .models import SlackAdminUser, SlackRoulette, SlackVoteFetch, SlackWorkspace, get_workspace
+from matcher.models import Vote, Roulette, RouletteUser, update_votes
 from .webapi import BotClient
 
 
@@ -15,7 +20,8 @@ def settings(request):
     slack_workspace = None
     if SlackWorkspace.objects.exists():
         slack_workspace = SlackWorkspace.objects.get()
-    return render(request, 'slackbot/settings.html', {'slack_workspace': slack_workspace})
+    return render(request, 'slackbot/settings.html', {'slack_workspace': slack_workspace,
+                                                      'api_metrics': sorted(get_scheduler().metrics().items())})
 
 
 @require_POST
@@ -54,7 +60,20 @@ def fetch_votes(request, roulette_id):
             raise Exception()
         slack_roulette = SlackRoulette.objects.get(roulette=int(roulette_id))
         vote_list = BotClient().fetch_votes(slack_roulette)
-        request.session['slackbot_vote_list'] = vote_list
+        with transaction.atomic():
+            # The matches could have been generated while the votes were being downloaded.
+            if not Roulette.objects.select_for_update().get(pk=roulette.pk).canVotesBeChanged():
+                failure_type = 'too_late_for_changing_votes'
+                raise Exception()
+            changed_votes = update_votes(roulette.pk, {int(vote["roulette_user_id"]): vote["choice"]
+                                                       for vote in vote_list["votes"]})
+            SlackRoulette.objects.filter(pk=slack_roulette.pk).update(
+                latest_response_timestamp=vote_list["last_message_timestamp"])
+            SlackVoteFetch.delete_expired()
+            vote_fetch = SlackVoteFetch.objects.create(roulette=roulette,
+                                                       vote_ids=[vote.pk for vote in changed_votes],
+                                                       unknown_messages=vote_list["unknown_messages"])
+        request.session['slackbot_vote_fetch_id'] = vote_fetch.pk
         return HttpResponseRedirect(reverse('slackbot:fetch_votes_success', args=[roulette_id]))
     except SlackRoulette.DoesNotExist:
         failure_type = 'no_slack_thread'
@@ -66,23 +85,35 @@ def fetch_votes(request, roulette_id):
 
 
 def fetch_votes_success(request, roulette_id):
-    vote_list = request.session.get('slackbot_vote_list', None)
-    if vote_list is None:
+    vote_fetch_id = request.session.pop('slackbot_vote_fetch_id', None)
+    vote_fetch = SlackVoteFetch.objects.filter(pk=vote_fetch_id, roulette=roulette_id).first()
+    if vote_fetch is None:
         return HttpResponseRedirect(reverse('slackbot:fetch_votes_failure', args=[roulette_id, 'no_vote_list']))
-    del request.session['slackbot_vote_list']
-    vote_instances = []
-    for vote_dict in vote_list["votes"]:
-        vote, _ = Vote.objects.update_or_create(
-            roulette=int(vote_dict["roulette_id"]),
-            user=int(vote_dict["roulette_user_id"]),
-            defaults={"choice": vote_dict["choice"]}
-        )
-        vote_instances.append(vote)
-    vote_list["votes"] = vote_instances
-    SlackRoulette.objects.filter(roulette=roulette_id).update(
-        latest_response_timestamp=vote_list["last_message_timestamp"])
+    # The result is shown only once, like the messages of the admin site.
+    vote_fetch.delete()
+    vote_list = {
+        "votes": Vote.objects.filter(pk__in=vote_fetch.vote_ids).select_related('user').order_by('user__name'),
+        "unknown_messages": vote_fetch.unknown_messages,
+    }
     return render(request, 'slackbot/fetch_votes/success.html', {'roulette_id': roulette_id, 'vote_list': vote_list})
 
 
 def fetch_votes_failure(request, roulette_id, failure_type):
     return render(request, 'slackbot/fetch_votes/failure.html', {'roulette_id': roulette_id, 'failure_type': failure_type})
+
+
+@csrf_exempt
+@require_POST
+def events(request):
+    """ The Request URL of the Slack Events API. Slack signs the requests with the app's signing secret. """
+    slack_workspace = get_workspace()
+    if slack_workspace is None or not is_request_signed(slack_workspace.signing_secret, request.body, request.headers):
+        return HttpResponseForbidden()
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest()
+    response_data = handle_event_payload(payload)
+    if response_data is None:
+        return HttpResponse()
+    return JsonResponse(response_data)
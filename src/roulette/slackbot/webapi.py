@@ -1,12 +1,32 @@
 import re
-import slack
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db.models.functions import Lower
 from .exceptions import NoWorkspaceError, SlackbotError
-from .models import SlackAdminUser, SlackUser, SlackWorkspace
-from matcher.models import RouletteUser
+from .models import SlackAdminUser, SlackUser, get_workspace
+from .ratelimit import ScheduledWebClient, get_scheduler
+from .webclient import get_webclient
+from matcher.models import RouletteUser, Vote
 from decimal import Decimal
 
+SLACK_DIRECTORY_CACHE_KEY = 'slackbot.directory'
+
+
+def parse_vote_choice(message_text):
+    """
+    Parse a message, which is supposed to be a vote: YES or NO, the case and punctuation are ignored.
+    Return matcher.models.Vote.YES or Vote.NO, or None if the parsing failed.
+    """
+    stripped_message = re.sub('[ \t\n\r.!]', '', message_text).lower()
+    if stripped_message == "yes":
+        return Vote.YES
+    elif stripped_message == "no":
+        return Vote.NO
+    return None
+
 
 class BotClient():
     """
@@ -15,13 +35,34 @@ class BotClient():
     _webclient = None
     _slack_workspace = None
 
-    def __init__(self):
-        try:
-            self._slack_workspace = SlackWorkspace.objects.get()
-            self._webclient = slack.WebClient(
-                token=self._slack_workspace.bot_api_token)
-        except SlackWorkspace.DoesNotExist:
+    def __init__(self, scheduler=None):
+        """
+        All the Slack API calls go through the scheduler (a slackbot.ratelimit.SlackRequestScheduler),
+        by default the one shared by the whole process. The workspace is cached, and the WebClient with its
+        keep-alive connections is shared by the whole process too (see slackbot.webclient), so creating a BotClient
+        is cheap.
+        """
+        self._slack_workspace = get_workspace()
+        if self._slack_workspace is None:
             raise NoWorkspaceError()
+        self._webclient = ScheduledWebClient(get_webclient(self._slack_workspace.bot_api_token),
+                                             scheduler if scheduler is not None else get_scheduler())
+
+    def _open_im_channel(self, slack_user):
+        """
+        Opens a direct channel between slackbot and slack_user, unless it has been opened before.
+        slack_user can be either a SlackUser or SlackAdminUser instance. It isn't modified, so this can be called
+        from any thread.
+        Returns the string identifying the channel.
+        """
+        if len(slack_user.im_channel) > 0:
+            return slack_user.im_channel
+        response = self._webclient.conversations_open(
+            users=str(slack_user.slack_user_id))
+        if not response["ok"]:
+            raise SlackbotError("Could not open Slack private conversation channel with user {0}: {1}".format(
+                slack_user.slack_user_id, response["error"]))
+        return response["channel"]["id"]
 
     def _open_im_channel_if_not_opened(self, slack_user):
         """
@@ -30,26 +71,95 @@ class BotClient():
         Returns the string identifying new channel.
         """
         if len(slack_user.im_channel) == 0:
-            response = self._webclient.conversations_open(
-                users=str(slack_user.slack_user_id))
-            if not response["ok"]:
-                raise SlackbotError("Could not open Slack private conversation channel with user {0}: {1}".format(
-                    slack_user.slack_user_id, response["error"]))
-            slack_user.im_channel = response["channel"]["id"]
+            slack_user.im_channel = self._open_im_channel(slack_user)
             slack_user.save()
         return slack_user.im_channel
 
+    def _send_im(self, slack_user, text):
+        """
+        Send an instant message to one slack user, without saving anything in the database.
+        Return the ID of the IM channel, throw on error.
+        """
+        channel = self._open_im_channel(slack_user)
+        response = self._webclient.chat_postMessage(channel=channel, text=text)
+        if not response["ok"]:
+            raise SlackbotError("Could not send Slack IM message to user {0}: {1}".format(
+                slack_user.slack_user_id, response["error"]))
+        return channel
+
     def post_im(self, slack_user, text):
         """
         Send an instant message to one slack user.
         slack_user can be either a SlackUser or SlackAdminUser instance.
         Return nothing, throw on error.
         """
-        channel = self._open_im_channel_if_not_opened(slack_user)
+        self._open_im_channel_if_not_opened(slack_user)
+        self._send_im(slack_user, text)
+
+    def _run_concurrently(self, function, arguments):
+        """
+        Call function(*args) for every args in arguments, in up to settings.SLACKBOT_NOTIFICATION_CONCURRENCY threads.
+        Return a list of futures, in the order of arguments.
+        """
+        if len(arguments) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=settings.SLACKBOT_NOTIFICATION_CONCURRENCY) as executor:
+            return [executor.submit(function, *args) for args in arguments]
+
+    def post_ims(self, messages):
+        """
+        Send many instant messages concurrently, in up to settings.SLACKBOT_NOTIFICATION_CONCURRENCY threads.
+        'messages' is a list of pairs (slack_user, text), where slack_user is a SlackUser or SlackAdminUser instance.
+        Return a list with the exception that was raised while sending each message, or None if it was sent.
+        The IM channels opened on the way are saved in bulk.
+        """
+        futures = self._run_concurrently(self._send_im, messages)
+        errors = []
+        opened_channels = {}
+        for (slack_user, _), future in zip(messages, futures):
+            errors.append(future.exception())
+            if errors[-1] is not None:
+                continue
+            channel = future.result()
+            if slack_user.im_channel != channel:
+                slack_user.im_channel = channel
+                opened_channels.setdefault(
+                    type(slack_user), []).append(slack_user)
+        for model, slack_users in opened_channels.items():
+            model.objects.bulk_update(slack_users, ['im_channel'])
+        return errors
+
+    def _send_group_message(self, slack_users, text):
+        """
+        Open a multi-person conversation of the bot with all slack_users, and post the message there.
+        Throw on error.
+        """
+        slack_user_ids = [str(slack_user.slack_user_id)
+                          for slack_user in slack_users]
+        response = self._webclient.conversations_open(
+            users=",".join(slack_user_ids))
+        if not response["ok"]:
+            raise SlackbotError("Could not open Slack conversation with users {0}: {1}".format(
+                ", ".join(slack_user_ids), response["error"]))
+        channel = response["channel"]["id"]
         response = self._webclient.chat_postMessage(channel=channel, text=text)
         if not response["ok"]:
-            raise SlackbotError("Could not send Slack IM message to user {0}: {1}".format(
-                slack_user.slack_user.id, response["error"]))
+            raise SlackbotError("Could not send Slack message to users {0}: {1}".format(
+                ", ".join(slack_user_ids), response["error"]))
+
+    def post_group_messages(self, messages):
+        """
+        Send messages to groups of slack users concurrently, one multi-person conversation per group.
+        'messages' is a list of pairs (slack_users, text), where slack_users is a list of SlackUser instances.
+        A 'group' of one user gets an instant message.
+        Return a list with the exception that was raised while sending each message, or None if it was sent.
+        """
+        group_messages = [(slack_users, text) for slack_users, text in messages if len(slack_users) > 1]
+        futures = iter(self._run_concurrently(self._send_group_message, group_messages))
+        im_errors = iter(self.post_ims([(slack_users[0], text)
+                                        for slack_users, text in messages if len(slack_users) == 1]))
+        return [next(futures).exception() if len(slack_users) > 1 else next(im_errors)
+                for slack_users, _ in messages]
 
     def post_im_to_all_admins(self, text):
         """
@@ -104,17 +214,99 @@ class BotClient():
         """
         return {
             "slack_id": slack_user.slack_user_id,
-            "database_slack_user_id": str(slack_user.pk),
+            "database_slack_user_id": str(slack_user.pk) if slack_user.pk is not None else None,
             "display_name": slack_user.user.name,
             "real_name": None,
             "email": slack_user.user.email
         }
 
+    def _load_directory(self):
+        """
+        Page through users.list and return the directory of the Slack workspace:
+        {
+            "loaded_on": 1600000000.0,
+            "emails": {"john.smith@example.com": "U12345"},
+            "profiles": {"U12345": {"display_name": "johnny", "real_name": "John Smith", "email": "john.smith@example.com"}}
+        }
+        The emails are lowercase. Bots and deactivated users are skipped.
+        """
+        directory = {"loaded_on": time.time(), "emails": {}, "profiles": {}}
+        cursor = None
+        while True:
+            response = self._webclient.users_list(
+                limit=settings.SLACKBOT_DIRECTORY_PAGE_SIZE, cursor=cursor)
+            if not response["ok"]:
+                raise SlackbotError(
+                    "Could not fetch the list of Slack users: {0}".format(response["error"]))
+            for member in response["members"]:
+                if member.get("deleted") or member.get("is_bot") or member["id"] == "USLACKBOT":
+                    continue
+                self._add_to_directory(directory, member["id"], member["profile"])
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not cursor:
+                return directory
+
+    def _add_to_directory(self, directory, slack_user_id, profile):
+        email = profile.get("email")
+        directory["profiles"][slack_user_id] = {
+            "display_name": profile.get("display_name"),
+            "real_name": profile.get("real_name"),
+            "email": email
+        }
+        if email:
+            directory["emails"][email.lower()] = slack_user_id
+
+    def _store_directory(self, directory):
+        """ Cache the directory until SLACKBOT_DIRECTORY_CACHE_SECONDS have passed since it was loaded. """
+        timeout = directory["loaded_on"] + \
+            settings.SLACKBOT_DIRECTORY_CACHE_SECONDS - time.time()
+        if timeout > 0:
+            cache.set(SLACK_DIRECTORY_CACHE_KEY, directory, timeout)
+
+    def get_directory(self, refresh=False):
+        """
+        Return the directory of the Slack workspace (see _load_directory), cached in the Django cache
+        for settings.SLACKBOT_DIRECTORY_CACHE_SECONDS. If refresh is True, it's loaded from Slack anyway.
+        """
+        directory = None if refresh else cache.get(SLACK_DIRECTORY_CACHE_KEY)
+        if directory is None:
+            directory = self._load_directory()
+            self._store_directory(directory)
+        return directory
+
+    def sync_slack_users(self, roulette_users=None, refresh=False):
+        """
+        Create the missing SlackUser instances of roulette_users (by default, all RouletteUsers), correlating them
+        with Slack users by email, using the directory. The SlackUsers are created in bulk.
+        Return the number of created SlackUsers.
+        """
+        users_without_slack_user = RouletteUser.objects.filter(slackuser=None)
+        if roulette_users is not None:
+            users_without_slack_user = users_without_slack_user.filter(
+                pk__in=[user.pk for user in roulette_users])
+        users_without_slack_user = list(users_without_slack_user)
+        if len(users_without_slack_user) == 0 and not refresh:
+            return 0
+        emails = self.get_directory(refresh)["emails"]
+        taken_slack_user_ids = set(
+            SlackUser.objects.values_list('slack_user_id', flat=True))
+        new_slack_users = []
+        for roulette_user in users_without_slack_user:
+            slack_user_id = emails.get(roulette_user.email.lower())
+            if slack_user_id is not None and slack_user_id not in taken_slack_user_ids:
+                new_slack_users.append(
+                    SlackUser(user=roulette_user, slack_user_id=slack_user_id))
+                taken_slack_user_ids.add(slack_user_id)
+        SlackUser.objects.bulk_create(new_slack_users)
+        return len(new_slack_users)
+
     def get_or_corellate_slack_user(self, slack_user_id):
         """
         Find or create a SlackUser instance, searching by slack_user_id or linked RouletteUser's email.
-        If the SlackUser doesn't exist, but the email of user slack_user_id as returned by Slack API is in our database,
-        then create a new SlackUser instance in database.
+        If the SlackUser doesn't exist, but the email of user slack_user_id as found in the Slack directory
+        is in our database, then create a new SlackUser instance in database.
+        Users that aren't in the cached directory yet (e.g. they have just joined Slack) are fetched from Slack
+        and added to it.
         Return a dictionary, for example:
         {
             "slack_id": "U12345",
@@ -131,66 +323,102 @@ class BotClient():
             return self._slack_user_to_dict(slack_users_by_id.get())
 
         # Corellate user account on Slack with SlackUser by his/her email address, which both we and Slack require.
-        response = self._webclient.users_info(user=slack_user_id)
-        if not response["ok"]:
-            raise SlackbotError("Could not fetch email of user {0}: {1}".format(
-                slack_user_id, response["error"]))
-        profile = response["user"]["profile"]
-        email = profile.get("email")
-        roulette_users_by_email = RouletteUser.objects.filter(email=email)
+        directory = self.get_directory()
+        profile = directory["profiles"].get(slack_user_id)
+        if profile is None:
+            response = self._webclient.users_info(user=slack_user_id)
+            if not response["ok"]:
+                raise SlackbotError("Could not fetch email of user {0}: {1}".format(
+                    slack_user_id, response["error"]))
+            self._add_to_directory(
+                directory, slack_user_id, response["user"]["profile"])
+            self._store_directory(directory)
+            profile = directory["profiles"][slack_user_id]
+        email = profile["email"]
+        roulette_users_by_email = RouletteUser.objects.filter(
+            email__iexact=email) if email else RouletteUser.objects.none()
         if len(roulette_users_by_email) == 0:
             return {
                 "slack_id": slack_user_id,
                 "database_slack_user_id": None,
-                "display_name": profile.get("display_name"),
-                "real_name": profile.get("real_name"),
+                "display_name": profile["display_name"],
+                "real_name": profile["real_name"],
                 "email": email
             }
-        roulette_user = roulette_users_by_email.get()
+        roulette_user = roulette_users_by_email.first()
         slack_user = SlackUser.objects.create(
             user=roulette_user, slack_user_id=slack_user_id)
         return self._slack_user_to_dict(slack_user)
 
     def corellate_slack_user_by_email(self, roulette_user):
         """
-        Find a user on Slack given the email field in RouletteUser parameter.
+        Find a user on Slack given the email field in RouletteUser parameter, using the directory.
         If this succeeds, create and return a SlackUser instance.
         Raise a SlackbotError if there was no such Slack user or the Slack Web API returns an error.
         """
-        response = self._webclient.users_lookupByEmail(
-            email=roulette_user.email)
-        if not response["ok"]:
-            # TODO it seems that we can't enter this branch because, on error, slack client throws an exception by itself.
-            # After writing tests, try to remove all bad response handling code from this file.
-            raise SlackbotError("Could not find Slack user by email {0}: {1}".format(
-                roulette_user.email, response["error"]))
-        return SlackUser.objects.create(user=roulette_user, slack_user_id=response["user"]["id"])
+        slack_user_id = self.get_directory()["emails"].get(
+            roulette_user.email.lower())
+        if slack_user_id is None:
+            raise SlackbotError(
+                "Could not find Slack user by email {0}".format(roulette_user.email))
+        return SlackUser.objects.create(user=roulette_user, slack_user_id=slack_user_id)
 
-    def _parse_vote(self, message_text, slack_user, roulette):
+    def _corellate_slack_user_ids(self, slack_user_ids):
         """
-        Try to parse user's message, which is supposed to be a vote.
-        Return a dictionary, for example:
-        {
-            "choice": "Y",
-            "roulette_id": "45",
-            "roulette_user_id": "32"
-        }, or None if the parsing failed.
-        """
-        stripped_message = re.sub('[ \t\n\r.!]', '', message_text).lower()
-        vote = {"roulette_id": str(roulette.id),
-                "roulette_user_id": str(slack_user.user.id)}
-        if stripped_message == "yes":
-            vote["choice"] = "Y"
-        elif stripped_message == "no":
-            vote["choice"] = "N"
-        else:
-            return None
-        return vote
+        Find the SlackUsers with given Slack user IDs, creating the missing ones for the RouletteUsers
+        with the same emails as in the Slack directory.
+        Return a pair of dictionaries: Slack user ID => SlackUser (with its user), for the users found in our database,
+        and Slack user ID => dictionary as returned by get_or_corellate_slack_user, for the other ones.
+        """
+        slack_users = {slack_user.slack_user_id: slack_user for slack_user in
+                       SlackUser.objects.select_related('user').filter(slack_user_id__in=slack_user_ids)}
+        unknown_ids = [slack_user_id for slack_user_id in slack_user_ids if slack_user_id not in slack_users]
+        if len(unknown_ids) == 0:
+            return slack_users, {}
+
+        directory = self.get_directory()
+        missing_ids = [slack_user_id for slack_user_id in unknown_ids if slack_user_id not in directory["profiles"]]
+        for slack_user_id in missing_ids:
+            response = self._webclient.users_info(user=slack_user_id)
+            if not response["ok"]:
+                raise SlackbotError("Could not fetch email of user {0}: {1}".format(
+                    slack_user_id, response["error"]))
+            self._add_to_directory(
+                directory, slack_user_id, response["user"]["profile"])
+        if len(missing_ids) > 0:
+            self._store_directory(directory)
+        emails = {(directory["profiles"][slack_user_id]["email"] or "").lower(): slack_user_id
+                  for slack_user_id in unknown_ids}
+        # Several RouletteUsers can have the same email (in a different case). Like get_or_corellate_slack_user,
+        # only the first one of them gets the Slack user.
+        new_slack_users = {}
+        for roulette_user in RouletteUser.objects.annotate(email_lower=Lower('email')).filter(
+                email_lower__in=[email for email in emails if email], slackuser=None).order_by('pk'):
+            new_slack_users.setdefault(emails[roulette_user.email_lower],
+                                       SlackUser(user=roulette_user, slack_user_id=emails[roulette_user.email_lower]))
+        SlackUser.objects.bulk_create(new_slack_users.values())
+        # bulk_create doesn't set the primary keys on every database, so the new SlackUsers are selected again.
+        slack_users.update((slack_user.slack_user_id, slack_user) for slack_user in
+                           SlackUser.objects.select_related('user').filter(slack_user_id__in=new_slack_users))
+        unknown_users = {}
+        for slack_user_id in unknown_ids:
+            if slack_user_id not in slack_users:
+                profile = directory["profiles"][slack_user_id]
+                unknown_users[slack_user_id] = {
+                    "slack_id": slack_user_id,
+                    "database_slack_user_id": None,
+                    "display_name": profile["display_name"],
+                    "real_name": profile["real_name"],
+                    "email": profile["email"]
+                }
+        return slack_users, unknown_users
 
     def fetch_votes(self, slack_roulette):
         """
         Parse the messages on the Slack thread which is connected to the roulette.
         Look only at the messages that have appeared since the last call of this function.
+        All the pages of replies are fetched first, then their authors are found in the database at once.
+        Only the last vote of every user is returned.
         As a side effect, this function may save new slackbot.models.SlackUser objects into database,
         if a correlation between matcher.models.RouletteUser.email and official Slack profile's email is found.
         sample_result = {
@@ -233,16 +461,14 @@ class BotClient():
             ]
         }
         """
-        vote_list = {
-            "last_message_timestamp": slack_roulette.latest_response_timestamp,
-            "votes": [],
-            "unknown_messages": []
-        }
-        more = True
-        reps_remaining = 100
-        while more:
+        messages = []
+        last_message_timestamp = slack_roulette.latest_response_timestamp
+        cursor = None
+        while True:
             response = self._webclient.conversations_replies(
-                channel=slack_roulette.channel_id, ts=slack_roulette.thread_timestamp, oldest=vote_list["last_message_timestamp"])
+                channel=slack_roulette.channel_id, ts=slack_roulette.thread_timestamp,
+                oldest=slack_roulette.latest_response_timestamp, cursor=cursor,
+                limit=settings.SLACKBOT_REPLIES_PAGE_SIZE)
             if not response["ok"]:
                 raise SlackbotError("Could not fetch Slack thread replies on channel {0}, thread {1}: {2}".format(
                     slack_roulette.channel_id, slack_roulette.thread_timestamp, response["error"]))
@@ -250,24 +476,38 @@ class BotClient():
                 if message["ts"] == slack_roulette.thread_timestamp:
                     # Slack returns the thread parent message too. We ignore it.
                     continue
-                user_dict = self.get_or_corellate_slack_user(message["user"])
-                if user_dict["database_slack_user_id"] is None:
-                    vote_list["unknown_messages"].append(
-                        {"user": user_dict, "text": message["text"], "reason": "Could not correlate our data with Slack using email field."})
-                else:
-                    slack_user = SlackUser.objects.get(
-                        pk=int(user_dict["database_slack_user_id"]))
-                    vote = self._parse_vote(
-                        message["text"], slack_user, slack_roulette.roulette)
-                    if vote is None:
-                        vote_list["unknown_messages"].append({"user": self._slack_user_to_dict(
-                            slack_user), "text": message["text"], "reason": "Could not parse user's message."})
-                    else:
-                        vote_list["votes"].append(vote)
-                if Decimal(message["ts"]) > Decimal(vote_list["last_message_timestamp"]):
-                    vote_list["last_message_timestamp"] = message["ts"]
-            more = response["has_more"]
-            reps_remaining -= 1
-            if reps_remaining <= 0:
-                more = False
+                if Decimal(message["ts"]) > Decimal(last_message_timestamp):
+                    last_message_timestamp = message["ts"]
+                # The messages of bots (e.g. our own) aren't votes.
+                if "user" in message and "bot_id" not in message:
+                    messages.append(message)
+            cursor = response.get("response_metadata", {}).get("next_cursor")
+            if not response.get("has_more") or not cursor:
+                break
+        messages.sort(key=lambda message: Decimal(message["ts"]))
+
+        slack_users, unknown_users = self._corellate_slack_user_ids(
+            list({message["user"] for message in messages}))
+        vote_list = {
+            "last_message_timestamp": last_message_timestamp,
+            "votes": [],
+            "unknown_messages": []
+        }
+        votes = {}
+        for message in messages:
+            if message["user"] in unknown_users:
+                vote_list["unknown_messages"].append(
+                    {"user": unknown_users[message["user"]], "text": message["text"], "reason": "Could not correlate our data with Slack using email field."})
+                continue
+            slack_user = slack_users[message["user"]]
+            choice = parse_vote_choice(message["text"])
+            if choice is None:
+                vote_list["unknown_messages"].append({"user": self._slack_user_to_dict(
+                    slack_user), "text": message["text"], "reason": "Could not parse user's message."})
+            else:
+                # Only the last vote counts. The messages are sorted, so the later votes replace the earlier ones.
+                votes[slack_user.user_id] = {"roulette_id": str(slack_roulette.roulette_id),
+                                             "roulette_user_id": str(slack_user.user_id),
+                                             "choice": choice}
+        vote_list["votes"] = list(votes.values())
         return vote_list
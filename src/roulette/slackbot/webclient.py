@@ -0,0 +1,152 @@
+"""
+The HTTP connections to the Slack Web API. slack.WebClient opens a new connection (and does a new TLS handshake)
+for every API call. KeepAliveWebClient sends the calls over keep-alive connections instead, which are kept
+in a ConnectionPool and reused by the following calls. get_webclient() returns a client shared by the whole process,
+so all the BotClients, in all the threads, share the same connections.
+"""
+import http.client
+import json
+import threading
+import slack
+from urllib.parse import urlencode, urlsplit
+from django.conf import settings
+
+
+class ConnectionPool():
+    """
+    A thread-safe pool of keep-alive HTTP(S) connections. Every request takes an idle connection to its host
+    (or opens a new one), and gives it back when the response has been read, so a connection is never used by two
+    threads at the same time. At most 'max_idle' connections per host are kept open between the requests.
+    """
+
+    def __init__(self, max_idle, timeout, ssl_context=None):
+        self._max_idle = max_idle
+        self._timeout = timeout
+        self._ssl_context = ssl_context
+        self._idle = {}
+        self._stats = {'requests': 0, 'connections_opened': 0}
+        self._lock = threading.Lock()
+
+    def _open(self, host_key):
+        scheme, host, port = host_key
+        with self._lock:
+            self._stats['connections_opened'] += 1
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self._timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(host, port, timeout=self._timeout)
+
+    def _take(self, host_key):
+        """ Return an idle connection to the host and True, or a new connection and False. """
+        with self._lock:
+            self._stats['requests'] += 1
+            idle_connections = self._idle.get(host_key)
+            if idle_connections:
+                return idle_connections.pop(), True
+        return self._open(host_key), False
+
+    def _give_back(self, host_key, connection):
+        with self._lock:
+            idle_connections = self._idle.setdefault(host_key, [])
+            if len(idle_connections) < self._max_idle:
+                idle_connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, url, body, headers):
+        """
+        POST the body (bytes or None) to the URL. Return the status, the headers (an http.client.HTTPMessage)
+        and the body (bytes) of the response.
+        """
+        parts = urlsplit(url)
+        host_key = (parts.scheme.lower(), parts.hostname, parts.port)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        connection, reused = self._take(host_key)
+        while True:
+            try:
+                connection.request('POST', path, body=body, headers=headers)
+                response = connection.getresponse()
+                response_body = response.read()
+                break
+            except ConnectionError:
+                connection.close()
+                if not reused:
+                    raise
+                # The server has closed the idle connection in the meantime. Try again on a new one.
+                connection, reused = self._open(host_key), False
+            except Exception:
+                connection.close()
+                raise
+        if response.will_close:
+            connection.close()
+        else:
+            self._give_back(host_key, connection)
+        return response.status, response.msg, response_body
+
+    def stats(self):
+        """ Return the number of requests sent and of connections opened for them, e.g. to check the reuse. """
+        with self._lock:
+            return dict(self._stats)
+
+    def close(self):
+        """ Close all the idle connections. """
+        with self._lock:
+            idle_connections = [connection for connections in self._idle.values() for connection in connections]
+            self._idle = {}
+        for connection in idle_connections:
+            connection.close()
+
+
+class KeepAliveWebClient(slack.WebClient):
+    """
+    A slack.WebClient that sends the API calls over the keep-alive connections of a ConnectionPool.
+    File uploads and calls through a proxy are still sent by the WebClient itself, one connection per call.
+    """
+
+    def __init__(self, *args, pool=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool if pool is not None else ConnectionPool(
+            settings.SLACKBOT_HTTP_MAX_IDLE_CONNECTIONS, self.timeout, self.ssl)
+
+    def _perform_urllib_http_request(self, *, url, args):
+        if self.proxy is not None or args["data"] or not url.lower().startswith("http"):
+            return super()._perform_urllib_http_request(url=url, args=args)
+        headers = args["headers"]
+        if args["json"]:
+            body = json.dumps(args["json"]).encode("utf-8")
+            headers["Content-Type"] = "application/json;charset=utf-8"
+        elif args["params"]:
+            body = urlencode(args["params"]).encode("utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        else:
+            body = None
+        status, response_headers, response_body = self.pool.request(url, body, headers)
+        charset = response_headers.get_content_charset() or "utf-8"
+        headers = dict(response_headers)
+        # Like the WebClient, so that slackbot.ratelimit finds the header whatever its case is.
+        if response_headers.get("Retry-After") is not None:
+            headers["Retry-After"] = response_headers.get("Retry-After")
+        return {"status": status, "headers": headers, "body": response_body.decode(charset)}
+
+
+_webclients = {}
+_webclients_lock = threading.Lock()
+
+
+def get_webclient(token):
+    """
+    Return the KeepAliveWebClient for the bot token and settings.SLACKBOT_API_URL, shared by the whole process.
+    """
+    key = (token, settings.SLACKBOT_API_URL)
+    with _webclients_lock:
+        if key not in _webclients:
+            _webclients[key] = KeepAliveWebClient(token=token, base_url=settings.SLACKBOT_API_URL)
+        return _webclients[key]
+
+
+def close_webclients():
+    """ Forget the shared clients, and close their idle connections. """
+    with _webclients_lock:
+        webclients = list(_webclients.values())
+        _webclients.clear()
+    for webclient in webclients:
+        webclient.pool.close()